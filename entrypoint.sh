@@ -1,4 +1,4 @@
 cd wallet || return 1
 pipenv run python tools/create_tables.py
 pipenv run python tools/create_users.py
-pipenv run python -O main.py
+exec pipenv run gunicorn -c gunicorn_conf.py main:app
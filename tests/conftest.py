@@ -39,6 +39,20 @@ def database(mocker):
     return database.return_value
 
 
+@pytest.fixture(scope='function', autouse=True)
+def export_cache_dir(mocker, tmp_path):
+    export_cache_dir = str(tmp_path / 'export-cache')
+    mocker.patch('config.EXPORT_CACHE_DIR', export_cache_dir)
+    return export_cache_dir
+
+
+@pytest.fixture(scope='function', autouse=True)
+def export_jobs_dir(mocker, tmp_path):
+    export_jobs_dir = str(tmp_path / 'export-jobs')
+    mocker.patch('config.EXPORT_JOBS_DIR', export_jobs_dir)
+    return export_jobs_dir
+
+
 @pytest.fixture(scope='function')
 def test_app():
     import wallet.main
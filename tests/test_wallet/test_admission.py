@@ -0,0 +1,175 @@
+import asyncio
+import decimal
+import time
+import uuid
+from unittest import mock
+
+import asyncpg
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.dialects import postgresql
+
+import adapters
+import admission
+import models
+import shards
+import tables
+from tests.factories import make_wallet_json
+from tests.utils import async_mock, get, post
+
+
+# Wallets of a transfer are locked in id order, the sender first
+WALLET_ID, RECIPIENT_WALLET_ID = sorted(str(uuid.uuid4()) for _ in range(2))
+
+
+@pytest.fixture
+def fail_fast_locks(mocker):
+    mocker.patch('config.WALLET_LOCK_MODE', 'timeout')
+    mocker.patch('config.WALLET_LOCK_TIMEOUT_MS', 200)
+    mocker.patch('config.DEPOSIT_STATEMENT_TIMEOUT_MS', 500)
+
+
+def test_deposit__burst_exhausted__returns_too_many_requests(database, user, test_app):
+    import wallet.main
+    wallet.main.mutation_rate_limiter.rate = 0.01
+    wallet.main.mutation_rate_limiter.burst = 1
+    database.fetch_one = async_mock(return_value=make_wallet_json(wallet_id=WALLET_ID, user_id=user.id))
+    database.fetch_val = async_mock(return_value=decimal.Decimal(1))
+    database.execute = async_mock(return_value=1)
+
+    first_response = post(test_app, f'/wallet/{WALLET_ID}/deposit', json={'value': '1'})
+    second_response = post(test_app, f'/wallet/{WALLET_ID}/deposit', json={'value': '1'})
+
+    assert first_response.status_code == 200
+    assert second_response.status_code == 429
+    assert second_response.json()['detail'][0]['msg'] == 'Too many requests'
+    assert int(second_response.headers['Retry-After']) > 1
+    assert database.fetch_one.mock.call_count == 1
+
+
+def test_operations__concurrency_cap_reached__returns_service_unavailable(database, user, test_app):
+    import wallet.main
+    limiter = wallet.main.export_concurrency_limiter
+    limiter.active = limiter.limit
+
+    response = get(test_app, f'/wallet/{WALLET_ID}/operations')
+
+    assert response.status_code == 503
+    assert response.json()['detail'][0]['msg'] == 'Too many concurrent requests'
+    assert database.fetch_one.mock.call_count == 0
+
+
+def test_get__pool_wait_over_threshold__returns_service_unavailable(database, user, test_app):
+    import wallet.main
+    wallet.main.read_pool_guard.guards[0].wait = 10
+    wallet.main.read_pool_guard.guards[0].updated_at = time.monotonic()
+
+    response = get(test_app, f'/wallet/{WALLET_ID}')
+
+    assert response.status_code == 503
+    assert response.json()['detail'][0]['msg'] == 'Service overloaded'
+    assert 'Retry-After' in response.headers
+    assert database.fetch_one.mock.call_count == 0
+
+
+def test_get__pool_wait_decayed__admits_request(database, user, test_app):
+    import wallet.main
+    wallet.main.read_pool_guard.guards[0].wait = 10
+    wallet.main.read_pool_guard.guards[0].updated_at = time.monotonic() - 60
+    database.fetch_one = async_mock(return_value=make_wallet_json(wallet_id=WALLET_ID, user_id=user.id))
+
+    response = get(test_app, f'/wallet/{WALLET_ID}')
+
+    assert response.status_code == 200
+
+
+@pytest.fixture
+def pool_sizes(mocker):
+    mocker.patch('config.POSTGRES_WRITE_POOL_MAX_SIZE', 6)
+    mocker.patch('config.POSTGRES_READ_POOL_MAX_SIZE', 4)
+    mocker.patch('config.POSTGRES_EXPORT_POOL_MAX_SIZE', 2)
+    mocker.patch('config.POSTGRES_WRITE_STATEMENT_TIMEOUT_MS', 0)
+
+
+def test_app__workloads__get_pools_with_own_sizes_and_timeouts(pool_sizes, database, test_app):
+    import databases
+    pools = [
+        (call.kwargs['max_size'], call.kwargs['server_settings'])
+        for call in databases.Database.call_args_list if 'server_settings' in call.kwargs
+    ]
+
+    assert pools == [(6, {}), (4, {'statement_timeout': '5000'}), (2, {'statement_timeout': '60000'})]
+
+
+def test_operations__export_pool_queue_full__sheds_exports_but_not_deposits(database, user, test_app):
+    import wallet.main
+    export_pool_guard = wallet.main.export_pool_guard.guards[0]
+    export_pool_guard.waiting = export_pool_guard.max_waiting
+    database.fetch_one = async_mock(return_value=make_wallet_json(wallet_id=WALLET_ID, user_id=user.id))
+    database.fetch_val = async_mock(return_value=decimal.Decimal(1))
+    database.execute = async_mock(return_value=1)
+
+    export_response = get(test_app, f'/wallet/{WALLET_ID}/operations')
+    deposit_response = post(test_app, f'/wallet/{WALLET_ID}/deposit', json={'value': '1'})
+
+    assert export_response.status_code == 503
+    assert export_response.json()['detail'][0]['msg'] == 'Service overloaded'
+    assert deposit_response.status_code == 200
+
+
+def test_sharded_pool_guard__busy_shard__sheds_only_its_wallets():
+    router = shards.ShardRouter([mock.MagicMock(), mock.MagicMock()])
+    guard = admission.ShardedPoolGuard('read', router, 0, max_waiting=1)
+    wallet_ids = {}
+    while len(wallet_ids) < 2:
+        wallet_id = str(uuid.uuid4())
+        wallet_ids.setdefault(router.get_index(wallet_id), wallet_id)
+    guard.guards[1].waiting = 1
+
+    async def request(wallet_id):
+        async for _ in guard(mock.MagicMock(path_params={'wallet_id': wallet_id})):
+            pass
+
+    asyncio.run(request(wallet_ids[0]))
+    asyncio.run(request('not-a-uuid'))
+    with pytest.raises(HTTPException):
+        asyncio.run(request(wallet_ids[1]))
+
+    assert router.databases[0].connection.call_count == 2
+    assert router.databases[1].connection.call_count == 0
+    assert [shard_guard.name for shard_guard in guard.guards] == ['read-0', 'read-1']
+
+
+def test_transfer__wallet_locked__returns_conflict(database, user, test_app):
+    database.fetch_one = async_mock(side_effect=asyncpg.LockNotAvailableError('could not obtain lock'))
+
+    response = post(test_app, f'/wallet/{WALLET_ID}/transfer-to/{RECIPIENT_WALLET_ID}', json={'value': '1'})
+
+    assert response.status_code == 409
+    assert response.json()['detail'][0]['msg'] == 'Wallet is busy'
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_deposit__statement_timeout__sets_local_timeouts_and_returns_service_unavailable(
+        fail_fast_locks, database, user, test_app,
+):
+    database.fetch_one = async_mock(side_effect=asyncpg.QueryCanceledError('canceling statement'))
+
+    response = post(test_app, f'/wallet/{WALLET_ID}/deposit', json={'value': '1'})
+
+    assert response.status_code == 503
+    assert response.json()['detail'][0]['msg'] == 'Request timed out'
+    timeouts_stmt = database.execute.mock.call_args_list[0].args[0].compile(dialect=postgresql.dialect())
+    assert str(timeouts_stmt).startswith('SELECT set_config(')
+    assert list(timeouts_stmt.params.values()) == ['lock_timeout', '200', 'statement_timeout', '500']
+
+
+def test_lock__nowait_mode__fails_instead_of_waiting():
+    database = mock.MagicMock()
+    database.fetch_one = async_mock(return_value=None)
+    adapter = adapters.WalletDatabaseAdapter(models.WalletDB, database, tables.wallets, lock_nowait=True)
+
+    asyncio.run(adapter.lock(WALLET_ID))
+
+    query = database.fetch_one.mock.call_args.args[0].compile(dialect=postgresql.dialect())
+    assert str(query).endswith('FOR UPDATE NOWAIT')
@@ -0,0 +1,132 @@
+import asyncio
+import datetime
+import decimal
+import os
+import uuid
+
+import enums
+import models
+import tables
+from tests.factories import make_wallet_json
+from tests.utils import async_mock, call_args_to_sql_strings, compile_sql_statement, get, post
+
+
+WALLET_ID = str(uuid.uuid4())
+JOB_ID = str(uuid.uuid4())
+
+
+def make_job_json(user_id, status=enums.ExportJobStatus.pending, **kwargs):
+    return models.ExportJobDB(
+        id=JOB_ID,
+        user_id=str(user_id),
+        wallet_id=WALLET_ID,
+        status=status,
+        rows_written=0,
+        created_at=datetime.datetime(2020, 1, 1),
+        updated_at=datetime.datetime(2020, 1, 1),
+        **kwargs,
+    ).dict()
+
+
+def test_create__wallet_owned__returns_pending_job(database, user, test_app):
+    wallet_data = make_wallet_json(wallet_id=WALLET_ID, user_id=user.id)
+    database.fetch_one = async_mock(return_value=wallet_data)
+    database.fetch_val = async_mock(return_value=JOB_ID)
+
+    response = post(test_app, f'/wallet/{WALLET_ID}/operations/export-jobs?side=deposit')
+
+    insert_stmt = call_args_to_sql_strings(database.fetch_val.mock.call_args_list, literal_binds=False)[0]
+    insert_params = database.fetch_val.mock.call_args.args[0].compile().params
+    assert insert_stmt.startswith('INSERT INTO export_job')
+    assert insert_params['side'] == 'deposit'
+    assert insert_params['status'] == 'pending'
+    assert response.status_code == 202
+    assert response.json()['id'] == JOB_ID
+    assert response.json()['status'] == 'pending'
+    assert response.json()['progress'] is None
+
+
+def test_create__wallet_not_owned__returns_error(database, user, test_app):
+    database.fetch_one = async_mock(return_value=make_wallet_json(wallet_id=WALLET_ID))
+
+    response = post(test_app, f'/wallet/{WALLET_ID}/operations/export-jobs')
+
+    assert database.fetch_val.mock.call_count == 0
+    assert response.status_code == 403
+
+
+def test_get__job_running__returns_progress(database, user, test_app):
+    job_data = make_job_json(user.id, status=enums.ExportJobStatus.running, rows_total=10)
+    job_data['rows_written'] = 5
+    database.fetch_one = async_mock(return_value=job_data)
+
+    response = get(test_app, f'/export-jobs/{JOB_ID}')
+
+    select_stmt = compile_sql_statement(tables.export_jobs.select().where(tables.export_jobs.c.id == JOB_ID))
+    assert call_args_to_sql_strings(database.fetch_one.mock.call_args_list)[0] == select_stmt
+    assert response.status_code == 200
+    assert response.json()['status'] == 'running'
+    assert response.json()['progress'] == 0.5
+
+
+def test_get__job_not_owned__returns_error(database, user, test_app):
+    database.fetch_one = async_mock(return_value=make_job_json(uuid.uuid4()))
+
+    response = get(test_app, f'/export-jobs/{JOB_ID}')
+
+    assert response.status_code == 403
+    assert response.json()['detail'][0]['msg'] == 'User does not own the export job'
+
+
+def test_download__job_not_finished__returns_error(database, user, test_app):
+    database.fetch_one = async_mock(return_value=make_job_json(user.id, status=enums.ExportJobStatus.running))
+
+    response = get(test_app, f'/export-jobs/{JOB_ID}/download')
+
+    assert response.status_code == 409
+    assert response.json()['detail'][0]['status'] == 'running'
+
+
+def test_download__job_done__returns_file(database, user, test_app, export_jobs_dir):
+    database.fetch_one = async_mock(return_value=make_job_json(
+        user.id,
+        status=enums.ExportJobStatus.done,
+        expires_at=datetime.datetime.utcnow() + datetime.timedelta(hours=1),
+    ))
+    os.makedirs(export_jobs_dir)
+    with open(os.path.join(export_jobs_dir, f'{JOB_ID}.csv'), 'w') as file:
+        file.write('id\r\n')
+
+    response = get(test_app, f'/export-jobs/{JOB_ID}/download')
+
+    assert response.status_code == 200
+    assert response.content == b'id\r\n'
+    assert response.headers['Content-Disposition'] == f'attachment;filename=export-{WALLET_ID}-both.csv'
+
+
+def test_run__pages_written__job_done(database, user, test_app, export_jobs_dir):
+    import wallet.main
+    entries = [
+        {
+            'wallet_id': WALLET_ID,
+            'timestamp': datetime.datetime(2020, 1, 1, 0, 0, 1),
+            'transaction_id': 1,
+            'counterparty_wallet_id': None,
+            'value': decimal.Decimal(1),
+        },
+    ]
+    database.fetch_val = async_mock(return_value=1)
+    database.fetch_all = async_mock(return_value=entries)
+    job = models.ExportJobDB(**make_job_json(user.id, status=enums.ExportJobStatus.running))
+
+    asyncio.run(wallet.main.export_job_runner.run(job))
+
+    with open(os.path.join(export_jobs_dir, f'{JOB_ID}.csv'), newline='') as file:
+        assert file.read() == (
+            'id,sender_wallet_id,recipient_wallet_id,value,timestamp\r\n'
+            f'1,EXTERNAL_DEPOSIT,{WALLET_ID},1,2020-01-01 00:00:01\r\n'
+        )
+    assert os.listdir(export_jobs_dir) == [f'{JOB_ID}.csv']
+    finish_stmt = call_args_to_sql_strings(database.execute.mock.call_args_list, literal_binds=False)[-1]
+    assert finish_stmt.startswith('UPDATE export_job SET status=')
+    assert database.execute.mock.call_args_list[-1].args[0].compile().params['status'] == 'done'
@@ -0,0 +1,229 @@
+import asyncio
+import datetime
+import decimal
+import uuid
+from unittest import mock
+
+from sqlalchemy.dialects import postgresql
+
+import adapters
+import enums
+import holds
+import models
+import tables
+from tests.factories import make_wallet_json
+from tests.utils import AsyncContextManagerMock, async_mock, call_args_to_sql_strings, get, post
+
+
+# Wallets of a transfer are locked in id order, the sender first
+WALLET_ID, RECIPIENT_WALLET_ID = sorted(str(uuid.uuid4()) for _ in range(2))
+HOLD_ID = str(uuid.uuid4())
+
+
+def make_hold_json(status=enums.HoldStatus.held, value=decimal.Decimal(30), expires_at=None):
+    return models.HoldDB(
+        id=HOLD_ID,
+        wallet_id=WALLET_ID,
+        recipient_wallet_id=RECIPIENT_WALLET_ID,
+        value=value,
+        status=status,
+        created_at=datetime.datetime(2020, 1, 1),
+        expires_at=expires_at or datetime.datetime(2020, 1, 8),
+    ).dict()
+
+
+def make_sender(user, balance, held):
+    return {
+        **make_wallet_json(wallet_id=WALLET_ID, user_id=user.id, balance=decimal.Decimal(balance)),
+        'held': decimal.Decimal(held),
+    }
+
+
+# Expires holds in memory, the ones in `failing` raise
+class FakeHoldAdapter:
+    def __init__(self, expiring, failing=()):
+        self.expiring = expiring
+        self.failing = failing
+        self.expired = []
+
+    async def get_expiring(self, until, limit):
+        return [hold for hold in self.expiring if hold.expires_at <= until][:limit]
+
+    async def expire(self, hold_id, now):
+        if hold_id in self.failing:
+            raise RuntimeError('connection lost')
+        self.expired.append(hold_id)
+        return True
+
+
+def make_expiring_hold(seconds):
+    return models.HoldDB(id=uuid.uuid4(), expires_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds))
+
+
+def make_scheduler(db_adapters, **kwargs):
+    return holds.HoldExpiryScheduler(db_adapters, **{
+        'horizon_seconds': 60,
+        'load_interval': 30.0,
+        'batch_size': 100,
+        **kwargs,
+    })
+
+
+def test_expire_due__loaded_holds__expires_only_due_ones_and_skips_failures():
+    overdue, failing, later, far = (make_expiring_hold(seconds) for seconds in (-10, -5, 30, 600))
+    db_adapter = FakeHoldAdapter([overdue, failing, later, far], failing={failing.id})
+    scheduler = make_scheduler([db_adapter])
+
+    loaded = asyncio.run(scheduler.load())
+    expired = asyncio.run(scheduler.expire_due())
+
+    assert loaded == 3
+    assert expired == 1
+    assert db_adapter.expired == [overdue.id]
+    assert [hold_id for _, hold_id, _ in scheduler._heap] == [later.id]
+
+
+def test_run__hold_scheduled_on_creation__expires_it_when_due():
+    db_adapter = FakeHoldAdapter([])
+    scheduler = make_scheduler([db_adapter])
+    hold = make_expiring_hold(0.05)
+
+    async def run():
+        scheduler.start()
+        await asyncio.sleep(0.01)
+        scheduler.schedule(0, hold.id, hold.expires_at)
+        scheduler.schedule(0, uuid.uuid4(), datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+        await asyncio.sleep(0.1)
+        await scheduler.stop()
+
+    asyncio.run(run())
+
+    assert db_adapter.expired == [hold.id]
+    assert len(scheduler._heap) == 0
+
+
+def test_expire__releases_held_funds_only_if_hold_is_still_active_and_due():
+    database = mock.MagicMock()
+    database.transaction = mock.MagicMock(return_value=AsyncContextManagerMock())
+    database.fetch_one = async_mock(side_effect=[{'wallet_id': WALLET_ID, 'value': decimal.Decimal(30)}, None])
+    database.execute = async_mock()
+    adapter = adapters.HoldDatabaseAdapter(models.HoldDB, database, tables.wallet_holds, tables.wallets)
+    now = datetime.datetime(2020, 1, 8)
+
+    assert asyncio.run(adapter.expire(HOLD_ID, now))
+    assert not asyncio.run(adapter.expire(HOLD_ID, now))
+
+    hold_query = str(database.fetch_one.mock.call_args.args[0].compile(dialect=postgresql.dialect()))
+    assert 'wallet_hold.status = %(status_1)s AND wallet_hold.expires_at <= %(expires_at_1)s' in hold_query
+    wallet_query = str(database.execute.mock.call_args.args[0].compile(dialect=postgresql.dialect()))
+    assert 'held=(wallet.held - %(held_1)s)' in wallet_query
+    assert database.execute.mock.call_count == 1
+
+
+def test_create__enough_available_funds__holds_them(database, user, test_app):
+    database.fetch_one = async_mock(side_effect=[
+        make_wallet_json(wallet_id=RECIPIENT_WALLET_ID),
+        make_sender(user, balance=100, held=50),
+        None,
+        make_hold_json(),
+    ])
+    database.fetch_val = async_mock(return_value=decimal.Decimal(80))
+
+    response = post(test_app, f'/wallet/{WALLET_ID}/holds', json={
+        'value': '30',
+        'recipient_wallet_id': RECIPIENT_WALLET_ID,
+        'ttl_seconds': 60,
+    })
+
+    assert response.status_code == 201
+    assert response.json()['status'] == 'held'
+    held_query = call_args_to_sql_strings(database.fetch_val.mock.call_args_list)[0]
+    assert 'held=(wallet.held + 30)' in held_query
+    insert_query = database.fetch_one.mock.call_args.args[0].compile(dialect=postgresql.dialect())
+    assert insert_query.params['expires_at'] - insert_query.params['created_at'] == datetime.timedelta(seconds=60)
+
+
+def test_create__held_funds_not_available__returns_error(database, user, test_app):
+    database.fetch_one = async_mock(side_effect=[
+        make_wallet_json(wallet_id=RECIPIENT_WALLET_ID),
+        make_sender(user, balance=100, held=80),
+    ])
+
+    response = post(test_app, f'/wallet/{WALLET_ID}/holds', json={
+        'value': '30',
+        'recipient_wallet_id': RECIPIENT_WALLET_ID,
+    })
+
+    assert response.status_code == 400
+    assert response.json()['detail'][0]['msg'] == 'Insufficient funds'
+    assert database.fetch_val.mock.call_count == 0
+
+
+def test_transfer__held_funds__are_not_spent(database, user, test_app):
+    database.fetch_one = async_mock(side_effect=[
+        make_sender(user, balance=100, held=95),
+        make_wallet_json(wallet_id=RECIPIENT_WALLET_ID),
+    ])
+
+    response = post(test_app, f'/wallet/{WALLET_ID}/transfer-to/{RECIPIENT_WALLET_ID}', json={'value': '10'})
+
+    assert response.status_code == 400
+    assert database.execute.mock.call_count == 0
+
+
+def test_capture__part_of_hold__transfers_it_and_releases_the_rest(database, user, test_app):
+    database.fetch_one = async_mock(side_effect=[
+        make_sender(user, balance=100, held=30),
+        make_hold_json(),
+        make_hold_json(status=enums.HoldStatus.captured),
+        make_sender(user, balance=100, held=30),
+        make_wallet_json(wallet_id=RECIPIENT_WALLET_ID),
+        None,
+    ])
+    database.fetch_val = async_mock(return_value=decimal.Decimal(90))
+    database.execute = async_mock(return_value=1)
+
+    response = post(test_app, f'/wallet/{WALLET_ID}/holds/{HOLD_ID}/capture', json={'value': '10'})
+
+    assert response.status_code == 200
+    assert response.json() == {'value': '10', 'balance': '90'}
+    resolve_query = call_args_to_sql_strings(database.fetch_one.mock.call_args_list)[2]
+    assert resolve_query.startswith("UPDATE wallet_hold SET status='captured'")
+    fetch_val_sql_args = call_args_to_sql_strings(database.fetch_val.mock.call_args_list)
+    assert any('held=(wallet.held + -30)' in query for query in fetch_val_sql_args)
+    assert any('balance=(wallet.balance + -10)' in query for query in fetch_val_sql_args)
+
+
+def test_capture__more_than_held__returns_error(database, user, test_app):
+    database.fetch_one = async_mock(side_effect=[make_sender(user, balance=100, held=30), make_hold_json()])
+
+    response = post(test_app, f'/wallet/{WALLET_ID}/holds/{HOLD_ID}/capture', json={'value': '31'})
+
+    assert response.status_code == 400
+    assert database.fetch_one.mock.call_count == 2
+
+
+def test_release__hold_already_expired__returns_error(database, user, test_app):
+    database.fetch_one = async_mock(side_effect=[
+        make_sender(user, balance=100, held=0),
+        make_hold_json(),
+        None,
+        make_hold_json(status=enums.HoldStatus.expired),
+    ])
+
+    response = post(test_app, f'/wallet/{WALLET_ID}/holds/{HOLD_ID}/release')
+
+    assert response.status_code == 409
+    assert response.json()['detail'][0]['status'] == 'expired'
+    assert database.fetch_val.mock.call_count == 0
+
+
+def test_get__active_holds__returns_them_with_available_funds(database, user, test_app):
+    database.fetch_one = async_mock(return_value=make_sender(user, balance=100, held=30))
+    database.fetch_all = async_mock(return_value=[make_hold_json()])
+
+    response = get(test_app, f'/wallet/{WALLET_ID}/holds')
+
+    assert response.status_code == 200
+    assert response.json()['available'] == '70'
+    assert [hold['id'] for hold in response.json()['holds']] == [HOLD_ID]
@@ -0,0 +1,276 @@
+import asyncio
+import contextlib
+import csv
+import datetime
+import decimal
+import io
+import uuid
+import zipfile
+from unittest import mock
+
+import pytest
+
+import adapters
+import models
+import operations_export
+import tables
+from tests.factories import make_wallet_json
+from tests.utils import AsyncContextManagerMock, async_mock, get
+
+
+WALLET_ID = str(uuid.uuid4())
+OTHER_WALLET_ID = str(uuid.uuid4())
+
+
+def make_transaction(transaction_id, second, sender_wallet_id=None, recipient_wallet_id=WALLET_ID):
+    return models.TransactionDB(
+        id=transaction_id,
+        sender_wallet_id=sender_wallet_id,
+        recipient_wallet_id=recipient_wallet_id,
+        value=decimal.Decimal(1),
+        timestamp=datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=second),
+    )
+
+
+# Serves pages of in-memory histories the way keyset pagination does, counting concurrent reads
+class FakeTransactionAdapter:
+    def __init__(self, histories):
+        self.histories = histories
+        self.pages = []
+        self.running = 0
+        self.max_running = 0
+        self.snapshots = []
+
+    async def get_page(self, wallet_id, from_timestamp, to_timestamp, transfer_side, after, limit, operation_filter):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        # Later pages come back sooner, so the output order does not follow the read order
+        await asyncio.sleep(0.01 / (len(self.pages) + 1))
+        self.running -= 1
+        history = [
+            transaction for transaction in self.histories[wallet_id]
+            if (not after or (transaction.timestamp, transaction.id) > after)
+            and (not from_timestamp or transaction.timestamp >= from_timestamp)
+            and (not to_timestamp or transaction.timestamp <= to_timestamp)
+        ]
+        self.pages.append((wallet_id, len(history[:limit])))
+        return history[:limit]
+
+    async def get_time_bounds(self, wallet_id, from_timestamp, to_timestamp):
+        history = self.histories[wallet_id]
+        return (history[0].timestamp, history[-1].timestamp) if history else (None, None)
+
+    @contextlib.asynccontextmanager
+    async def export_snapshot(self, wallet_id):
+        yield '00000003-0000001B-1'
+
+    @contextlib.asynccontextmanager
+    async def use_snapshot(self, wallet_id, snapshot_id):
+        self.snapshots.append(snapshot_id)
+        yield
+
+
+def make_cursors(adapter, page_size, parallelism=2):
+    semaphore = asyncio.Semaphore(parallelism)
+    return [
+        operations_export.WalletPages(adapter, wallet_id, None, None, None, page_size, semaphore)
+        for wallet_id in adapter.histories
+    ]
+
+
+# Cursors share a semaphore, which has to be made inside the running loop
+def collect(make_stream):
+    async def run():
+        return [chunk async for chunk in make_stream()]
+
+    return asyncio.run(run())
+
+
+def test_stream_merged_csv__several_wallets__merges_by_time_and_writes_shared_transfers_once():
+    transfer = make_transaction(3, 3, sender_wallet_id=OTHER_WALLET_ID)
+    adapter = FakeTransactionAdapter({
+        WALLET_ID: [make_transaction(1, 1), transfer, make_transaction(5, 5)],
+        OTHER_WALLET_ID: [make_transaction(2, 2, recipient_wallet_id=OTHER_WALLET_ID), transfer],
+    })
+
+    chunks = collect(lambda: operations_export.stream_merged_csv(make_cursors(adapter, page_size=1), 2))
+
+    rows = list(csv.DictReader(io.StringIO(''.join(chunks))))
+    assert [row['id'] for row in rows] == ['1', '2', '3', '5']
+    assert rows[0]['sender_wallet_id'] == 'EXTERNAL_DEPOSIT'
+    assert max(len(chunk.splitlines()) for chunk in chunks[1:]) == 2
+    assert adapter.max_running == 2
+
+
+def test_stream_zip__several_wallets__writes_one_file_per_wallet():
+    adapter = FakeTransactionAdapter({
+        WALLET_ID: [make_transaction(transaction_id, transaction_id) for transaction_id in range(1, 6)],
+        OTHER_WALLET_ID: [],
+    })
+
+    chunks = collect(lambda: operations_export.stream_zip(
+        make_cursors(adapter, page_size=2), ['a.csv', 'b.csv'], read_ahead=1,
+    ))
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+
+    assert archive.namelist() == ['a.csv', 'b.csv']
+    rows = list(csv.DictReader(io.StringIO(archive.read('a.csv').decode())))
+    assert [row['id'] for row in rows] == ['1', '2', '3', '4', '5']
+    assert archive.read('b.csv').decode().splitlines() == ['id,sender_wallet_id,recipient_wallet_id,value,timestamp']
+    assert [size for wallet_id, size in adapter.pages if wallet_id == WALLET_ID] == [2, 2, 1]
+
+
+def test_get_page_size__many_wallets__keeps_rows_within_budget():
+    assert operations_export.get_page_size(10, row_budget=1000, max_page_size=500) == 50
+    assert operations_export.get_page_size(1, row_budget=1000, max_page_size=100) == 100
+    assert operations_export.get_page_size(5000, row_budget=1000, max_page_size=100) == 1
+
+
+def test_get__zip_of_owned_wallet__streams_archive(database, user, test_app):
+    database.fetch_one = async_mock(return_value=make_wallet_json(wallet_id=WALLET_ID, user_id=user.id))
+    database.fetch_all = async_mock(return_value=[{
+        'wallet_id': WALLET_ID,
+        'timestamp': datetime.datetime(2020, 1, 1, 0, 0, 1),
+        'transaction_id': 1,
+        'counterparty_wallet_id': None,
+        'value': decimal.Decimal(1),
+    }])
+
+    response = get(test_app, f'/operations?wallet_ids={WALLET_ID}&format=zip')
+
+    assert response.status_code == 200
+    assert response.headers['Content-Disposition'] == 'attachment;filename=export-wallets-both.zip'
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.namelist() == [f'export-{WALLET_ID}-both.csv']
+    assert archive.read(archive.namelist()[0]).decode().splitlines()[1].startswith('1,EXTERNAL_DEPOSIT,')
+
+
+def test_get__wallet_not_owned__returns_error(database, user, test_app):
+    database.fetch_one = async_mock(side_effect=[
+        make_wallet_json(wallet_id=WALLET_ID, user_id=user.id),
+        make_wallet_json(wallet_id=OTHER_WALLET_ID),
+    ])
+
+    response = get(test_app, f'/operations?wallet_ids={WALLET_ID}&wallet_ids={OTHER_WALLET_ID}')
+
+    assert response.status_code == 403
+    assert database.fetch_all.mock.call_count == 0
+
+
+def test_get__too_many_wallets__returns_error(mocker, database, user, test_app):
+    mocker.patch('config.OPERATIONS_EXPORT_MAX_WALLETS', 1)
+
+    response = get(test_app, f'/operations?wallet_ids={WALLET_ID}&wallet_ids={OTHER_WALLET_ID}')
+
+    assert response.status_code == 400
+
+
+def test_split_time_range__long_range__covers_it_with_adjacent_chunks():
+    first, last = datetime.datetime(2020, 1, 1), datetime.datetime(2020, 1, 31)
+
+    chunks = operations_export.split_time_range(first, last, max_chunks=3, min_chunk_seconds=86400)
+
+    assert chunks == [
+        (first, datetime.datetime(2020, 1, 10, 23, 59, 59, 999999)),
+        (datetime.datetime(2020, 1, 11), datetime.datetime(2020, 1, 20, 23, 59, 59, 999999)),
+        (datetime.datetime(2020, 1, 21), last),
+    ]
+    short_chunks = operations_export.split_time_range(first, last, max_chunks=3, min_chunk_seconds=20 * 86400)
+    assert short_chunks == [(first, last)]
+
+
+def stream_parallel(adapter, **kwargs):
+    return collect(lambda: operations_export.stream_parallel_csv(adapter, WALLET_ID, None, None, None, None, **{
+        'page_size': 2,
+        'workers': 4,
+        'min_chunk_seconds': 10,
+        'buffer_pages': 1,
+        'acquire_timeout': 1,
+        **kwargs,
+    }))
+
+
+def test_stream_parallel_csv__long_history__reads_chunks_in_one_snapshot_and_keeps_order():
+    adapter = FakeTransactionAdapter({
+        WALLET_ID: [make_transaction(transaction_id, transaction_id * 3) for transaction_id in range(1, 21)],
+    })
+
+    chunks = stream_parallel(adapter)
+
+    rows = list(csv.DictReader(io.StringIO(''.join(chunks))))
+    assert [row['id'] for row in rows] == [str(transaction_id) for transaction_id in range(1, 21)]
+    assert adapter.snapshots == ['00000003-0000001B-1'] * 4
+    assert adapter.max_running == 4
+
+
+def test_stream_parallel_csv__short_history__reads_in_exporting_transaction():
+    adapter = FakeTransactionAdapter({WALLET_ID: [make_transaction(1, 1), make_transaction(2, 5)]})
+
+    chunks = stream_parallel(adapter)
+
+    assert [row['id'] for row in csv.DictReader(io.StringIO(''.join(chunks)))] == ['1', '2']
+    assert adapter.snapshots == []
+
+
+def test_stream_parallel_csv__pool_exhausted__falls_back_to_one_query():
+    adapter = FakeTransactionAdapter({
+        WALLET_ID: [make_transaction(transaction_id, transaction_id * 3) for transaction_id in range(1, 21)],
+    })
+
+    # Other exports hold every connection of the pool
+    @contextlib.asynccontextmanager
+    async def use_snapshot(wallet_id, snapshot_id):
+        await asyncio.sleep(60)
+        yield
+
+    adapter.use_snapshot = use_snapshot
+
+    chunks = stream_parallel(adapter, acquire_timeout=0.01)
+
+    rows = list(csv.DictReader(io.StringIO(''.join(chunks))))
+    assert [row['id'] for row in rows] == [str(transaction_id) for transaction_id in range(1, 21)]
+    assert adapter.pages == [(WALLET_ID, 2)] * 10 + [(WALLET_ID, 0)]
+
+
+@pytest.fixture
+def small_export_pool(mocker):
+    mocker.patch('config.OPERATIONS_PARALLEL_WORKERS', 8)
+    mocker.patch('config.POSTGRES_EXPORT_POOL_MAX_SIZE', 3)
+
+
+def test_app__parallel_workers_over_export_pool__are_capped(small_export_pool, database, test_app):
+    import wallet.main
+
+    assert wallet.main.operations_parallel_workers == 2
+
+
+def test_stream_parallel_csv__chunk_fails__raises():
+    adapter = FakeTransactionAdapter({
+        WALLET_ID: [make_transaction(transaction_id, transaction_id * 3) for transaction_id in range(1, 21)],
+    })
+    adapter.get_page = async_mock(side_effect=RuntimeError('connection lost'))
+
+    with pytest.raises(RuntimeError, match='connection lost'):
+        stream_parallel(adapter)
+
+
+def test_use_snapshot__imports_snapshot_at_transaction_start():
+    database = mock.MagicMock()
+    database.transaction = mock.MagicMock(return_value=AsyncContextManagerMock())
+    database.execute = async_mock()
+    adapter = adapters.TransactionDatabaseAdapter(
+        models.TransactionDB, database, tables.transactions, tables.wallet_entries,
+    )
+
+    async def use_snapshot(snapshot_id):
+        async with adapter.use_snapshot(snapshot_id):
+            pass
+
+    asyncio.run(use_snapshot('00000003-0000001B-1'))
+    with pytest.raises(ValueError):
+        asyncio.run(use_snapshot("1'; DROP TABLE wallet; --"))
+
+    assert [call.args[0] for call in database.execute.mock.call_args_list] == [
+        'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY',
+        "SET TRANSACTION SNAPSHOT '00000003-0000001B-1'",
+    ]
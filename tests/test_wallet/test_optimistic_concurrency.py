@@ -0,0 +1,123 @@
+import decimal
+import uuid
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+import adapters
+from tests.factories import make_wallet_json
+from tests.utils import async_mock, post
+
+
+# Wallets of a transfer are locked in id order, the sender first
+SENDER_WALLET_ID, RECIPIENT_WALLET_ID = sorted(str(uuid.uuid4()) for _ in range(2))
+
+
+@pytest.fixture
+def optimistic(mocker):
+    mocker.patch('config.WALLET_CONCURRENCY', 'optimistic')
+    mocker.patch('config.WALLET_OPTIMISTIC_RETRIES', 1)
+
+
+def make_sender(user, version, concurrency=None):
+    return {
+        **make_wallet_json(wallet_id=SENDER_WALLET_ID, user_id=user.id, balance=decimal.Decimal(100)),
+        'version': version,
+        'concurrency': concurrency,
+    }
+
+
+def make_recipient(concurrency=None):
+    return {**make_wallet_json(wallet_id=RECIPIENT_WALLET_ID), 'version': 7, 'concurrency': concurrency}
+
+
+def transfer(test_app):
+    return post(test_app, f'/wallet/{SENDER_WALLET_ID}/transfer-to/{RECIPIENT_WALLET_ID}', json={'value': '10'})
+
+
+def compile_statements(call_args_list):
+    return [call.args[0].compile(dialect=postgresql.dialect()) for call in call_args_list]
+
+
+def test_transfer__unchanged_sender__debits_by_version_without_locks(optimistic, database, user, test_app):
+    database.fetch_one = async_mock(side_effect=[make_sender(user, version=3), make_recipient(), None])
+    database.fetch_val = async_mock(side_effect=[decimal.Decimal(90), decimal.Decimal(110)])
+    database.execute = async_mock(return_value=1)
+
+    response = transfer(test_app)
+
+    assert response.status_code == 200
+    assert response.json() == {'value': '10', 'balance': '90'}
+    assert not any('FOR UPDATE' in str(stmt) for stmt in compile_statements(database.fetch_one.mock.call_args_list))
+    debit_stmt = compile_statements(database.fetch_val.mock.call_args_list)[0]
+    assert 'AND wallet.version = %(version_2)s AND wallet.balance >= %(balance_2)s' in str(debit_stmt)
+    assert debit_stmt.params['version_2'] == 3
+
+
+def test_transfer__version_conflict__rereads_and_retries(optimistic, database, user, test_app):
+    conflicts = adapters.OPTIMISTIC_CONFLICTS.get()
+    database.fetch_one = async_mock(side_effect=[
+        make_sender(user, version=3), make_recipient(), None,
+        make_sender(user, version=4), make_recipient(), None,
+    ])
+    database.fetch_val = async_mock(side_effect=[None, decimal.Decimal(90), decimal.Decimal(110)])
+    database.execute = async_mock(return_value=1)
+
+    response = transfer(test_app)
+
+    assert response.status_code == 200
+    assert response.json()['balance'] == '90'
+    assert adapters.OPTIMISTIC_CONFLICTS.get() == conflicts + 1
+    debit_stmts = compile_statements(database.fetch_val.mock.call_args_list)[:2]
+    assert [stmt.params['version_2'] for stmt in debit_stmts] == [3, 4]
+
+
+def test_transfer__retries_exhausted__falls_back_to_locks(optimistic, database, user, test_app):
+    database.fetch_one = async_mock(side_effect=[
+        make_sender(user, version=3), make_recipient(), None,
+        make_sender(user, version=4), make_recipient(), None,
+        make_sender(user, version=5), make_recipient(), None,
+    ])
+    database.fetch_val = async_mock(side_effect=[None, None, decimal.Decimal(110), decimal.Decimal(90)])
+    database.execute = async_mock(return_value=1)
+
+    response = transfer(test_app)
+
+    assert response.status_code == 200
+    assert response.json()['balance'] == '90'
+    fetch_one_stmts = [str(stmt) for stmt in compile_statements(database.fetch_one.mock.call_args_list)]
+    assert ['FOR UPDATE' in stmt for stmt in fetch_one_stmts[::3]] == [False, False, True]
+
+
+def test_transfer__pessimistic_wallet__takes_locks(optimistic, database, user, test_app):
+    database.fetch_one = async_mock(side_effect=[
+        make_sender(user, version=3), make_recipient(concurrency='pessimistic'), None,
+        make_sender(user, version=3), make_recipient(), None,
+    ])
+    database.fetch_val = async_mock(side_effect=[decimal.Decimal(110), decimal.Decimal(90)])
+    database.execute = async_mock(return_value=1)
+
+    response = transfer(test_app)
+
+    assert response.status_code == 200
+    assert response.json()['balance'] == '90'
+    fetch_one_stmts = [str(stmt) for stmt in compile_statements(database.fetch_one.mock.call_args_list)]
+    assert 'FOR UPDATE' in fetch_one_stmts[3]
+    assert 'wallet.version =' not in str(compile_statements(database.fetch_val.mock.call_args_list)[1])
+
+
+def test_deposit__optimistic__updates_in_one_statement(optimistic, database, user, test_app):
+    database.fetch_one = async_mock(return_value={
+        'id': SENDER_WALLET_ID,
+        'user_id': str(user.id),
+        'balance': decimal.Decimal(110),
+    })
+    database.execute = async_mock(return_value=1)
+
+    response = post(test_app, f'/wallet/{SENDER_WALLET_ID}/deposit', json={'value': '10'})
+
+    assert response.status_code == 200
+    assert response.json() == {'value': '10', 'balance': '110'}
+    assert database.fetch_one.mock.call_count == 1
+    assert str(database.fetch_one.mock.call_args.args[0]).startswith('UPDATE wallet SET')
+    assert database.fetch_val.mock.call_count == 0
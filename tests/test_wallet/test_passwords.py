@@ -0,0 +1,55 @@
+import asyncio
+from unittest import mock
+
+import pytest
+from fastapi import HTTPException
+from fastapi.security import OAuth2PasswordRequestForm
+from fastapi_users.password import get_password_hash
+
+import models
+import tables
+from passwords import PasswordHasher
+from tests.utils import async_mock
+
+
+PASSWORD = 'guinevere'
+HASHED_PASSWORD = get_password_hash(PASSWORD)
+
+
+def make_user_database(user_dict):
+    # auth binds FastAPIUsers on import, so it must not be imported before the user fixture patches it
+    from auth import UserDatabase
+    database = mock.MagicMock()
+    database.fetch_one = async_mock(return_value=user_dict)
+    return UserDatabase(models.UserDB, database, tables.users, PasswordHasher(workers=2, max_pending=4))
+
+
+def make_credentials(password: str) -> OAuth2PasswordRequestForm:
+    return OAuth2PasswordRequestForm(username='admin@example.net', password=password, scope='')
+
+
+@pytest.mark.parametrize('password, authenticated', ((PASSWORD, True), ('lancelot', False)))
+def test_authenticate__password_checked_in_pool(password, authenticated, user):
+    user_dict = user.copy(update={'hashed_password': HASHED_PASSWORD}).dict()
+    user_db = make_user_database(user_dict)
+
+    authenticated_user = asyncio.run(user_db.authenticate(make_credentials(password)))
+
+    assert (authenticated_user is not None) is authenticated
+
+
+def test_authenticate__unknown_email__returns_none(user):
+    user_db = make_user_database(None)
+
+    assert asyncio.run(user_db.authenticate(make_credentials(PASSWORD))) is None
+
+
+def test_hash__too_many_pending__rejected():
+    hasher = PasswordHasher(workers=1, max_pending=2)
+    hasher.pending = 2
+
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(hasher.hash(PASSWORD))
+
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers['Retry-After'] == '1'
@@ -0,0 +1,293 @@
+import asyncio
+import datetime
+import decimal
+import os
+import uuid
+from unittest import mock
+
+import asyncpg
+import pytest
+
+import adapters
+import models
+import shards
+import tables
+from tests.utils import MultiValuesStrCompileDialect, async_mock, call_args_to_sql_strings
+
+
+# Comma separated DSNs of empty databases with max_prepared_transactions > 0, see docker-compose.shards.yml
+TEST_SHARD_DSNS = [dsn for dsn in os.environ.get('TEST_POSTGRES_SHARD_DSNS', '').split(',') if dsn]
+
+
+def make_database():
+    database = mock.MagicMock()
+    database.execute = async_mock(return_value=1)
+    database.fetch_all = async_mock(return_value=[])
+    database.fetch_one = async_mock(return_value=None)
+    database.fetch_val = async_mock()
+    return database
+
+
+def get_statements(database):
+    return [
+        call.args[0] if isinstance(call.args[0], str) else call.args[0].__visit_name__
+        for call in database.execute.mock.call_args_list
+    ]
+
+
+def make_wallet_ids_on_two_shards(router):
+    wallet_ids = {}
+    while len(wallet_ids) < 2:
+        wallet_id = uuid.uuid4()
+        wallet_ids.setdefault(router.get_index(wallet_id), wallet_id)
+    return wallet_ids[0], wallet_ids[1]
+
+
+# Locks wallets in memory, each lock is kept until the test releases it
+class FakeLockingWalletAdapter:
+    def __init__(self, locks, locked):
+        self.locks = locks
+        self.locked = locked
+
+    async def lock(self, wallet_id):
+        await self.locks[wallet_id].acquire()
+        self.locked.append(wallet_id)
+        await asyncio.sleep(0.01)
+        return models.WalletDB(id=wallet_id)
+
+
+def test_lock_many__opposing_cross_shard_transfers__lock_in_same_order_without_deadlock():
+    router = shards.ShardRouter([make_database(), make_database()])
+    first_wallet_id, second_wallet_id = make_wallet_ids_on_two_shards(router)
+
+    async def run():
+        locks = {first_wallet_id: asyncio.Lock(), second_wallet_id: asyncio.Lock()}
+        locked = []
+        adapter = shards.ShardedWalletDatabaseAdapter(router, [FakeLockingWalletAdapter(locks, locked)] * 2)
+
+        async def transfer(sender_wallet_id, recipient_wallet_id):
+            wallets = await adapter.lock_many([sender_wallet_id, recipient_wallet_id])
+            for lock in locks.values():
+                lock.release()
+            return [wallet.id for wallet in wallets]
+
+        results = await asyncio.wait_for(asyncio.gather(
+            transfer(second_wallet_id, first_wallet_id),
+            transfer(first_wallet_id, second_wallet_id),
+        ), timeout=1)
+        return results, locked
+
+    results, locked = asyncio.run(run())
+
+    assert results == [[second_wallet_id, first_wallet_id], [first_wallet_id, second_wallet_id]]
+    assert locked == [first_wallet_id, second_wallet_id] * 2
+
+
+def test_router__several_shards__hash_is_stable_and_spreads_wallets():
+    router = shards.ShardRouter([make_database() for _ in range(4)])
+    wallet_ids = [uuid.uuid4() for _ in range(1000)]
+
+    indexes = [router.get_index(wallet_id) for wallet_id in wallet_ids]
+
+    assert indexes == [router.get_index(str(wallet_id)) for wallet_id in wallet_ids]
+    assert all(indexes.count(index) > 150 for index in range(4))
+
+
+def test_two_phase_commit__success__prepares_logs_decision_and_commits():
+    first, second = make_database(), make_database()
+    two_phase_commit = shards.TwoPhaseCommit(first, tables.shard_transactions)
+
+    async def transfer():
+        async with two_phase_commit.transaction([first, second]):
+            pass
+
+    asyncio.run(transfer())
+
+    gid = first.execute.mock.call_args_list[1].args[0].split("'")[1]
+    assert gid.startswith(shards.TwoPhaseCommit.GID_PREFIX)
+    assert get_statements(first) == [
+        'BEGIN', f"PREPARE TRANSACTION '{gid}'", 'insert', f"COMMIT PREPARED '{gid}'", 'delete',
+    ]
+    assert get_statements(second) == ['BEGIN', f"PREPARE TRANSACTION '{gid}'", f"COMMIT PREPARED '{gid}'"]
+
+
+def test_two_phase_commit__body_fails__rolls_back_every_shard():
+    first, second = make_database(), make_database()
+    two_phase_commit = shards.TwoPhaseCommit(first, tables.shard_transactions)
+
+    async def transfer():
+        async with two_phase_commit.transaction([first, second]):
+            raise ValueError
+
+    with pytest.raises(ValueError):
+        asyncio.run(transfer())
+
+    assert get_statements(first) == ['BEGIN', 'ROLLBACK']
+    assert get_statements(second) == ['BEGIN', 'ROLLBACK']
+
+
+def test_two_phase_commit__prepare_fails__rolls_back_prepared_shards():
+    first, second = make_database(), make_database()
+    second.execute = async_mock(side_effect=[None, RuntimeError, None])
+    two_phase_commit = shards.TwoPhaseCommit(first, tables.shard_transactions)
+
+    async def transfer():
+        async with two_phase_commit.transaction([first, second]):
+            pass
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(transfer())
+
+    gid = first.execute.mock.call_args_list[1].args[0].split("'")[1]
+    assert get_statements(first) == ['BEGIN', f"PREPARE TRANSACTION '{gid}'", f"ROLLBACK PREPARED '{gid}'"]
+    assert get_statements(second)[-1] == 'ROLLBACK'
+
+
+def test_two_phase_commit__commit_fails__keeps_decision_for_recovery():
+    first, second = make_database(), make_database()
+    second.execute = async_mock(side_effect=[None, None, RuntimeError])
+    two_phase_commit = shards.TwoPhaseCommit(first, tables.shard_transactions)
+
+    async def transfer():
+        async with two_phase_commit.transaction([first, second]):
+            pass
+
+    asyncio.run(transfer())
+
+    assert get_statements(first)[-1].startswith('COMMIT PREPARED')
+
+
+def test_create_transaction__cross_shard__writes_entries_on_both_shards():
+    databases = [make_database(), make_database()]
+    router = shards.ShardRouter(databases)
+    sender_wallet_id, recipient_wallet_id = make_wallet_ids_on_two_shards(router)
+    adapter = shards.ShardedTransactionDatabaseAdapter(router, [
+        adapters.TransactionDatabaseAdapter(models.TransactionDB, database, tables.transactions, tables.wallet_entries)
+        for database in databases
+    ])
+
+    transaction_id = asyncio.run(adapter.create(models.TransactionDB(
+        sender_wallet_id=sender_wallet_id,
+        recipient_wallet_id=recipient_wallet_id,
+        value=decimal.Decimal(1),
+        timestamp=datetime.datetime(2020, 1, 1),
+    )))
+
+    assert transaction_id == 1
+    sender_stmts = call_args_to_sql_strings(databases[0].execute.mock.call_args_list, literal_binds=False)
+    assert [stmt.split(' (')[0] for stmt in sender_stmts] == ['INSERT INTO transaction', 'INSERT INTO wallet_entry']
+    sender_entry = databases[0].execute.mock.call_args_list[1].args[0].compile(dialect=MultiValuesStrCompileDialect())
+    recipient_entry = databases[1].execute.mock.call_args_list[0].args[0].compile(
+        dialect=MultiValuesStrCompileDialect(),
+    )
+    assert sender_entry.params['wallet_id_m0'] == sender_wallet_id
+    assert sender_entry.params['value_m0'] == decimal.Decimal(-1)
+    assert 'wallet_id_m1' not in sender_entry.params
+    assert recipient_entry.params['wallet_id_m0'] == recipient_wallet_id
+    assert recipient_entry.params['transaction_id_m0'] == 1
+
+
+def make_sharded_wallet_adapter(databases):
+    router = shards.ShardRouter(databases)
+    return shards.ShardedWalletDatabaseAdapter(
+        router,
+        [adapters.WalletDatabaseAdapter(models.WalletDB, database, tables.wallets) for database in databases],
+        shards.TwoPhaseCommit(databases[0], tables.shard_transactions),
+        tables.wallet_names,
+    )
+
+
+def test_create_wallet__other_shard__claims_name_in_same_two_phase_commit(mocker):
+    databases = [make_database(), make_database()]
+    adapter = make_sharded_wallet_adapter(databases)
+    _, wallet_id = make_wallet_ids_on_two_shards(adapter.router)
+    mocker.patch('ids.make_wallet_id', return_value=wallet_id)
+    databases[1].fetch_val = async_mock(return_value=wallet_id)
+
+    assert asyncio.run(adapter.create(models.WalletCreate(name='wallet'), uuid.uuid4())) == wallet_id
+
+    gid = databases[1].execute.mock.call_args_list[1].args[0].split("'")[1]
+    assert get_statements(databases[0])[:3] == ['BEGIN', 'insert', f"PREPARE TRANSACTION '{gid}'"]
+    name_query = databases[0].execute.mock.call_args_list[1].args[0].compile()
+    assert name_query.params == {'name': 'wallet', 'wallet_id': wallet_id}
+    assert call_args_to_sql_strings(databases[1].fetch_val.mock.call_args_list)[0].startswith('INSERT INTO wallet ')
+
+
+def test_create_wallet__name_taken_on_other_shard__rolls_back_and_raises(mocker):
+    databases = [make_database(), make_database()]
+    databases[0].execute = async_mock(side_effect=[None, asyncpg.UniqueViolationError(), None])
+    adapter = make_sharded_wallet_adapter(databases)
+    _, wallet_id = make_wallet_ids_on_two_shards(adapter.router)
+    mocker.patch('ids.make_wallet_id', return_value=wallet_id)
+
+    with pytest.raises(ValueError):
+        asyncio.run(adapter.create(models.WalletCreate(name='wallet'), uuid.uuid4()))
+
+    assert get_statements(databases[1]) == ['BEGIN', 'ROLLBACK']
+    assert databases[1].fetch_val.mock.call_count == 0
+
+
+def test_get_many_wallets__several_shards__merges_pages_and_totals():
+    databases = [make_database(), make_database()]
+    router = shards.ShardRouter(databases)
+    user_id = uuid.uuid4()
+    wallet_ids = sorted(uuid.uuid4() for _ in range(3))
+
+    def make_row(wallet_id, wallet_count, version_sum, total_balance):
+        return {
+            'id': wallet_id, 'name': str(wallet_id), 'balance': decimal.Decimal(1), 'wallet_count': wallet_count,
+            'version_sum': version_sum, 'total_balance': total_balance,
+        }
+
+    databases[0].fetch_all = async_mock(return_value=[
+        make_row(wallet_ids[0], 2, 3, 2),
+        make_row(wallet_ids[2], 2, 3, 2),
+    ])
+    databases[1].fetch_all = async_mock(return_value=[make_row(wallet_ids[1], 1, 5, 7)])
+    adapter = shards.ShardedWalletDatabaseAdapter(router, [
+        adapters.WalletDatabaseAdapter(models.WalletDB, database, tables.wallets) for database in databases
+    ])
+
+    wallet_list = asyncio.run(adapter.get_many(user_id, limit=2, include_balance=True))
+
+    assert [wallet.id for wallet in wallet_list.wallets] == wallet_ids[:2]
+    assert wallet_list.wallet_count == 3
+    assert wallet_list.version_sum == 8
+    assert wallet_list.total_balance == 9
+
+
+@pytest.mark.skipif(len(TEST_SHARD_DSNS) < 2, reason='TEST_POSTGRES_SHARD_DSNS is not set')
+def test_transfer__real_shards__commits_on_both():
+    import databases as databases_package
+    import sqlalchemy
+
+    for dsn in TEST_SHARD_DSNS:
+        tables.Base.metadata.create_all(sqlalchemy.create_engine(dsn))
+
+    async def transfer():
+        router = shards.ShardRouter([databases_package.Database(dsn) for dsn in TEST_SHARD_DSNS])
+        await router.connect()
+        try:
+            wallet_db_adapter = shards.ShardedWalletDatabaseAdapter(router, [
+                adapters.WalletDatabaseAdapter(models.WalletDB, database, tables.wallets)
+                for database in router.databases
+            ])
+            sender_wallet_id, recipient_wallet_id = make_wallet_ids_on_two_shards(router)
+            user_id = uuid.uuid4()
+            for wallet_id in (sender_wallet_id, recipient_wallet_id):
+                await wallet_db_adapter.get_shard(wallet_id).create(
+                    models.WalletCreate(name=str(wallet_id)), user_id, wallet_id,
+                )
+            two_phase_commit = shards.TwoPhaseCommit(router.databases[0], tables.shard_transactions)
+            async with two_phase_commit.transaction([router.databases[0], router.databases[1]]):
+                await wallet_db_adapter.decrease_balance(sender_wallet_id, decimal.Decimal(5))
+                await wallet_db_adapter.increase_balance(recipient_wallet_id, decimal.Decimal(5))
+            return (
+                (await wallet_db_adapter.get(sender_wallet_id)).balance,
+                (await wallet_db_adapter.get(recipient_wallet_id)).balance,
+                await router.databases[0].fetch_val('SELECT count(*) FROM shard_transaction'),
+            )
+        finally:
+            await router.disconnect()
+
+    assert asyncio.run(transfer()) == (decimal.Decimal(-5), decimal.Decimal(5), 0)
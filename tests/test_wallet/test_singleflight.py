@@ -0,0 +1,109 @@
+import asyncio
+import contextvars
+import uuid
+from unittest import mock
+
+import adapters
+import models
+import tables
+from singleflight import SingleFlight
+from tests.factories import make_wallet_json
+
+
+WALLET_ID = str(uuid.uuid4())
+
+
+def test_get__concurrent_identical_calls__share_one_query():
+    async def run():
+        database = mock.MagicMock()
+        release = asyncio.Event()
+        calls = []
+
+        async def fetch_one(query):
+            calls.append(query)
+            await release.wait()
+            return make_wallet_json(wallet_id=WALLET_ID)
+
+        database.fetch_one = fetch_one
+        adapter = adapters.WalletDatabaseAdapter(models.WalletDB, database, tables.wallets)
+        waiters = [asyncio.ensure_future(adapter.get(WALLET_ID)) for _ in range(10)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiters)
+        return calls, results
+
+    calls, results = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert str(results[0].id) == WALLET_ID
+
+
+def test_do__one_waiter_cancelled__others_get_result():
+    async def run():
+        single_flight = SingleFlight('test')
+        release = asyncio.Event()
+
+        async def query():
+            await release.wait()
+            return 42
+
+        cancelled = asyncio.ensure_future(single_flight.do('key', query))
+        waiting = asyncio.ensure_future(single_flight.do('key', query))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return await waiting, cancelled.cancelled(), single_flight.in_flight
+
+    result, cancelled, in_flight = asyncio.run(run())
+
+    assert result == 42
+    assert cancelled
+    assert in_flight == 0
+
+
+def test_do__all_waiters_cancelled__cancels_query():
+    async def run():
+        single_flight = SingleFlight('test')
+        started = asyncio.Event()
+        query_cancelled = asyncio.Event()
+
+        async def query():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                query_cancelled.set()
+                raise
+
+        waiters = [asyncio.ensure_future(single_flight.do('key', query)) for _ in range(3)]
+        await started.wait()
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+        return query_cancelled.is_set(), single_flight.in_flight
+
+    query_cancelled, in_flight = asyncio.run(run())
+
+    assert query_cancelled
+    assert in_flight == 0
+
+
+def test_do__first_caller_context__is_not_shared_with_query():
+    connection = contextvars.ContextVar('connection', default=None)
+
+    async def run():
+        single_flight = SingleFlight('test')
+
+        async def query():
+            return connection.get()
+
+        async def caller():
+            connection.set('caller connection')
+            return await single_flight.do('key', query)
+
+        return await caller()
+
+    assert asyncio.run(run()) is None
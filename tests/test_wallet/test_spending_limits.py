@@ -0,0 +1,104 @@
+import asyncio
+import datetime
+import decimal
+import uuid
+from unittest import mock
+
+import freezegun
+from sqlalchemy.dialects import postgresql
+
+import adapters
+import models
+import tables
+from tests.factories import make_wallet_json
+from tests.utils import async_mock, get, post, put
+
+
+# Wallets of a transfer are locked in id order, the sender first
+SENDER_WALLET_ID, RECIPIENT_WALLET_ID = sorted(str(uuid.uuid4()) for _ in range(2))
+
+
+def make_adapter(database):
+    return adapters.SpendingLimitDatabaseAdapter(
+        models.SpendingLimitDB, database, tables.wallet_spending_limits, tables.wallet_spending_buckets, 300,
+    )
+
+
+def make_spending(hourly_limit=None, daily_limit=None, hourly_spent=0, daily_spent=0):
+    return {
+        'wallet_id': SENDER_WALLET_ID,
+        'hourly_limit': hourly_limit,
+        'daily_limit': daily_limit,
+        'hourly_spent': decimal.Decimal(hourly_spent),
+        'daily_spent': decimal.Decimal(daily_spent),
+    }
+
+
+def transfer(database, user, test_app, spending):
+    database.fetch_one = async_mock(side_effect=[
+        make_wallet_json(wallet_id=SENDER_WALLET_ID, user_id=user.id, balance=decimal.Decimal(100)),
+        make_wallet_json(wallet_id=RECIPIENT_WALLET_ID),
+        spending,
+    ])
+    database.fetch_val = async_mock(return_value=decimal.Decimal(90))
+    database.execute = async_mock(return_value=1)
+    return post(test_app, f'/wallet/{SENDER_WALLET_ID}/transfer-to/{RECIPIENT_WALLET_ID}', json={'value': '10'})
+
+
+def test_transfer__daily_limit_exceeded__returns_error(database, user, test_app):
+    response = transfer(database, user, test_app, make_spending(daily_limit=decimal.Decimal(50), daily_spent=45))
+
+    assert database.execute.mock.call_count == 0
+    assert response.status_code == 400
+    assert response.json()['detail'] == [{'msg': 'Spending limit exceeded', 'window': 'daily'}]
+
+
+@freezegun.freeze_time(datetime.datetime(2020, 1, 1, 12, 7, 30))
+def test_transfer__within_limits__records_spending_in_bucket(database, user, test_app):
+    response = transfer(database, user, test_app, make_spending(hourly_limit=decimal.Decimal(10), hourly_spent=0))
+
+    assert response.status_code == 200
+    bucket_stmt = database.execute.mock.call_args_list[-2].args[0].compile(dialect=postgresql.dialect())
+    assert str(bucket_stmt).startswith('INSERT INTO wallet_spending_bucket')
+    assert bucket_stmt.params['bucket_start'] == datetime.datetime(2020, 1, 1, 12, 5)
+    assert bucket_stmt.params['slot'] == (12 * 60 + 5) // 5
+    assert bucket_stmt.params['spent'] == decimal.Decimal(10)
+
+
+def test_get_spent__windows_start_at_bucket_boundaries():
+    database = mock.MagicMock()
+    database.fetch_one = async_mock(return_value=make_spending(hourly_limit=decimal.Decimal(1)))
+
+    spending = asyncio.run(make_adapter(database).get_spent(SENDER_WALLET_ID, datetime.datetime(2020, 1, 2, 0, 3)))
+
+    params = database.fetch_one.mock.call_args.args[0].compile().params
+    assert datetime.datetime(2020, 1, 1, 23, 0) in params.values()
+    assert datetime.datetime(2020, 1, 1, 0, 0) in params.values()
+    assert spending.hourly_limit == decimal.Decimal(1)
+
+
+def test_set__no_limits__deletes_limits(database, user, test_app):
+    database.fetch_one = async_mock(return_value=make_wallet_json(wallet_id=SENDER_WALLET_ID, user_id=user.id))
+
+    response = put(test_app, f'/wallet/{SENDER_WALLET_ID}/spending-limits', json={'hourly': None, 'daily': None})
+
+    assert response.status_code == 200
+    assert str(database.execute.mock.call_args.args[0]).startswith('DELETE FROM wallet_spending_limit')
+
+
+def test_set__negative_limit__returns_error(database, user, test_app):
+    response = put(test_app, f'/wallet/{SENDER_WALLET_ID}/spending-limits', json={'daily': '-1'})
+
+    assert response.status_code == 422
+
+
+def test_get__no_limits__returns_empty_state(database, user, test_app):
+    database.fetch_one = async_mock(side_effect=[
+        make_wallet_json(wallet_id=SENDER_WALLET_ID, user_id=user.id),
+        None,
+    ])
+
+    response = get(test_app, f'/wallet/{SENDER_WALLET_ID}/spending-limits')
+
+    assert response.status_code == 200
+    assert response.json() == {'hourly': None, 'daily': None, 'hourly_spent': '0', 'daily_spent': '0'}
@@ -0,0 +1,83 @@
+import decimal
+import uuid
+
+import pytest
+
+from tests.factories import make_wallet_json
+from tests.utils import async_mock, post
+from tracing import parse_traceparent
+
+
+WALLET_ID = str(uuid.uuid4())
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+
+
+@pytest.fixture
+def file_tracing(mocker, tmp_path):
+    mocker.patch('config.TRACING_EXPORTER', 'file')
+    mocker.patch('config.TRACING_FILE', str(tmp_path / 'traces.jsonl'))
+    mocker.patch('config.TRACING_SAMPLE_RATIO', 0.0)
+
+
+@pytest.mark.parametrize(
+    'traceparent, expected',
+    (
+            (f'00-{TRACE_ID}-{PARENT_ID}-01', (TRACE_ID, PARENT_ID, True)),
+            (f'00-{TRACE_ID.upper()}-{PARENT_ID}-00', (TRACE_ID, PARENT_ID, False)),
+            (f'00-{"0" * 32}-{PARENT_ID}-01', None),
+            (f'ff-{TRACE_ID}-{PARENT_ID}-01', None),
+            (f'00-{TRACE_ID}-xyz-01', None),
+            (None, None),
+    )
+)
+def test_parse_traceparent(traceparent, expected):
+    assert parse_traceparent(traceparent) == expected
+
+
+def test_deposit__sampled_parent__exports_request_and_db_spans(file_tracing, database, user, test_app):
+    import wallet.main
+    database.fetch_one = async_mock(return_value=make_wallet_json(wallet_id=WALLET_ID, user_id=user.id))
+    database.fetch_val = async_mock(return_value=decimal.Decimal(1))
+    database.execute = async_mock(return_value=1)
+
+    response = post(
+        test_app,
+        f'/wallet/{WALLET_ID}/deposit',
+        json={'value': '1'},
+        headers={'traceparent': f'00-{TRACE_ID}-{PARENT_ID}-01'},
+    )
+
+    spans = {span.name: span for span in wallet.main.tracer.exporter._spans}
+    request_span = spans[f'POST /wallet/{WALLET_ID}/deposit']
+    assert response.status_code == 200
+    assert response.headers['traceparent'] == request_span.traceparent
+    assert request_span.trace_id == TRACE_ID
+    assert request_span.parent_id == PARENT_ID
+    assert request_span.attributes['http.status_code'] == 200
+    assert set(spans) == {
+        request_span.name,
+        'db.pool.acquire',
+        'db.transaction',
+        'WalletDatabaseAdapter.lock',
+        'WalletDatabaseAdapter.increase_balance',
+        'TransactionDatabaseAdapter.create',
+        'OutboxDatabaseAdapter.add',
+        'db.commit',
+    }
+    assert spans['db.pool.acquire'].parent_id == request_span.span_id
+    assert spans['WalletDatabaseAdapter.lock'].parent_id == spans['db.transaction'].span_id
+    assert spans['db.commit'].parent_id == spans['db.transaction'].span_id
+
+
+def test_deposit__not_sampled__exports_nothing(file_tracing, database, user, test_app):
+    import wallet.main
+    database.fetch_one = async_mock(return_value=make_wallet_json(wallet_id=WALLET_ID, user_id=user.id))
+    database.fetch_val = async_mock(return_value=decimal.Decimal(1))
+    database.execute = async_mock(return_value=1)
+
+    response = post(test_app, f'/wallet/{WALLET_ID}/deposit', json={'value': '1'})
+
+    assert response.status_code == 200
+    assert 'traceparent' not in response.headers
+    assert wallet.main.tracer.exporter._spans == []
@@ -0,0 +1,103 @@
+import asyncio
+import csv
+import datetime
+import decimal
+import uuid
+from unittest import mock
+
+import pytest
+
+import adapters
+import archive
+import models
+import tables
+from tests.factories import make_wallet_json
+from tests.utils import async_mock, call_args_to_sql_strings, compile_sql_statement, get
+
+
+WALLET_ID = str(uuid.uuid4())
+COUNTERPARTY_WALLET_ID = uuid.uuid4()
+
+
+def make_entry(second: int, transaction_id: int, value: str, counterparty_wallet_id=None):
+    return {
+        'wallet_id': WALLET_ID,
+        'timestamp': datetime.datetime(2020, 1, 1, 0, 0, second),
+        'transaction_id': transaction_id,
+        'counterparty_wallet_id': counterparty_wallet_id,
+        'value': decimal.Decimal(value),
+    }
+
+
+ARCHIVED_ENTRIES = [make_entry(1, 1, '5'), make_entry(2, 2, '-1.5', COUNTERPARTY_WALLET_ID)]
+ARCHIVE_BATCH = {
+    'wallet_id': WALLET_ID,
+    'from_timestamp': ARCHIVED_ENTRIES[0]['timestamp'],
+    'from_transaction_id': 1,
+    'to_timestamp': ARCHIVED_ENTRIES[-1]['timestamp'],
+    'entry_count': 2,
+    'data': archive.encode_entries(ARCHIVED_ENTRIES),
+}
+
+
+@pytest.fixture
+def archive_enabled(mocker):
+    mocker.patch('config.TRANSACTION_ARCHIVE_ENABLED', True)
+
+
+def test_encode_entries__round_trip():
+    assert archive.decode_entries(WALLET_ID, archive.encode_entries(ARCHIVED_ENTRIES)) == ARCHIVED_ENTRIES
+
+
+def test_rescale_entries__to_minor_and_back__converts_values():
+    data = archive.encode_entries(ARCHIVED_ENTRIES)
+
+    minor_entries = archive.decode_entries(WALLET_ID, archive.rescale_entries(data, models.AMOUNT_DECIMAL_PLACES))
+    numeric_data = archive.rescale_entries(archive.encode_entries(minor_entries), -models.AMOUNT_DECIMAL_PLACES)
+
+    assert [entry['value'] for entry in minor_entries] == [
+        entry['value'].scaleb(models.AMOUNT_DECIMAL_PLACES) for entry in ARCHIVED_ENTRIES
+    ]
+    assert all(entry['value'] == entry['value'].to_integral_value() for entry in minor_entries)
+    assert archive.decode_entries(WALLET_ID, numeric_data) == ARCHIVED_ENTRIES
+
+
+def test_rescale_entries__too_many_decimal_places__raises():
+    data = archive.encode_entries([{**ARCHIVED_ENTRIES[0], 'value': decimal.Decimal('0.000000001')}])
+
+    with pytest.raises(ValueError):
+        archive.rescale_entries(data, models.AMOUNT_DECIMAL_PLACES)
+
+
+def test_get__archive_enabled__merges_archived_and_hot_entries(archive_enabled, database, user, test_app):
+    database.fetch_one = async_mock(return_value=make_wallet_json(wallet_id=WALLET_ID, user_id=user.id))
+    # The second archived entry was moved while the hot read was running, so it is seen twice
+    database.fetch_all = async_mock(side_effect=[[ARCHIVED_ENTRIES[1], make_entry(3, 3, '2')], [ARCHIVE_BATCH]])
+
+    response = get(test_app, f'/wallet/{WALLET_ID}/operations?from_timestamp=2020-01-01%2000%3A00%3A00')
+
+    archive_stmt = compile_sql_statement(
+        tables.wallet_entry_archives.select().where(
+            (tables.wallet_entry_archives.c.wallet_id == WALLET_ID)
+            & (tables.wallet_entry_archives.c.to_timestamp >= datetime.datetime(2020, 1, 1))
+        ).order_by(tables.wallet_entry_archives.c.from_timestamp, tables.wallet_entry_archives.c.from_transaction_id)
+    )
+    assert call_args_to_sql_strings(database.fetch_all.mock.call_args_list)[1] == archive_stmt
+    assert response.status_code == 200
+    lines = list(csv.reader(response.content.decode().rstrip('\r\n').split('\r\n')))
+    assert [line[0] for line in lines[1:]] == ['1', '2', '3']
+
+
+def test_get_page__archive_exhausted__continues_with_hot_entries():
+    database = mock.MagicMock()
+    database.fetch_all = async_mock(side_effect=[[ARCHIVE_BATCH], [make_entry(3, 3, '2')]])
+    adapter = adapters.TransactionDatabaseAdapter(
+        models.TransactionDB, database, tables.transactions, tables.wallet_entries, tables.wallet_entry_archives,
+    )
+
+    transactions = asyncio.run(adapter.get_page(WALLET_ID, after=(ARCHIVED_ENTRIES[0]['timestamp'], 1), limit=10))
+
+    assert [transaction.id for transaction in transactions] == [2, 3]
+    hot_stmt = database.fetch_all.mock.call_args_list[1].args[0]
+    assert hot_stmt.compile().params['param_2'] == 2
+    assert hot_stmt.compile().params['param_3'] == 9
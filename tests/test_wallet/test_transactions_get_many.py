@@ -1,19 +1,33 @@
+import asyncio
 import csv
 import datetime
 import decimal
+import json
+import os
 import uuid
+from unittest import mock
 
 import pytest
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, func
+from sqlalchemy.dialects import postgresql
 
+import adapters
+import enums
+import models
 import tables
-from models import TransactionDB
+from services import make_etag, make_filename
 from tests.factories import make_wallet_json
 from tests.utils import async_mock, call_args_to_sql_strings, compile_sql_statement, get
 
 
 WALLET_ID = str(uuid.uuid4())
 COUNTERPARTY_WALLET_ID = str(uuid.uuid4())
+# Empty database the EXPLAIN test may fill with synthetic wallet entries
+TEST_DSN = os.environ.get('TEST_POSTGRES_DSN')
+
+
+def make_synthetic_wallet_id(number):
+    return uuid.UUID(f'00000000-0000-4000-8000-{number:012d}')
 
 
 @pytest.mark.parametrize(
@@ -22,90 +36,99 @@ COUNTERPARTY_WALLET_ID = str(uuid.uuid4())
             (
                     'from_timestamp=2020-01-01%2000%3A00%3A01&to_timestamp=2020-01-01%2000%3A00%3A10',
                     and_(
-                        or_(
-                            tables.transactions.c.recipient_wallet_id == WALLET_ID,
-                            tables.transactions.c.sender_wallet_id == WALLET_ID,
-                        ),
-                        tables.transactions.c.timestamp >= datetime.datetime(2020, 1, 1, 0, 0, 1),
-                        tables.transactions.c.timestamp <= datetime.datetime(2020, 1, 1, 0, 0, 10),
+                        tables.wallet_entries.c.wallet_id == WALLET_ID,
+                        tables.wallet_entries.c.timestamp >= datetime.datetime(2020, 1, 1, 0, 0, 1),
+                        tables.wallet_entries.c.timestamp <= datetime.datetime(2020, 1, 1, 0, 0, 10),
                     ),
             ),
             (
                     'from_timestamp=2020-01-01%2000%3A00%3A01&to_timestamp=2020-01-01%2000%3A00%3A10&side=deposit',
                     and_(
-                        tables.transactions.c.recipient_wallet_id == WALLET_ID,
-                        tables.transactions.c.timestamp >= datetime.datetime(2020, 1, 1, 0, 0, 1),
-                        tables.transactions.c.timestamp <= datetime.datetime(2020, 1, 1, 0, 0, 10),
+                        tables.wallet_entries.c.wallet_id == WALLET_ID,
+                        tables.wallet_entries.c.value > 0,
+                        tables.wallet_entries.c.timestamp >= datetime.datetime(2020, 1, 1, 0, 0, 1),
+                        tables.wallet_entries.c.timestamp <= datetime.datetime(2020, 1, 1, 0, 0, 10),
                     )
             ),
             (
                     'from_timestamp=2020-01-01%2000%3A00%3A01&to_timestamp=2020-01-01%2000%3A00%3A10&side=withdraw',
                     and_(
-                        tables.transactions.c.sender_wallet_id == WALLET_ID,
-                        tables.transactions.c.timestamp >= datetime.datetime(2020, 1, 1, 0, 0, 1),
-                        tables.transactions.c.timestamp <= datetime.datetime(2020, 1, 1, 0, 0, 10),
+                        tables.wallet_entries.c.wallet_id == WALLET_ID,
+                        tables.wallet_entries.c.value < 0,
+                        tables.wallet_entries.c.timestamp >= datetime.datetime(2020, 1, 1, 0, 0, 1),
+                        tables.wallet_entries.c.timestamp <= datetime.datetime(2020, 1, 1, 0, 0, 10),
                     )
             ),
             (
                     'from_timestamp=2020-01-01%2000%3A00%3A01&side=withdraw',
                     and_(
-                        tables.transactions.c.sender_wallet_id == WALLET_ID,
-                        tables.transactions.c.timestamp >= datetime.datetime(2020, 1, 1, 0, 0, 1),
+                        tables.wallet_entries.c.wallet_id == WALLET_ID,
+                        tables.wallet_entries.c.value < 0,
+                        tables.wallet_entries.c.timestamp >= datetime.datetime(2020, 1, 1, 0, 0, 1),
                     )
             ),
             (
                     'to_timestamp=2020-01-01%2000%3A00%3A01',
                     and_(
-                        or_(
-                            tables.transactions.c.recipient_wallet_id == WALLET_ID,
-                            tables.transactions.c.sender_wallet_id == WALLET_ID,
-                        ),
-                        tables.transactions.c.timestamp <= datetime.datetime(2020, 1, 1, 0, 0, 1),
+                        tables.wallet_entries.c.wallet_id == WALLET_ID,
+                        tables.wallet_entries.c.timestamp <= datetime.datetime(2020, 1, 1, 0, 0, 1),
+                    )
+            ),
+            (
+                    f'counterparty_wallet_id={COUNTERPARTY_WALLET_ID}&min_value=1.5&max_value=100',
+                    and_(
+                        tables.wallet_entries.c.wallet_id == WALLET_ID,
+                        tables.wallet_entries.c.counterparty_wallet_id == uuid.UUID(COUNTERPARTY_WALLET_ID),
+                        func.abs(tables.wallet_entries.c.value) >= decimal.Decimal('1.5'),
+                        func.abs(tables.wallet_entries.c.value) <= decimal.Decimal(100),
+                    )
+            ),
+            (
+                    'side=withdraw&from_transaction_id=2&to_transaction_id=3',
+                    and_(
+                        tables.wallet_entries.c.wallet_id == WALLET_ID,
+                        tables.wallet_entries.c.value < 0,
+                        tables.wallet_entries.c.transaction_id >= 2,
+                        tables.wallet_entries.c.transaction_id <= 3,
                     )
             ),
     )
 )
 def test_get__wallet_exists_and_owned_args__returns_wallet_list(args, condition, database, user, test_app):
     wallet_data = make_wallet_json(wallet_id=WALLET_ID, user_id=user.id)
-    transactions = [
-        TransactionDB(
-            id=1,
-            sender_wallet_id=None,
-            recipient_wallet_id=WALLET_ID,
-            value=decimal.Decimal(1),
-            timestamp=datetime.datetime(2020, 1, 1, 0, 0, 1),
-        ).dict(),
-        TransactionDB(
-            id=2,
-            sender_wallet_id=COUNTERPARTY_WALLET_ID,
-            recipient_wallet_id=WALLET_ID,
-            value=decimal.Decimal(2),
-            timestamp=datetime.datetime(2020, 1, 1, 0, 0, 2),
-        ).dict(),
-        TransactionDB(
-            id=3,
-            sender_wallet_id=WALLET_ID,
-            recipient_wallet_id=COUNTERPARTY_WALLET_ID,
-            value=decimal.Decimal(1),
-            timestamp=datetime.datetime(2020, 1, 1, 0, 0, 3),
-        ).dict(),
+    entries = [
+        {
+            'wallet_id': WALLET_ID,
+            'timestamp': datetime.datetime(2020, 1, 1, 0, 0, 1),
+            'transaction_id': 1,
+            'counterparty_wallet_id': None,
+            'value': decimal.Decimal(1),
+        },
+        {
+            'wallet_id': WALLET_ID,
+            'timestamp': datetime.datetime(2020, 1, 1, 0, 0, 2),
+            'transaction_id': 2,
+            'counterparty_wallet_id': COUNTERPARTY_WALLET_ID,
+            'value': decimal.Decimal(2),
+        },
+        {
+            'wallet_id': WALLET_ID,
+            'timestamp': datetime.datetime(2020, 1, 1, 0, 0, 3),
+            'transaction_id': 3,
+            'counterparty_wallet_id': COUNTERPARTY_WALLET_ID,
+            'value': decimal.Decimal(-1),
+        },
     ]
 
     database.fetch_one = async_mock(return_value=wallet_data)
-    database.fetch_all = async_mock(return_value=transactions)
+    database.fetch_all = async_mock(return_value=entries)
 
     response = get(test_app, f'/wallet/{WALLET_ID}/operations?{args}')
 
     select_stmt = compile_sql_statement(
-        tables.transactions.select(
+        tables.wallet_entries.select(
             condition
-        ).with_only_columns([
-            tables.transactions.c.id,
-            tables.transactions.c.sender_wallet_id,
-            tables.transactions.c.recipient_wallet_id,
-            tables.transactions.c.value,
-            tables.transactions.c.timestamp,
-        ]).order_by(tables.transactions.c.timestamp)
+        ).order_by(tables.wallet_entries.c.timestamp, tables.wallet_entries.c.transaction_id)
     )
 
     assert call_args_to_sql_strings(database.fetch_all.mock.call_args_list)[0] == select_stmt
@@ -144,3 +167,173 @@ def test_get__wallet_does_not_exist__returns_error(database, user, test_app):
     assert database.fetch_all.mock.call_count == 0
     assert response.status_code == 404
     assert response.json()['detail'][0]['entity'] == 'wallet'
+
+
+def test_get__etag_matches__returns_not_modified(database, user, test_app):
+    wallet_data = make_wallet_json(wallet_id=WALLET_ID, user_id=user.id)
+    wallet_data['version'] = 5
+    database.fetch_one = async_mock(return_value=wallet_data)
+    etag = make_etag('operations', WALLET_ID, 5, None, None, enums.TransferSide.deposit)
+
+    response = get(test_app, f'/wallet/{WALLET_ID}/operations?side=deposit', headers={'If-None-Match': etag})
+
+    assert database.fetch_all.mock.call_count == 0
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+
+def test_get__etag_outdated__returns_operations(database, user, test_app):
+    wallet_data = make_wallet_json(wallet_id=WALLET_ID, user_id=user.id)
+    wallet_data['version'] = 6
+    database.fetch_one = async_mock(return_value=wallet_data)
+    database.fetch_all = async_mock(return_value=[])
+    etag = make_etag('operations', WALLET_ID, 5, None, None, None)
+
+    response = get(test_app, f'/wallet/{WALLET_ID}/operations', headers={'If-None-Match': etag})
+
+    assert database.fetch_all.mock.call_count == 1
+    assert response.status_code == 200
+    assert response.headers['ETag'] == make_etag('operations', WALLET_ID, 6, None, None, None)
+
+
+def test_get__closed_past_range__served_from_cache(database, user, test_app, export_cache_dir):
+    wallet_data = make_wallet_json(wallet_id=WALLET_ID, user_id=user.id)
+    entries = [
+        {
+            'wallet_id': WALLET_ID,
+            'timestamp': datetime.datetime(2020, 1, 1, 0, 0, 1),
+            'transaction_id': 1,
+            'counterparty_wallet_id': None,
+            'value': decimal.Decimal(1),
+        },
+    ]
+    database.fetch_one = async_mock(return_value=wallet_data)
+    database.fetch_all = async_mock(return_value=entries)
+    url = f'/wallet/{WALLET_ID}/operations?to_timestamp=2020-01-02%2000%3A00%3A00'
+
+    first_response = get(test_app, url)
+    second_response = get(test_app, url)
+
+    assert database.fetch_all.mock.call_count == 1
+    assert len(os.listdir(export_cache_dir)) == 1
+    assert first_response.status_code == second_response.status_code == 200
+    assert first_response.content == second_response.content
+    assert first_response.headers['Content-Type'] == second_response.headers['Content-Type']
+    assert first_response.headers['ETag'] == second_response.headers['ETag']
+    assert first_response.headers['Content-Disposition'] == second_response.headers['Content-Disposition']
+
+
+def test_get__open_range__bypasses_cache(database, user, test_app, export_cache_dir):
+    wallet_data = make_wallet_json(wallet_id=WALLET_ID, user_id=user.id)
+    database.fetch_one = async_mock(return_value=wallet_data)
+    database.fetch_all = async_mock(return_value=[])
+    url = f'/wallet/{WALLET_ID}/operations?from_timestamp=2020-01-02%2000%3A00%3A00'
+
+    get(test_app, url)
+    get(test_app, url)
+
+    assert database.fetch_all.mock.call_count == 2
+    assert not os.path.exists(export_cache_dir)
+
+
+def test_make_filename__operation_filter__is_part_of_name():
+    operation_filter = models.OperationFilter(counterparty_wallet_id=COUNTERPARTY_WALLET_ID, min_value=20)
+
+    filename = make_filename(WALLET_ID, None, None, enums.TransferSide.withdraw, operation_filter=operation_filter)
+
+    assert filename == f'export-{WALLET_ID}-withdraw-counterparty_wallet_id{COUNTERPARTY_WALLET_ID}-min_value20.csv'
+    assert make_filename(WALLET_ID, None, None, enums.TransferSide.withdraw) == f'export-{WALLET_ID}-withdraw.csv'
+
+
+def test_get__filter_with_archive__filters_archived_entries(mocker, database):
+    mocker.patch('archive.decode_entries', return_value=[
+        {
+            'wallet_id': WALLET_ID,
+            'timestamp': datetime.datetime(2019, 1, 1, 0, 0, transaction_id),
+            'transaction_id': transaction_id,
+            'counterparty_wallet_id': uuid.UUID(COUNTERPARTY_WALLET_ID) if transaction_id % 2 else None,
+            'value': decimal.Decimal(transaction_id * 10),
+        }
+        for transaction_id in range(1, 6)
+    ])
+    database.fetch_all = async_mock(side_effect=[[], [{'data': b''}]])
+    adapter = adapters.TransactionDatabaseAdapter(
+        models.TransactionDB, database, tables.transactions, tables.wallet_entries, tables.wallet_entry_archives,
+    )
+    operation_filter = models.OperationFilter(counterparty_wallet_id=COUNTERPARTY_WALLET_ID, min_value=20)
+
+    transactions = asyncio.run(adapter.get_many(WALLET_ID, operation_filter=operation_filter))
+
+    assert [transaction.id for transaction in transactions] == [3, 5]
+
+
+# 2000 wallets of 100 entries. Wallet 0 has every counterparty once, values spread over -5000..4999
+# and transaction ids 1..100, so each filter below matches a few of its entries.
+@pytest.fixture(scope='module')
+def explain():
+    import psycopg2.extras
+    import sqlalchemy
+
+    engine = sqlalchemy.create_engine(TEST_DSN)
+    tables.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for statement in tables.EXTRA_DDL:
+            connection.execute(statement)
+        connection.execute('TRUNCATE wallet_entry')
+        connection.execute('''
+            INSERT INTO wallet_entry (wallet_id, timestamp, transaction_id, counterparty_wallet_id, value)
+            SELECT ('00000000-0000-4000-8000-' || lpad(w::text, 12, '0'))::uuid,
+                   timestamp '2020-01-01' + n * interval '1 minute', w * 1000 + n,
+                   CASE WHEN n % 10 = 0 THEN NULL
+                   ELSE ('00000000-0000-4000-8000-' || lpad(((w + n) % 2000)::text, 12, '0'))::uuid END,
+                   n * 7919 % 10000 - 5000
+            FROM generate_series(0, 1999) w, generate_series(1, 100) n
+        ''')
+        connection.execute('ANALYZE wallet_entry')
+    psycopg2.extras.register_uuid()
+    raw_connection = engine.raw_connection()
+
+    def explain_query(query):
+        compiled = query.compile(dialect=postgresql.psycopg2.dialect())
+        with raw_connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params)
+            return cursor.fetchone()[0][0]['Plan']
+
+    yield explain_query
+    raw_connection.close()
+    with engine.begin() as connection:
+        connection.execute('TRUNCATE wallet_entry')
+
+
+def walk_plan(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from walk_plan(child)
+
+
+@pytest.mark.skipif(not TEST_DSN, reason='TEST_POSTGRES_DSN is not set')
+@pytest.mark.parametrize(
+    'operation_filter, index_name',
+    (
+            (
+                    models.OperationFilter(counterparty_wallet_id=make_synthetic_wallet_id(7)),
+                    'wallet_entry_counterparty_idx',
+            ),
+            (models.OperationFilter(min_value=4990), 'wallet_entry_abs_value_idx'),
+            (models.OperationFilter(min_value=100, max_value=110), 'wallet_entry_abs_value_idx'),
+            (models.OperationFilter(from_transaction_id=40, to_transaction_id=45), 'wallet_entry_transaction_id_idx'),
+    ),
+)
+def test_get__filters__scan_their_indexes(operation_filter, index_name, explain):
+    database = mock.MagicMock()
+    database.fetch_all = async_mock(return_value=[])
+    adapter = adapters.TransactionDatabaseAdapter(
+        models.TransactionDB, database, tables.transactions, tables.wallet_entries,
+    )
+
+    asyncio.run(adapter.get_many(make_synthetic_wallet_id(0), operation_filter=operation_filter))
+
+    plan = explain(database.fetch_all.mock.call_args.args[0])
+    nodes = list(walk_plan(plan))
+    assert not any(node['Node Type'] == 'Seq Scan' for node in nodes), json.dumps(plan)
+    assert index_name in [node.get('Index Name') for node in nodes], json.dumps(plan)
@@ -0,0 +1,146 @@
+import asyncio
+import datetime
+import decimal
+import uuid
+from unittest import mock
+
+from sqlalchemy.dialects import postgresql
+
+import adapters
+import archive
+import checkpoints
+import models
+import tables
+from tests.utils import async_mock, get, post
+
+
+WALLET_ID = str(uuid.uuid4())
+OTHER_WALLET_ID = str(uuid.uuid4())
+
+
+def make_adapter(database, archived=False):
+    return adapters.BalanceCheckpointDatabaseAdapter(
+        models.WalletBalanceDB,
+        database,
+        tables.wallet_balance_checkpoints,
+        tables.wallets,
+        tables.wallet_entries,
+        tables.wallet_entry_archives if archived else None,
+        tables.wallet_archive_summaries if archived else None,
+    )
+
+
+def test_get__owned__returns_balance_at_timestamp(database, user, test_app):
+    database.fetch_all = async_mock(return_value=[
+        {'id': WALLET_ID, 'user_id': user.id, 'balance': decimal.Decimal('12.5')},
+    ])
+
+    response = get(test_app, f'/wallet/{WALLET_ID}/balance?timestamp=2020-01-01T00:00:00')
+
+    query_params = database.fetch_all.mock.call_args.args[0].compile().params
+    assert datetime.datetime(2020, 1, 1) in query_params.values()
+    assert response.status_code == 200
+    assert response.json() == {'wallet_id': WALLET_ID, 'timestamp': '2020-01-01T00:00:00', 'balance': '12.5'}
+
+
+def test_get__does_not_exist__returns_error(database, user, test_app):
+    database.fetch_all = async_mock(return_value=[])
+
+    response = get(test_app, f'/wallet/{WALLET_ID}/balance?timestamp=2020-01-01T00:00:00')
+
+    assert response.status_code == 404
+    assert response.json()['detail'][0]['entity'] == 'wallet'
+
+
+def test_get_many__one_not_owned__returns_error(database, user, test_app):
+    database.fetch_all = async_mock(return_value=[
+        {'id': WALLET_ID, 'user_id': user.id, 'balance': decimal.Decimal(1)},
+        {'id': OTHER_WALLET_ID, 'user_id': str(uuid.uuid4()), 'balance': decimal.Decimal(2)},
+    ])
+
+    response = post(test_app, '/wallet/balance', json={
+        'wallet_ids': [WALLET_ID, OTHER_WALLET_ID],
+        'timestamp': '2020-01-01T00:00:00',
+    })
+
+    assert response.status_code == 403
+
+
+def test_get_many__owned__returns_balances_in_requested_order(database, user, test_app):
+    database.fetch_all = async_mock(return_value=[
+        {'id': WALLET_ID, 'user_id': user.id, 'balance': decimal.Decimal(1)},
+        {'id': OTHER_WALLET_ID, 'user_id': user.id, 'balance': decimal.Decimal(2)},
+    ])
+
+    response = post(test_app, '/wallet/balance', json={
+        'wallet_ids': [OTHER_WALLET_ID, WALLET_ID],
+        'timestamp': '2020-01-01T00:00:00',
+    })
+
+    assert database.fetch_all.mock.call_count == 1
+    assert response.status_code == 200
+    assert [balance['balance'] for balance in response.json()['balances']] == ['2', '1']
+
+
+def test_get_many__too_many_wallets__returns_error(database, user, test_app, mocker):
+    mocker.patch('config.BALANCE_QUERY_MAX_WALLETS', 1)
+
+    response = post(test_app, '/wallet/balance', json={
+        'wallet_ids': [WALLET_ID, OTHER_WALLET_ID],
+        'timestamp': '2020-01-01T00:00:00',
+    })
+
+    assert response.status_code == 422
+
+
+def test_get_many__before_archive_cutoff__replays_archive():
+    entries = [
+        {'timestamp': datetime.datetime(2019, 1, 1), 'transaction_id': 1, 'counterparty_wallet_id': None, 'value': 5},
+        {'timestamp': datetime.datetime(2019, 6, 1), 'transaction_id': 2, 'counterparty_wallet_id': None, 'value': 3},
+    ]
+    database = mock.MagicMock()
+    database.fetch_all = async_mock(side_effect=[
+        [{'id': WALLET_ID, 'user_id': None, 'archived_until': datetime.datetime(2020, 1, 1), 'balance': 8}],
+        [{'data': archive.encode_entries(entries)}],
+    ])
+
+    balances = asyncio.run(make_adapter(database, archived=True).get_many([WALLET_ID], datetime.datetime(2019, 3, 1)))
+
+    assert balances[0].balance == decimal.Decimal(5)
+
+
+def test_checkpointer__lock_taken__skips_pass():
+    database = mock.MagicMock()
+    database.fetch_val = async_mock(return_value=False)
+    database.fetch_all = async_mock()
+    checkpointer = checkpoints.BalanceCheckpointer(
+        make_adapter(database), interval=1, batch_size=2, min_entries=10, settle_seconds=60,
+    )
+
+    assert asyncio.run(checkpointer.run()) is None
+    assert database.fetch_all.mock.call_count == 0
+
+
+def test_checkpointer__lock_acquired__walks_wallets_in_batches():
+    wallet_ids = [uuid.uuid4() for _ in range(3)]
+    database = mock.MagicMock()
+    database.fetch_val = async_mock(return_value=True)
+    database.fetch_all = async_mock(side_effect=[
+        [{'id': wallet_id} for wallet_id in wallet_ids[:2]],
+        [{'wallet_id': wallet_ids[1]}],
+        [{'id': wallet_ids[2]}],
+        [],
+        [],
+    ])
+    checkpointer = checkpoints.BalanceCheckpointer(
+        make_adapter(database), interval=1, batch_size=2, min_entries=10, settle_seconds=60,
+    )
+
+    assert asyncio.run(checkpointer.run()) == 1
+    insert_stmt = database.fetch_all.mock.call_args_list[1].args[0].compile(dialect=postgresql.dialect())
+    assert str(insert_stmt).startswith('INSERT INTO wallet_balance_checkpoint')
+    assert insert_stmt.params['entry_count_1'] == 10
+    next_batch_params = database.fetch_all.mock.call_args_list[2].args[0].compile().params
+    assert next_batch_params['id_1'] == wallet_ids[1]
+    # Lock and unlock
+    assert database.fetch_val.mock.call_count == 2
@@ -1,7 +1,9 @@
+import time
 import uuid
 
 import asyncpg
 
+import models
 from tests.utils import async_mock
 
 
@@ -32,3 +34,17 @@ def test_create__unique_violation__returns_error(database, user, test_app):
     assert response.json() == {
         'detail': 'Wallet with this name already exists'
     }
+
+
+def test_create__time_ordered_ids__inserts_sortable_uuid4(mocker, database, user, test_app):
+    mocker.patch('config.WALLET_ID_STRATEGY', 'time_ordered')
+    database.fetch_val = async_mock(return_value=str(uuid.uuid4()))
+
+    test_app.post('/wallet?args=a&kwargs=b', json={'name': 'first'})
+    time.sleep(0.002)
+    test_app.post('/wallet?args=a&kwargs=b', json={'name': 'second'})
+
+    first_id, second_id = (call.args[0].compile().params['id'] for call in database.fetch_val.mock.call_args_list)
+    assert first_id.version == second_id.version == 4
+    assert models.WalletId(id=str(first_id)).id == first_id
+    assert first_id < second_id
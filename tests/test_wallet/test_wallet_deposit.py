@@ -4,13 +4,16 @@ import uuid
 
 import freezegun
 import pytest
+from sqlalchemy import TIMESTAMP, Text, literal, select
 
+import models
 import tables
 from tests.factories import make_wallet_json
 from tests.utils import async_mock, call_args_to_sql_strings, compile_sql_statement, post
 
 
 WALLET_ID = str(uuid.uuid4())
+TRANSACTION_ID = 1
 DEPOSIT_VALUE = decimal.Decimal('10.0001')
 
 SELECT_FOR_UPDATE_STMT = compile_sql_statement(
@@ -20,13 +23,15 @@ SELECT_FOR_UPDATE_STMT = compile_sql_statement(
         tables.wallets.c.id,
         tables.wallets.c.user_id,
         tables.wallets.c.balance,
+        tables.wallets.c.held,
     ]).with_for_update()
 )
 UPDATE_BALANCE_STMT = compile_sql_statement(
     tables.wallets.update(
         tables.wallets.c.id == WALLET_ID
     ).values(
-        balance=tables.wallets.c.balance + DEPOSIT_VALUE
+        balance=tables.wallets.c.balance + DEPOSIT_VALUE,
+        version=tables.wallets.c.version + 1,
     ).returning(tables.wallets.c.balance),
     literal_binds=False
 )
@@ -39,7 +44,39 @@ def make_insert_transaction_stmt():
             'recipient_wallet_id': WALLET_ID,
             'value': DEPOSIT_VALUE,
             'timestamp': datetime.datetime.utcnow()
-        }),
+        }).returning(tables.transactions.c.id),
+        literal_binds=False
+    )
+
+
+def make_insert_entries_stmt():
+    return compile_sql_statement(
+        tables.wallet_entries.insert().values([{
+            'wallet_id': WALLET_ID,
+            'timestamp': datetime.datetime.utcnow(),
+            'transaction_id': TRANSACTION_ID,
+            'counterparty_wallet_id': None,
+            'value': DEPOSIT_VALUE,
+        }]),
+        literal_binds=False
+    )
+
+
+def make_insert_outbox_stmt(*user_ids):
+    return compile_sql_statement(
+        tables.outbox_events.insert().from_select([
+            tables.outbox_events.c.user_id,
+            tables.outbox_events.c.url,
+            tables.outbox_events.c.payload,
+            tables.outbox_events.c.created_at,
+            tables.outbox_events.c.next_attempt_at,
+        ], select([
+            tables.webhook_endpoints.c.user_id,
+            tables.webhook_endpoints.c.url,
+            literal('', Text),
+            literal(datetime.datetime.utcnow(), TIMESTAMP),
+            literal(datetime.datetime.utcnow(), TIMESTAMP),
+        ]).where(tables.webhook_endpoints.c.user_id.in_(user_ids))),
         literal_binds=False
     )
 
@@ -49,6 +86,7 @@ def test_deposit__own_wallet__returns_value_and_new_balance(database, user, test
     wallet_data = make_wallet_json(wallet_id=WALLET_ID, user_id=user.id)
     database.fetch_one = async_mock(return_value=wallet_data)
     database.fetch_val = async_mock(return_value=decimal.Decimal('110.0001'))
+    database.execute = async_mock(return_value=TRANSACTION_ID)
 
     response = post(test_app, f'/wallet/{WALLET_ID}/deposit', json={'value': str(DEPOSIT_VALUE)})
 
@@ -61,8 +99,10 @@ def test_deposit__own_wallet__returns_value_and_new_balance(database, user, test
     assert UPDATE_BALANCE_STMT in fetch_val_sql_args
 
     execute_sql_args = call_args_to_sql_strings(database.execute.mock.call_args_list, literal_binds=False)
-    assert database.execute.mock.call_count == 1
+    assert database.execute.mock.call_count == 3
     assert make_insert_transaction_stmt() in execute_sql_args
+    assert make_insert_entries_stmt() in execute_sql_args
+    assert make_insert_outbox_stmt(user.id) in execute_sql_args
 
     assert response.status_code == 200
     assert response.json() == {
@@ -76,6 +116,7 @@ def test_deposit__stranger_wallet__returns_value_only(database, user, test_app):
     wallet_data = make_wallet_json(wallet_id=WALLET_ID)
     database.fetch_one = async_mock(return_value=wallet_data)
     database.fetch_val = async_mock(return_value=decimal.Decimal('110.0001'))
+    database.execute = async_mock(return_value=TRANSACTION_ID)
 
     response = post(test_app, f'/wallet/{WALLET_ID}/deposit', json={'value': str(DEPOSIT_VALUE)})
 
@@ -88,8 +129,10 @@ def test_deposit__stranger_wallet__returns_value_only(database, user, test_app):
     assert UPDATE_BALANCE_STMT in fetch_val_sql_args
 
     execute_sql_args = call_args_to_sql_strings(database.execute.mock.call_args_list, literal_binds=False)
-    assert database.execute.mock.call_count == 1
+    assert database.execute.mock.call_count == 3
     assert make_insert_transaction_stmt() in execute_sql_args
+    assert make_insert_entries_stmt() in execute_sql_args
+    assert make_insert_outbox_stmt(wallet_data['user_id']) in execute_sql_args
 
     assert response.status_code == 200
     assert response.json() == {
@@ -140,7 +183,47 @@ def test_deposit__decimals__returns_error(deposit_value, expected_status_code, d
     wallet_data = make_wallet_json(wallet_id=WALLET_ID, user_id=user.id)
     database.fetch_one = async_mock(return_value=wallet_data)
     database.fetch_val = async_mock(return_value=decimal.Decimal('110.0001'))
+    database.execute = async_mock(return_value=TRANSACTION_ID)
 
     response = post(test_app, f'/wallet/{WALLET_ID}/deposit', json={'value': str(deposit_value)})
 
     assert response.status_code == expected_status_code
+
+
+@freezegun.freeze_time(datetime.datetime(2020, 1, 1, 0, 0, 0))
+def test_deposit__minor_units__converts_amounts(mocker, database, user, test_app):
+    mocker.patch('config.AMOUNTS_AS_MINOR_UNITS', True)
+    wallet_data = make_wallet_json(wallet_id=WALLET_ID, user_id=user.id)
+    wallet_data['balance'] = 10000000000
+    database.fetch_one = async_mock(return_value=wallet_data)
+    database.fetch_val = async_mock(return_value=11000010000)
+    database.execute = async_mock(return_value=TRANSACTION_ID)
+
+    response = post(test_app, f'/wallet/{WALLET_ID}/deposit', json={'value': str(DEPOSIT_VALUE)})
+
+    update_stmt = database.fetch_val.mock.call_args.args[0]
+    assert update_stmt.compile().params['balance_1'] == 1000010000
+    insert_stmt = database.execute.mock.call_args_list[0].args[0]
+    assert insert_stmt.compile().params['value'] == 1000010000
+
+    assert response.status_code == 200
+    assert response.json() == {
+        'balance': '110.0001',
+        'value': '10.0001',
+    }
+
+
+@pytest.mark.parametrize(
+    'amount, units',
+    (
+            (decimal.Decimal('0.00000001'), 1),
+            (decimal.Decimal('10.5'), 1050000000),
+            (decimal.Decimal('100'), 10000000000),
+            (decimal.Decimal('-2.25'), -225000000),
+    )
+)
+def test_storage_amount__minor_units__round_trips(mocker, amount, units):
+    mocker.patch('config.AMOUNTS_AS_MINOR_UNITS', True)
+
+    assert models.to_storage_amount(amount) == units
+    assert str(models.from_storage_amount(units)) == str(amount)
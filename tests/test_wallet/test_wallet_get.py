@@ -1,6 +1,7 @@
 import decimal
 import uuid
 
+from services import make_etag
 from tests.utils import async_mock, get
 
 
@@ -46,3 +47,56 @@ def test_get__not_owned__returns_error(database, user, test_app):
 
     assert response.status_code == 403
     assert response.json()['detail'][0]['msg'] == 'User does not own the wallet'
+
+
+def test_get__etag_matches__returns_not_modified(database, user, test_app):
+    wallet_id = str(uuid.uuid4())
+    wallet_data = {
+        'id': wallet_id,
+        'user_id': user.id,
+        'name': 'wallet1',
+        'balance': decimal.Decimal(10),
+        'version': 3,
+    }
+    database.fetch_one = async_mock(return_value=wallet_data)
+    etag = make_etag('wallet', wallet_id, 3)
+
+    response = get(test_app, f'/wallet/{wallet_id}', headers={'If-None-Match': f'"other", W/{etag}'})
+
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert response.content == b''
+
+
+def test_get__etag_outdated__returns_wallet(database, user, test_app):
+    wallet_id = str(uuid.uuid4())
+    wallet_data = {
+        'id': wallet_id,
+        'user_id': user.id,
+        'name': 'wallet1',
+        'balance': decimal.Decimal(10),
+        'version': 4,
+    }
+    database.fetch_one = async_mock(return_value=wallet_data)
+
+    response = get(test_app, f'/wallet/{wallet_id}', headers={'If-None-Match': make_etag('wallet', wallet_id, 3)})
+
+    assert response.status_code == 200
+    assert response.headers['ETag'] == make_etag('wallet', wallet_id, 4)
+    assert response.json()['balance'] == '10'
+
+
+def test_get__etag_matches_not_owned__returns_error(database, user, test_app):
+    wallet_id = str(uuid.uuid4())
+    wallet_data = {
+        'id': wallet_id,
+        'user_id': str(uuid.uuid4()),
+        'name': 'wallet1',
+        'balance': decimal.Decimal(10),
+        'version': 3,
+    }
+    database.fetch_one = async_mock(return_value=wallet_data)
+
+    response = get(test_app, f'/wallet/{wallet_id}', headers={'If-None-Match': make_etag('wallet', wallet_id, 3)})
+
+    assert response.status_code == 403
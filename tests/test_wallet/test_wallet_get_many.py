@@ -1,6 +1,22 @@
+import decimal
 import uuid
 
-from tests.utils import async_mock
+from sqlalchemy import func, select
+
+import tables
+from services import make_etag
+from tests.utils import async_mock, call_args_to_sql_strings, compile_sql_statement, get
+
+
+def make_user_aggregate(user_id, aggregate):
+    return select([aggregate]).where(tables.wallets.c.user_id == user_id).as_scalar()
+
+
+def make_list_version_columns(user_id):
+    return [
+        make_user_aggregate(user_id, func.count()).label('wallet_count'),
+        make_user_aggregate(user_id, func.coalesce(func.sum(tables.wallets.c.version), 0)).label('version_sum'),
+    ]
 
 
 def test_get__called__returns_wallet_list(database, user, test_app):
@@ -14,10 +30,105 @@ def test_get__called__returns_wallet_list(database, user, test_app):
             'name': 'wallet2'
         }
     ]
-    database.fetch_all = async_mock(return_value=wallet_list)
+    database.fetch_all = async_mock(return_value=[
+        {**wallet, 'wallet_count': 2, 'version_sum': 7} for wallet in wallet_list
+    ])
     response = test_app.get('/wallet?args=a&kwargs=b')
 
     assert response.status_code == 200
     assert response.json() == {
         'wallets': wallet_list
     }
+    assert response.headers['ETag'] == make_etag('wallets', 2, 7, None, None, False)
+
+
+def test_get__paginated_with_balance__returns_page_and_total(database, user, test_app):
+    after = str(uuid.uuid4())
+    wallet_list = [
+        {
+            'id': str(uuid.uuid4()),
+            'name': 'wallet1',
+            'balance': decimal.Decimal(10),
+            'total_balance': decimal.Decimal(35),
+            'wallet_count': 3,
+            'version_sum': 7,
+        },
+        {
+            'id': str(uuid.uuid4()),
+            'name': 'wallet2',
+            'balance': decimal.Decimal(5),
+            'total_balance': decimal.Decimal(35),
+            'wallet_count': 3,
+            'version_sum': 7,
+        }
+    ]
+    database.fetch_all = async_mock(return_value=wallet_list)
+    response = get(test_app, f'/wallet?after={after}&limit=2&include_balance=true')
+
+    total_balance = make_user_aggregate(user.id, func.coalesce(func.sum(tables.wallets.c.balance), 0))
+    select_stmt = compile_sql_statement(
+        tables.wallets.select().where(
+            (tables.wallets.c.user_id == user.id) & (tables.wallets.c.id > after),
+        ).with_only_columns([
+            tables.wallets.c.id,
+            tables.wallets.c.name,
+            *make_list_version_columns(user.id),
+            tables.wallets.c.balance,
+            total_balance.label('total_balance'),
+        ]).order_by(tables.wallets.c.id).limit(2)
+    )
+    assert call_args_to_sql_strings(database.fetch_all.mock.call_args_list) == [select_stmt]
+
+    assert response.status_code == 200
+    assert response.json() == {
+        'wallets': [
+            {'id': wallet_list[0]['id'], 'name': 'wallet1', 'balance': '10'},
+            {'id': wallet_list[1]['id'], 'name': 'wallet2', 'balance': '5'},
+        ],
+        'total_balance': '35',
+        'next_after': wallet_list[1]['id'],
+    }
+
+
+def test_get__last_page__returns_no_cursor(database, user, test_app):
+    wallet_list = [
+        {
+            'id': str(uuid.uuid4()),
+            'name': 'wallet1'
+        },
+    ]
+    database.fetch_all = async_mock(return_value=[
+        {**wallet, 'wallet_count': 1, 'version_sum': 0} for wallet in wallet_list
+    ])
+    response = get(test_app, '/wallet?limit=2')
+
+    assert response.status_code == 200
+    assert response.json() == {
+        'wallets': wallet_list
+    }
+
+
+def test_get__etag_matches__returns_not_modified(database, user, test_app):
+    etag = make_etag('wallets', 2, 7, None, None, False)
+    database.fetch_one = async_mock(return_value={'wallet_count': 2, 'version_sum': 7})
+
+    response = get(test_app, '/wallet', headers={'If-None-Match': etag})
+
+    assert call_args_to_sql_strings(database.fetch_one.mock.call_args_list) == [
+        compile_sql_statement(select(make_list_version_columns(user.id)))
+    ]
+    assert database.fetch_all.mock.call_count == 0
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+
+def test_get__etag_outdated__returns_wallet_list(database, user, test_app):
+    wallet = {'id': str(uuid.uuid4()), 'name': 'wallet1'}
+    database.fetch_one = async_mock(return_value={'wallet_count': 1, 'version_sum': 8})
+    database.fetch_all = async_mock(return_value=[{**wallet, 'wallet_count': 1, 'version_sum': 8}])
+
+    response = get(test_app, '/wallet', headers={'If-None-Match': make_etag('wallets', 1, 7, None, None, False)})
+
+    assert response.status_code == 200
+    assert response.json() == {'wallets': [wallet]}
+    assert response.headers['ETag'] == make_etag('wallets', 1, 8, None, None, False)
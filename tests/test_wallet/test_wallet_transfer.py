@@ -3,14 +3,16 @@ import decimal
 import uuid
 
 import freezegun
+from sqlalchemy import TIMESTAMP, Text, literal, select
 
 import tables
 from tests.factories import make_wallet_json
 from tests.utils import async_mock, call_args_to_sql_strings, compile_sql_statement, post
 
 
-SENDER_WALLET_ID = str(uuid.uuid4())
-RECIPIENT_WALLET_ID = str(uuid.uuid4())
+# Wallets of a transfer are locked in id order, the sender first
+SENDER_WALLET_ID, RECIPIENT_WALLET_ID = sorted(str(uuid.uuid4()) for _ in range(2))
+TRANSACTION_ID = 1
 TRANSFER_VALUE = decimal.Decimal(10)
 
 DECREMENT_SENDER_BALANCE_STMT = compile_sql_statement(
@@ -18,6 +20,7 @@ DECREMENT_SENDER_BALANCE_STMT = compile_sql_statement(
         tables.wallets.c.id == SENDER_WALLET_ID
     ).values(
         balance=tables.wallets.c.balance + (-TRANSFER_VALUE),
+        version=tables.wallets.c.version + 1,
     ).returning(tables.wallets.c.balance)
 )
 INCREMENT_RECIPIENT_BALANCE_STMT = compile_sql_statement(
@@ -25,6 +28,7 @@ INCREMENT_RECIPIENT_BALANCE_STMT = compile_sql_statement(
         tables.wallets.c.id == RECIPIENT_WALLET_ID
     ).values(
         balance=tables.wallets.c.balance + TRANSFER_VALUE,
+        version=tables.wallets.c.version + 1,
     ).returning(tables.wallets.c.balance)
 )
 
@@ -36,7 +40,47 @@ def make_insert_transaction_stmt():
             'recipient_wallet_id': RECIPIENT_WALLET_ID,
             'value': TRANSFER_VALUE,
             'timestamp': datetime.datetime.utcnow(),
-        })
+        }).returning(tables.transactions.c.id)
+    )
+
+
+def make_insert_entries_stmt():
+    return compile_sql_statement(
+        tables.wallet_entries.insert().values([
+            {
+                'wallet_id': RECIPIENT_WALLET_ID,
+                'timestamp': datetime.datetime.utcnow(),
+                'transaction_id': TRANSACTION_ID,
+                'counterparty_wallet_id': SENDER_WALLET_ID,
+                'value': TRANSFER_VALUE,
+            },
+            {
+                'wallet_id': SENDER_WALLET_ID,
+                'timestamp': datetime.datetime.utcnow(),
+                'transaction_id': TRANSACTION_ID,
+                'counterparty_wallet_id': RECIPIENT_WALLET_ID,
+                'value': -TRANSFER_VALUE,
+            },
+        ])
+    )
+
+
+def make_insert_outbox_stmt(*user_ids):
+    return compile_sql_statement(
+        tables.outbox_events.insert().from_select([
+            tables.outbox_events.c.user_id,
+            tables.outbox_events.c.url,
+            tables.outbox_events.c.payload,
+            tables.outbox_events.c.created_at,
+            tables.outbox_events.c.next_attempt_at,
+        ], select([
+            tables.webhook_endpoints.c.user_id,
+            tables.webhook_endpoints.c.url,
+            literal('', Text),
+            literal(datetime.datetime.utcnow(), TIMESTAMP),
+            literal(datetime.datetime.utcnow(), TIMESTAMP),
+        ]).where(tables.webhook_endpoints.c.user_id.in_(user_ids))),
+        literal_binds=False
     )
 
 
@@ -48,8 +92,10 @@ def test__user_owns_sender_wallet_recipient_exists_sufficient_funds__returns_new
     database.fetch_one = async_mock(side_effect=[
         sender_wallet_data,
         recipient_wallet_data,
+        None,
     ])
     database.fetch_val = async_mock(return_value=decimal.Decimal(90))
+    database.execute = async_mock(return_value=TRANSACTION_ID)
 
     response = post(
         test_app,
@@ -63,8 +109,11 @@ def test__user_owns_sender_wallet_recipient_exists_sufficient_funds__returns_new
     assert INCREMENT_RECIPIENT_BALANCE_STMT in fetch_val_sql_args
 
     execute_sql_args = call_args_to_sql_strings(database.execute.mock.call_args_list)
-    assert database.execute.mock.call_count == 1
+    assert database.execute.mock.call_count == 3
     assert make_insert_transaction_stmt() in execute_sql_args
+    assert make_insert_entries_stmt() in execute_sql_args
+    outbox_sql_args = call_args_to_sql_strings(database.execute.mock.call_args_list, literal_binds=False)
+    assert make_insert_outbox_stmt(user.id, recipient_wallet_data['user_id']) in outbox_sql_args
 
     assert response.status_code == 200
     assert response.json() == {
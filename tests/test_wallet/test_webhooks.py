@@ -0,0 +1,164 @@
+import asyncio
+import datetime
+import http.server
+import json
+import threading
+import uuid
+from unittest import mock
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+import adapters
+import models
+import tables
+import webhooks
+from tests.utils import async_mock, get, put
+
+
+USER_ID = uuid.uuid4()
+NOW = datetime.datetime(2020, 1, 1, 12, 0)
+
+
+# Local endpoint answering every POST with `status` and keeping the bodies it got
+@pytest.fixture
+def endpoint():
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            server.bodies.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+            self.send_response(server.status)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.bodies = []
+    server.status = 200
+    server.url = f'http://127.0.0.1:{server.server_address[1]}/hook'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_events(url, count, attempts=1):
+    return [
+        models.OutboxEventDB(
+            id=event_id,
+            user_id=USER_ID,
+            url=url,
+            payload=json.dumps({'id': str(event_id)}),
+            created_at=NOW,
+            attempts=attempts,
+            next_attempt_at=NOW,
+        )
+        for event_id in range(1, count + 1)
+    ]
+
+
+def make_db_adapter(events):
+    db_adapter = mock.MagicMock()
+    db_adapter.claim = async_mock(return_value=events)
+    db_adapter.delete = async_mock()
+    db_adapter.reschedule = async_mock()
+    return db_adapter
+
+
+def dispatch(db_adapter, **kwargs):
+    dispatcher = webhooks.WebhookDispatcher([], **{
+        'batch_size': 100,
+        'events_per_request': 2,
+        'endpoint_concurrency': 1,
+        'max_connections': 10,
+        'timeout': 5.0,
+        'max_attempts': 3,
+        'retry_base_seconds': 10.0,
+        'retry_max_seconds': 60.0,
+        'lease_seconds': 60,
+        'poll_interval': 1.0,
+        **kwargs,
+    })
+
+    async def run():
+        dispatcher.start()
+        try:
+            return await dispatcher.run(db_adapter)
+        finally:
+            await dispatcher.stop()
+
+    return asyncio.run(run())
+
+
+def test_run__endpoint_accepts__posts_batches_and_deletes_events(endpoint):
+    db_adapter = make_db_adapter(make_events(endpoint.url, 5))
+
+    claimed = dispatch(db_adapter)
+
+    assert claimed == 5
+    assert sorted(len(body['events']) for body in endpoint.bodies) == [1, 2, 2]
+    assert sorted(event['id'] for body in endpoint.bodies for event in body['events']) == ['1', '2', '3', '4', '5']
+    deleted_ids = [call.args[0] for call in db_adapter.delete.mock.call_args_list]
+    assert sorted(event_id for event_ids in deleted_ids for event_id in event_ids) == [1, 2, 3, 4, 5]
+    assert db_adapter.reschedule.mock.call_count == 0
+
+
+def test_run__endpoint_fails__reschedules_with_backoff_and_parks_last_attempt(endpoint):
+    endpoint.status = 503
+    events = make_events(endpoint.url, 2, attempts=2) + make_events(endpoint.url, 1, attempts=3)
+    events[-1].id = 3
+    db_adapter = make_db_adapter(events)
+
+    dispatch(db_adapter, events_per_request=10)
+
+    assert len(endpoint.bodies) == 1
+    assert db_adapter.delete.mock.call_count == 0
+    reschedules = {tuple(call.args[0]): call.args[1] for call in db_adapter.reschedule.mock.call_args_list}
+    retry_at = reschedules[(1, 2)]
+    assert datetime.timedelta(seconds=19) < retry_at - datetime.datetime.utcnow() <= datetime.timedelta(seconds=20)
+    assert reschedules[(3,)] is None
+
+
+def test_run__endpoint_unreachable__reschedules_events():
+    db_adapter = make_db_adapter(make_events('http://127.0.0.1:1/hook', 1))
+
+    dispatch(db_adapter)
+
+    assert db_adapter.delete.mock.call_count == 0
+    assert db_adapter.reschedule.mock.call_args.args[0] == [1]
+
+
+def test_claim__skips_events_locked_by_other_dispatchers():
+    database = mock.MagicMock()
+    database.fetch_all = async_mock(return_value=[])
+    adapter = adapters.OutboxDatabaseAdapter(
+        models.OutboxEventDB, database, tables.outbox_events, tables.webhook_endpoints,
+    )
+
+    asyncio.run(adapter.claim(NOW, 100, datetime.timedelta(seconds=60)))
+
+    query = str(database.fetch_all.mock.call_args.args[0].compile(dialect=postgresql.dialect()))
+    assert query.startswith('UPDATE outbox_event SET attempts=(outbox_event.attempts + %(attempts_1)s)')
+    assert 'FOR UPDATE SKIP LOCKED' in query
+    assert query.endswith('RETURNING outbox_event.id, outbox_event.user_id, outbox_event.url, outbox_event.payload, '
+                          'outbox_event.created_at, outbox_event.attempts, outbox_event.next_attempt_at')
+
+
+def test_put__valid_url__sets_endpoint(database, user, test_app):
+    response = put(test_app, '/webhook', json={'url': 'https://example.com/hook'})
+
+    assert response.status_code == 200
+    assert response.json() == {'url': 'https://example.com/hook'}
+    query = database.execute.mock.call_args.args[0].compile(dialect=postgresql.dialect())
+    assert str(query).startswith('INSERT INTO webhook_endpoint')
+    assert query.params['url'] == 'https://example.com/hook'
+
+
+def test_get__no_endpoint__returns_error(database, user, test_app):
+    database.fetch_val = async_mock(return_value=None)
+
+    response = get(test_app, '/webhook')
+
+    assert response.status_code == 404
+    assert response.json()['detail'][0]['entity'] == 'webhook'
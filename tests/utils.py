@@ -2,6 +2,12 @@ import typing as t
 from unittest import mock
 from unittest.mock import _CallList
 
+from sqlalchemy.engine.default import StrCompileDialect
+
+
+class MultiValuesStrCompileDialect(StrCompileDialect):
+    supports_multivalues_insert = True
+
 
 class AsyncContextManagerMock(mock.MagicMock):
     async def __aenter__(self):
@@ -31,8 +37,16 @@ def post(client, url, *args, **kwargs):
     return client.post(f'{url}{delimiter}args=a&kwargs=b', *args, **kwargs)
 
 
+def put(client, url, *args, **kwargs):
+    delimiter = '&' if '?' in url else '?'
+    return client.put(f'{url}{delimiter}args=a&kwargs=b', *args, **kwargs)
+
+
 def compile_sql_statement(sql_statement, literal_binds=True) -> str:
-    return str(sql_statement.compile(compile_kwargs={"literal_binds": literal_binds}))
+    return str(sql_statement.compile(
+        dialect=MultiValuesStrCompileDialect(),
+        compile_kwargs={"literal_binds": literal_binds},
+    ))
 
 
 def call_args_to_sql_strings(call_args_list: _CallList, literal_binds=True) -> t.List[str]:
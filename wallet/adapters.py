@@ -1,15 +1,41 @@
+import contextlib
 import datetime
 import decimal
+import re
 import typing as t
 import uuid
 
 import asyncpg
 from databases import Database
 from pydantic.types import UUID4
-from sqlalchemy import Table, and_, or_
+from sqlalchemy import TIMESTAMP, Table, Text, and_, case, func, literal, or_, select, true, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.elements import ColumnElement, Label
 
+import archive
 import enums
+import ids
+import metrics
 import models
+import tracing
+from services import to_naive_utc
+from singleflight import SingleFlight
+
+
+OPTIMISTIC_CONFLICTS = metrics.Counter(
+    'wallet_optimistic_conflicts_total', 'Optimistic debits rejected because the wallet changed since it was read',
+)
+
+# What pg_export_snapshot() returns, e.g. 00000003-0000001B-1
+SNAPSHOT_ID_PATTERN = re.compile(r'[0-9A-F]+(-[0-9A-F]+)+', re.IGNORECASE)
+
+
+# SET LOCAL of both timeouts in one round trip, nothing is sent when neither is set
+async def set_local_timeouts(database: Database, lock_timeout: int = 0, statement_timeout: int = 0):
+    settings = {'lock_timeout': lock_timeout, 'statement_timeout': statement_timeout}
+    columns = [func.set_config(name, str(value), true()) for name, value in settings.items() if value]
+    if columns:
+        await database.execute(select(columns))
 
 
 # noinspection PyPropertyAccess
@@ -19,38 +45,96 @@ class WalletDatabaseAdapter:
             db_model: t.Type[models.WalletDB],
             database: Database,
             table: Table,
+            lock_nowait: bool = False,
     ):
         self.db_model = db_model
         self.database = database
         self.table = table
-        
-    async def create(self, wallet: models.WalletCreate, user_id: UUID4) -> UUID4:
+        self.lock_nowait = lock_nowait
+        self._single_flight = SingleFlight('wallet_get')
+
+    @tracing.traced
+    async def create(self, wallet: models.WalletCreate, user_id: UUID4, wallet_id: UUID4 = None) -> UUID4:
         query = self.table.insert(values={
-            'id': uuid.uuid4(),
+            'id': wallet_id or ids.make_wallet_id(),
             'user_id': user_id,
             'name': wallet.name,
-            'balance': decimal.Decimal(0),
+            'balance': models.to_storage_amount(decimal.Decimal(0)),
         }).returning(self.table.c.id)
         try:
             return await self.database.fetch_val(query)
         except asyncpg.UniqueViolationError:
             raise ValueError('Wallet with this name already exists')
 
+    @tracing.traced
     async def get(self, wallet_id: UUID4) -> t.Optional[models.WalletDB]:
+        return await self._single_flight.do(wallet_id, lambda: self._get(wallet_id))
+
+    async def _get(self, wallet_id: UUID4) -> t.Optional[models.WalletDB]:
         query = self.table.select().where(self.table.c.id == wallet_id)
         wallet_dict = await self.database.fetch_one(query)
-        return self.db_model(**wallet_dict) if wallet_dict else None
+        return self._to_model(wallet_dict) if wallet_dict else None
 
-    async def get_many(self, user_id: UUID4) -> t.List[models.WalletDB]:
-        query = self.table.select().where(
-            self.table.c.user_id == user_id,
-        ).with_only_columns([
+    @tracing.traced
+    async def get_many(
+            self,
+            user_id: UUID4,
+            after: UUID4 = None,
+            limit: int = None,
+            include_balance: bool = False,
+    ) -> models.WalletListDB:
+        columns = [
             self.table.c.id,
             self.table.c.name,
-        ])
+            *self._make_list_version_columns(user_id),
+        ]
+        if include_balance:
+            total_balance = self._make_user_aggregate(user_id, func.coalesce(func.sum(self.table.c.balance), 0))
+            columns += [self.table.c.balance, total_balance.label('total_balance')]
+        conditions = [self.table.c.user_id == user_id]
+        if after:
+            conditions.append(self.table.c.id > after)
+        query = self.table.select().where(
+            and_(*conditions),
+        ).with_only_columns(columns).order_by(self.table.c.id).limit(limit)
         wallet_dicts = await self.database.fetch_all(query)
-        return [self.db_model(**wallet_dict) for wallet_dict in wallet_dicts]
+        if not wallet_dicts:
+            return models.WalletListDB(wallets=[])
+        return models.WalletListDB(
+            wallets=[self._to_model(wallet_dict) for wallet_dict in wallet_dicts],
+            total_balance=models.from_storage_amount(wallet_dicts[0]['total_balance']) if include_balance else None,
+            wallet_count=wallet_dicts[0]['wallet_count'],
+            version_sum=wallet_dicts[0]['version_sum'],
+        )
 
+    def _to_model(self, wallet_dict: t.Mapping[str, t.Any]) -> models.WalletDB:
+        wallet = self.db_model(**wallet_dict)
+        wallet.balance = models.from_storage_amount(wallet.balance)
+        wallet.held = models.from_storage_amount(wallet.held)
+        return wallet
+
+    @tracing.traced
+    async def get_list_version(self, user_id: UUID4) -> t.Tuple[int, int]:
+        query = select(self._make_list_version_columns(user_id))
+        version_dict = await self.database.fetch_one(query)
+        return version_dict['wallet_count'], version_dict['version_sum']
+
+    @tracing.traced
+    async def get_total_balance(self, user_id: UUID4) -> decimal.Decimal:
+        query = select([self._make_user_aggregate(user_id, func.coalesce(func.sum(self.table.c.balance), 0))])
+        return models.from_storage_amount(await self.database.fetch_val(query))
+
+    def _make_list_version_columns(self, user_id: UUID4) -> t.List[Label]:
+        # Versions only grow and wallets are never deleted, so (count, sum of versions) changes on any update
+        return [
+            self._make_user_aggregate(user_id, func.count()).label('wallet_count'),
+            self._make_user_aggregate(user_id, func.coalesce(func.sum(self.table.c.version), 0)).label('version_sum'),
+        ]
+
+    def _make_user_aggregate(self, user_id: UUID4, aggregate: ColumnElement) -> ColumnElement:
+        return select([aggregate]).where(self.table.c.user_id == user_id).as_scalar()
+
+    @tracing.traced
     async def lock(self, wallet_id: UUID4) -> t.Optional[models.WalletDB]:
         query = self.table.select().where(
             self.table.c.id == wallet_id,
@@ -58,13 +142,65 @@ class WalletDatabaseAdapter:
             self.table.c.id,
             self.table.c.user_id,
             self.table.c.balance,
-        ]).with_for_update()
+            self.table.c.held,
+        ]).with_for_update(nowait=self.lock_nowait)
         wallet_dict = await self.database.fetch_one(query)
-        return self.db_model(**wallet_dict) if wallet_dict else None
+        return self._to_model(wallet_dict) if wallet_dict else None
 
+    # Bypasses SingleFlight, a shared stale read would fail the optimistic debit of every caller
+    @tracing.traced
+    async def read(self, wallet_id: UUID4) -> t.Optional[models.WalletDB]:
+        query = select([
+            self.table.c.id,
+            self.table.c.user_id,
+            self.table.c.balance,
+            self.table.c.held,
+            self.table.c.version,
+            self.table.c.concurrency,
+        ]).where(self.table.c.id == wallet_id)
+        wallet_dict = await self.database.fetch_one(query)
+        return self._to_model(wallet_dict) if wallet_dict else None
+
+    # A deposit cannot conflict, so it needs neither a lock nor a version, just the owner of the wallet
+    @tracing.traced
+    async def deposit(self, wallet_id: UUID4, delta: decimal.Decimal) -> t.Optional[models.WalletDB]:
+        query = self.table.update(
+            self.table.c.id == wallet_id
+        ).values(
+            balance=self.table.c.balance + models.to_storage_amount(delta),
+            version=self.table.c.version + 1,
+        ).returning(self.table.c.id, self.table.c.user_id, self.table.c.balance)
+        wallet_dict = await self.database.fetch_one(query)
+        return self._to_model(wallet_dict) if wallet_dict else None
+
+    # None when the wallet was changed since `version` was read or no longer has the funds
+    @tracing.traced
+    async def decrease_balance_if_unchanged(
+            self,
+            wallet_id: UUID4,
+            delta: decimal.Decimal,
+            version: int,
+    ) -> t.Optional[decimal.Decimal]:
+        delta = models.to_storage_amount(delta)
+        query = self.table.update().where(and_(
+            self.table.c.id == wallet_id,
+            self.table.c.version == version,
+            self.table.c.balance >= delta,
+        )).values(
+            balance=self.table.c.balance - delta,
+            version=self.table.c.version + 1,
+        ).returning(self.table.c.balance)
+        balance = await self.database.fetch_val(query)
+        if balance is None:
+            OPTIMISTIC_CONFLICTS.inc()
+            return None
+        return models.from_storage_amount(balance)
+
+    @tracing.traced
     async def increase_balance(self, wallet_id: UUID4, delta: decimal.Decimal) -> decimal.Decimal:
         return await self._alter_balance(wallet_id, delta)
 
+    @tracing.traced
     async def decrease_balance(self, wallet_id: UUID4, delta: decimal.Decimal) -> decimal.Decimal:
         return await self._alter_balance(wallet_id, -delta)
 
@@ -72,49 +208,901 @@ class WalletDatabaseAdapter:
         query = self.table.update(
             self.table.c.id == wallet_id
         ).values(
-            balance=self.table.c.balance + delta
+            balance=self.table.c.balance + models.to_storage_amount(delta),
+            version=self.table.c.version + 1,
         ).returning(self.table.c.balance)
-        return await self.database.fetch_val(query)
+        return models.from_storage_amount(await self.database.fetch_val(query))
+
+    # Bumps the version too, so an optimistic debit of funds read as available fails once they are held
+    @tracing.traced
+    async def increase_held(self, wallet_id: UUID4, delta: decimal.Decimal) -> decimal.Decimal:
+        return await self._alter_held(wallet_id, delta)
+
+    @tracing.traced
+    async def decrease_held(self, wallet_id: UUID4, delta: decimal.Decimal) -> decimal.Decimal:
+        return await self._alter_held(wallet_id, -delta)
+
+    async def _alter_held(self, wallet_id: UUID4, delta: decimal.Decimal) -> decimal.Decimal:
+        query = self.table.update(
+            self.table.c.id == wallet_id
+        ).values(
+            held=self.table.c.held + models.to_storage_amount(delta),
+            version=self.table.c.version + 1,
+        ).returning(self.table.c.held)
+        return models.from_storage_amount(await self.database.fetch_val(query))
 
 
 # noinspection PyPropertyAccess
 class TransactionDatabaseAdapter:
+    # Each archived batch is decompressed as a whole, so paged reads fetch only a few at a time
+    ARCHIVE_BATCHES_PER_QUERY = 2
+
     def __init__(
             self,
             db_model: t.Type[models.TransactionDB],
             database: Database,
             table: Table,
+            entry_table: Table,
+            archive_table: Table = None,
     ):
         self.db_model = db_model
         self.database = database
         self.table = table
+        self.entry_table = entry_table
+        self.archive_table = archive_table
+        self._single_flight = SingleFlight('transaction_get_many')
+
+    @tracing.traced
+    async def create(self, transaction: models.TransactionDB, entry_wallet_ids: t.List[UUID4] = None) -> int:
+        query = self.table.insert(values={
+            **transaction.dict(exclude={'id'}),
+            'value': models.to_storage_amount(transaction.value),
+        }).returning(self.table.c.id)
+        transaction_id = await self.database.execute(query)
+        await self._create_entries(transaction, transaction_id, entry_wallet_ids)
+        return transaction_id
+
+    # Entries of a cross-shard transfer are written on the shard of their wallet, see shards.py
+    @tracing.traced
+    async def create_entries(self, transaction: models.TransactionDB, transaction_id: int, wallet_ids: t.List[UUID4]):
+        await self._create_entries(transaction, transaction_id, wallet_ids)
 
-    async def create(self, transaction: models.TransactionDB) -> UUID4:
-        query = self.table.insert(values=transaction.dict(exclude={'id'}))
-        return await self.database.execute(query)
+    async def _create_entries(
+            self,
+            transaction: models.TransactionDB,
+            transaction_id: int,
+            wallet_ids: t.Optional[t.List[UUID4]],
+    ):
+        value = models.to_storage_amount(transaction.value)
+        entries = [{
+            'wallet_id': transaction.recipient_wallet_id,
+            'timestamp': transaction.timestamp,
+            'transaction_id': transaction_id,
+            'counterparty_wallet_id': transaction.sender_wallet_id,
+            'value': value,
+        }]
+        if transaction.sender_wallet_id:
+            entries.append({
+                'wallet_id': transaction.sender_wallet_id,
+                'timestamp': transaction.timestamp,
+                'transaction_id': transaction_id,
+                'counterparty_wallet_id': transaction.recipient_wallet_id,
+                'value': -value,
+            })
+        if wallet_ids is not None:
+            entries = [entry for entry in entries if entry['wallet_id'] in wallet_ids]
+        await self.database.execute(self.entry_table.insert().values(entries))
 
+    @tracing.traced
     async def get_many(
             self,
             wallet_id: UUID4,
             from_timestamp: datetime.datetime = None,
             to_timestamp: datetime.datetime = None,
             transfer_side: enums.TransferSide = None,
+            operation_filter: models.OperationFilter = None,
     ) -> t.List[models.TransactionDB]:
-        and_conditions = []
-        or_conditions = []
-        if not transfer_side or transfer_side is enums.TransferSide.deposit:
-            or_conditions.append(self.table.c.recipient_wallet_id == wallet_id)
-        if not transfer_side or transfer_side is enums.TransferSide.withdraw:
-            or_conditions.append(self.table.c.sender_wallet_id == wallet_id)
-        and_conditions.append(or_(*or_conditions))
+        return await self._single_flight.do(
+            (wallet_id, from_timestamp, to_timestamp, transfer_side, operation_filter and operation_filter.json()),
+            lambda: self._get_many(wallet_id, from_timestamp, to_timestamp, transfer_side, operation_filter),
+        )
+
+    async def _get_many(
+            self,
+            wallet_id: UUID4,
+            from_timestamp: datetime.datetime = None,
+            to_timestamp: datetime.datetime = None,
+            transfer_side: enums.TransferSide = None,
+            operation_filter: models.OperationFilter = None,
+    ) -> t.List[models.TransactionDB]:
+        query = self.entry_table.select(and_(
+            *self._make_conditions(wallet_id, from_timestamp, to_timestamp, transfer_side, operation_filter)
+        )).order_by(self.entry_table.c.timestamp, self.entry_table.c.transaction_id)
+
+        entry_dicts = await self.database.fetch_all(query)
+        transactions = [self._entry_to_transaction(entry_dict) for entry_dict in entry_dicts]
+        if self.archive_table is None:
+            return transactions
+        # Archived after the hot read, so entries moved in between show up twice rather than not at all
+        archived = await self._get_archived(wallet_id, from_timestamp, to_timestamp, transfer_side, operation_filter)
+        if not archived:
+            return transactions
+        keys = {(transaction.timestamp, transaction.id) for transaction in transactions}
+        archived = [transaction for transaction in archived if (transaction.timestamp, transaction.id) not in keys]
+        return sorted(archived + transactions, key=lambda transaction: (transaction.timestamp, transaction.id))
+
+    @tracing.traced
+    async def get_page(
+            self,
+            wallet_id: UUID4,
+            from_timestamp: datetime.datetime = None,
+            to_timestamp: datetime.datetime = None,
+            transfer_side: enums.TransferSide = None,
+            after: t.Tuple[datetime.datetime, int] = None,
+            limit: int = None,
+            operation_filter: models.OperationFilter = None,
+    ) -> t.List[models.TransactionDB]:
+        transactions = []
+        if self.archive_table is not None:
+            transactions = await self._get_archived(
+                wallet_id, from_timestamp, to_timestamp, transfer_side, operation_filter, after, limit,
+            )
+            if transactions:
+                after = (transactions[-1].timestamp, transactions[-1].id)
+            if limit:
+                limit -= len(transactions)
+                if not limit:
+                    return transactions
+
+        and_conditions = self._make_conditions(wallet_id, from_timestamp, to_timestamp, transfer_side, operation_filter)
+        if after:
+            # Keyset pagination over the primary key, so every page is a short index range scan
+            and_conditions.append(
+                tuple_(self.entry_table.c.timestamp, self.entry_table.c.transaction_id) > tuple_(*after),
+            )
+        query = self.entry_table.select(and_(
+            *and_conditions
+        )).order_by(self.entry_table.c.timestamp, self.entry_table.c.transaction_id).limit(limit)
+
+        entry_dicts = await self.database.fetch_all(query)
+        return transactions + [self._entry_to_transaction(entry_dict) for entry_dict in entry_dicts]
+
+    @tracing.traced
+    async def count(
+            self,
+            wallet_id: UUID4,
+            from_timestamp: datetime.datetime = None,
+            to_timestamp: datetime.datetime = None,
+            transfer_side: enums.TransferSide = None,
+            operation_filter: models.OperationFilter = None,
+    ) -> int:
+        query = select([func.count()]).select_from(self.entry_table).where(and_(
+            *self._make_conditions(wallet_id, from_timestamp, to_timestamp, transfer_side, operation_filter)
+        ))
+        count = await self.database.fetch_val(query)
+        if self.archive_table is None:
+            return count
+        # Whole overlapping batches are counted, so this is an upper bound for archived history
+        query = select([
+            func.coalesce(func.sum(self.archive_table.c.entry_count), 0),
+        ]).where(and_(
+            *self._make_archive_conditions(wallet_id, from_timestamp, to_timestamp)
+        ))
+        return count + await self.database.fetch_val(query)
+
+    @tracing.traced
+    async def get_time_bounds(
+            self,
+            wallet_id: UUID4,
+            from_timestamp: datetime.datetime = None,
+            to_timestamp: datetime.datetime = None,
+    ) -> t.Tuple[t.Optional[datetime.datetime], t.Optional[datetime.datetime]]:
+        query = select([
+            func.min(self.entry_table.c.timestamp), func.max(self.entry_table.c.timestamp),
+        ]).where(and_(
+            *self._make_conditions(wallet_id, from_timestamp, to_timestamp, None)
+        ))
+        bounds = [tuple(await self.database.fetch_one(query))]
+        if self.archive_table is not None:
+            query = select([
+                func.min(self.archive_table.c.from_timestamp), func.max(self.archive_table.c.to_timestamp),
+            ]).where(and_(
+                *self._make_archive_conditions(wallet_id, from_timestamp, to_timestamp)
+            ))
+            bounds.append(tuple(await self.database.fetch_one(query)))
+        firsts = [first for first, _ in bounds if first is not None]
+        lasts = [last for _, last in bounds if last is not None]
+        if not firsts:
+            return None, None
+        first, last = min(firsts), max(lasts)
+        # Archived batches may stick out of the range
         if from_timestamp:
-            and_conditions.append(self.table.c.timestamp >= from_timestamp)
+            first = max(first, to_naive_utc(from_timestamp))
         if to_timestamp:
-            and_conditions.append(self.table.c.timestamp <= to_timestamp)
+            last = min(last, to_naive_utc(to_timestamp))
+        return first, last
 
-        query = self.table.select(and_(
-            *and_conditions
-        )).order_by(self.table.c.timestamp)
+    # Reads in use_snapshot transactions of other connections see exactly what this transaction sees,
+    # as long as it stays open
+    @contextlib.asynccontextmanager
+    async def export_snapshot(self) -> t.AsyncIterator[str]:
+        async with self.database.transaction():
+            await self.database.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+            yield await self.database.fetch_val(select([func.pg_export_snapshot()]))
+
+    @contextlib.asynccontextmanager
+    async def use_snapshot(self, snapshot_id: str) -> t.AsyncIterator[None]:
+        if not SNAPSHOT_ID_PATTERN.fullmatch(snapshot_id):
+            raise ValueError(f'Invalid snapshot id {snapshot_id!r}')
+        async with self.database.transaction():
+            await self.database.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+            # Not a parametrizable statement, hence the id check above
+            await self.database.execute(f"SET TRANSACTION SNAPSHOT '{snapshot_id}'")
+            yield
+
+    async def _get_archived(
+            self,
+            wallet_id: UUID4,
+            from_timestamp: t.Optional[datetime.datetime],
+            to_timestamp: t.Optional[datetime.datetime],
+            transfer_side: t.Optional[enums.TransferSide],
+            operation_filter: t.Optional[models.OperationFilter],
+            after: t.Tuple[datetime.datetime, int] = None,
+            limit: int = None,
+    ) -> t.List[models.TransactionDB]:
+        from_timestamp = to_naive_utc(from_timestamp) if from_timestamp else None
+        to_timestamp = to_naive_utc(to_timestamp) if to_timestamp else None
+        transactions = []
+        batch_key = None
+        while True:
+            if batch_key is None:
+                and_conditions = self._make_archive_conditions(
+                    wallet_id, after[0] if after else from_timestamp, to_timestamp,
+                )
+            else:
+                batch_columns = (self.archive_table.c.from_timestamp, self.archive_table.c.from_transaction_id)
+                and_conditions = [
+                    self.archive_table.c.wallet_id == wallet_id,
+                    tuple_(*batch_columns) > tuple_(*batch_key),
+                ]
+            query = self.archive_table.select(and_(
+                *and_conditions
+            )).order_by(
+                self.archive_table.c.from_timestamp, self.archive_table.c.from_transaction_id,
+            ).limit(self.ARCHIVE_BATCHES_PER_QUERY if limit else None)
+            batch_dicts = await self.database.fetch_all(query)
+            for batch_dict in batch_dicts:
+                for entry_dict in archive.decode_entries(wallet_id, batch_dict['data']):
+                    if not self._archived_entry_matches(
+                            entry_dict, from_timestamp, to_timestamp, transfer_side, operation_filter, after,
+                    ):
+                        continue
+                    transactions.append(self._entry_to_transaction(entry_dict))
+                    if limit and len(transactions) == limit:
+                        return transactions
+            if not limit or len(batch_dicts) < self.ARCHIVE_BATCHES_PER_QUERY:
+                return transactions
+            batch_key = (batch_dicts[-1]['from_timestamp'], batch_dicts[-1]['from_transaction_id'])
+
+    def _make_archive_conditions(
+            self,
+            wallet_id: UUID4,
+            from_timestamp: t.Optional[datetime.datetime],
+            to_timestamp: t.Optional[datetime.datetime],
+    ) -> t.List[ColumnElement]:
+        and_conditions = [self.archive_table.c.wallet_id == wallet_id]
+        if from_timestamp:
+            and_conditions.append(self.archive_table.c.to_timestamp >= from_timestamp)
+        if to_timestamp:
+            and_conditions.append(self.archive_table.c.from_timestamp <= to_timestamp)
+        return and_conditions
+
+    @staticmethod
+    def _archived_entry_matches(
+            entry_dict: t.Mapping[str, t.Any],
+            from_timestamp: t.Optional[datetime.datetime],
+            to_timestamp: t.Optional[datetime.datetime],
+            transfer_side: t.Optional[enums.TransferSide],
+            operation_filter: t.Optional[models.OperationFilter],
+            after: t.Optional[t.Tuple[datetime.datetime, int]],
+    ) -> bool:
+        if transfer_side is enums.TransferSide.deposit and entry_dict['value'] <= 0:
+            return False
+        if transfer_side is enums.TransferSide.withdraw and entry_dict['value'] >= 0:
+            return False
+        if from_timestamp and entry_dict['timestamp'] < from_timestamp:
+            return False
+        if to_timestamp and entry_dict['timestamp'] > to_timestamp:
+            return False
+        if after and (entry_dict['timestamp'], entry_dict['transaction_id']) <= after:
+            return False
+        if not operation_filter:
+            return True
+        counterparty_wallet_id = operation_filter.counterparty_wallet_id
+        if counterparty_wallet_id and entry_dict['counterparty_wallet_id'] != counterparty_wallet_id:
+            return False
+        min_value = models.to_storage_amount(operation_filter.min_value)
+        if min_value is not None and abs(entry_dict['value']) < min_value:
+            return False
+        max_value = models.to_storage_amount(operation_filter.max_value)
+        if max_value is not None and abs(entry_dict['value']) > max_value:
+            return False
+        from_transaction_id = operation_filter.from_transaction_id
+        if from_transaction_id is not None and entry_dict['transaction_id'] < from_transaction_id:
+            return False
+        to_transaction_id = operation_filter.to_transaction_id
+        if to_transaction_id is not None and entry_dict['transaction_id'] > to_transaction_id:
+            return False
+        return True
+
+    def _make_conditions(
+            self,
+            wallet_id: UUID4,
+            from_timestamp: t.Optional[datetime.datetime],
+            to_timestamp: t.Optional[datetime.datetime],
+            transfer_side: t.Optional[enums.TransferSide],
+            operation_filter: t.Optional[models.OperationFilter] = None,
+    ) -> t.List[ColumnElement]:
+        and_conditions = [self.entry_table.c.wallet_id == wallet_id]
+        if transfer_side is enums.TransferSide.deposit:
+            and_conditions.append(self.entry_table.c.value > 0)
+        elif transfer_side is enums.TransferSide.withdraw:
+            and_conditions.append(self.entry_table.c.value < 0)
+        if from_timestamp:
+            and_conditions.append(self.entry_table.c.timestamp >= from_timestamp)
+        if to_timestamp:
+            and_conditions.append(self.entry_table.c.timestamp <= to_timestamp)
+        if operation_filter:
+            and_conditions.extend(self._make_filter_conditions(operation_filter))
+        return and_conditions
+
+    # Each filter matches the leading columns of one of the wallet_entry indexes in tables.EXTRA_DDL
+    def _make_filter_conditions(self, operation_filter: models.OperationFilter) -> t.List[ColumnElement]:
+        and_conditions = []
+        if operation_filter.counterparty_wallet_id:
+            and_conditions.append(self.entry_table.c.counterparty_wallet_id == operation_filter.counterparty_wallet_id)
+        if operation_filter.min_value is not None:
+            and_conditions.append(
+                func.abs(self.entry_table.c.value) >= models.to_storage_amount(operation_filter.min_value),
+            )
+        if operation_filter.max_value is not None:
+            and_conditions.append(
+                func.abs(self.entry_table.c.value) <= models.to_storage_amount(operation_filter.max_value),
+            )
+        if operation_filter.from_transaction_id is not None:
+            and_conditions.append(self.entry_table.c.transaction_id >= operation_filter.from_transaction_id)
+        if operation_filter.to_transaction_id is not None:
+            and_conditions.append(self.entry_table.c.transaction_id <= operation_filter.to_transaction_id)
+        return and_conditions
+
+    def _entry_to_transaction(self, entry_dict: t.Mapping[str, t.Any]) -> models.TransactionDB:
+        if entry_dict['value'] > 0:
+            sender_wallet_id = entry_dict['counterparty_wallet_id']
+            recipient_wallet_id = entry_dict['wallet_id']
+        else:
+            sender_wallet_id = entry_dict['wallet_id']
+            recipient_wallet_id = entry_dict['counterparty_wallet_id']
+        return self.db_model(
+            id=entry_dict['transaction_id'],
+            sender_wallet_id=sender_wallet_id,
+            recipient_wallet_id=recipient_wallet_id,
+            value=models.from_storage_amount(abs(entry_dict['value'])),
+            timestamp=entry_dict['timestamp'],
+        )
+
+
+# noinspection PyPropertyAccess
+class BalanceCheckpointDatabaseAdapter:
+    # Any constant shared by all worker processes, see pg_try_advisory_lock
+    WRITER_LOCK_KEY = 0x77616c6c6574
+
+    def __init__(
+            self,
+            db_model: t.Type[models.WalletBalanceDB],
+            database: Database,
+            table: Table,
+            wallet_table: Table,
+            entry_table: Table,
+            archive_table: Table = None,
+            archive_summary_table: Table = None,
+    ):
+        self.db_model = db_model
+        self.database = database
+        self.table = table
+        self.wallet_table = wallet_table
+        self.entry_table = entry_table
+        self.archive_table = archive_table
+        self.archive_summary_table = archive_summary_table
+
+    @tracing.traced
+    async def get_many(self, wallet_ids: t.List[UUID4], timestamp: datetime.datetime) -> t.List[models.WalletBalanceDB]:
+        timestamp = to_naive_utc(timestamp)
+        checkpoint = self._make_checkpoint_lateral(timestamp)
+        # Only entries after the checkpoint are summed, so the scan is bounded by BALANCE_CHECKPOINT_MIN_ENTRIES
+        # plus whatever was written since the last checkpoint pass
+        delta = select([
+            func.coalesce(func.sum(self.entry_table.c.value), 0),
+        ]).where(and_(
+            *self._make_entry_conditions(self.entry_table, checkpoint, timestamp)
+        )).as_scalar()
+        columns = [self.wallet_table.c.id, self.wallet_table.c.user_id]
+        from_clause = self.wallet_table.outerjoin(checkpoint, true())
+        if self.archive_summary_table is not None:
+            columns.append(self.archive_summary_table.c.archived_until)
+            from_clause = from_clause.outerjoin(
+                self.archive_summary_table, self.archive_summary_table.c.wallet_id == self.wallet_table.c.id,
+            )
+        columns.append((self._make_base_balance(checkpoint) + delta).label('balance'))
+        query = select(columns).select_from(from_clause).where(self.wallet_table.c.id.in_(wallet_ids))
+        balance_dicts = await self.database.fetch_all(query)
+
+        balances = []
+        for balance_dict in balance_dicts:
+            balance = balance_dict['balance']
+            # Hot entries start at archived_until, older balances are replayed from the archive
+            archived_until = balance_dict['archived_until'] if self.archive_summary_table is not None else None
+            if archived_until and timestamp < archived_until:
+                balance = await self._get_archived_balance(balance_dict['id'], timestamp)
+            balances.append(self.db_model(
+                id=balance_dict['id'],
+                user_id=balance_dict['user_id'],
+                balance=models.from_storage_amount(balance),
+            ))
+        return balances
+
+    async def _get_archived_balance(self, wallet_id: UUID4, timestamp: datetime.datetime) -> decimal.Decimal:
+        query = self.archive_table.select().where(and_(
+            self.archive_table.c.wallet_id == wallet_id,
+            self.archive_table.c.from_timestamp <= timestamp,
+        ))
+        balance = decimal.Decimal(0)
+        for batch_dict in await self.database.fetch_all(query):
+            balance += sum(
+                entry_dict['value']
+                for entry_dict in archive.decode_entries(wallet_id, batch_dict['data'])
+                if entry_dict['timestamp'] <= timestamp
+            )
+        return balance
+
+    @contextlib.asynccontextmanager
+    async def lock_writer(self) -> t.AsyncIterator[bool]:
+        # Session level advisory locks belong to a connection, so it is held for the whole pass
+        async with self.database.connection():
+            locked = await self.database.fetch_val(select([func.pg_try_advisory_lock(self.WRITER_LOCK_KEY)]))
+            try:
+                yield locked
+            finally:
+                if locked:
+                    await self.database.fetch_val(select([func.pg_advisory_unlock(self.WRITER_LOCK_KEY)]))
+
+    async def get_wallet_ids(self, after: t.Optional[UUID4], limit: int) -> t.List[UUID4]:
+        query = select([self.wallet_table.c.id]).order_by(self.wallet_table.c.id).limit(limit)
+        if after:
+            query = query.where(self.wallet_table.c.id > after)
+        wallet_dicts = await self.database.fetch_all(query)
+        return [wallet_dict['id'] for wallet_dict in wallet_dicts]
+
+    async def write(self, wallet_ids: t.List[UUID4], settled_until: datetime.datetime, min_entries: int) -> int:
+        checkpoint = self._make_checkpoint_lateral(settled_until)
+        last_entry = select([
+            self.entry_table.c.timestamp,
+            self.entry_table.c.transaction_id,
+        ]).where(and_(
+            self.entry_table.c.wallet_id == self.wallet_table.c.id,
+            self.entry_table.c.timestamp <= settled_until,
+        )).order_by(
+            self.entry_table.c.timestamp.desc(), self.entry_table.c.transaction_id.desc(),
+        ).limit(1).lateral('last_entry')
+        new_entry = self.entry_table.alias('new_entry')
+        new_entries = select([
+            func.count().label('entry_count'),
+            func.coalesce(func.sum(new_entry.c.value), 0).label('delta'),
+        ]).where(and_(
+            *self._make_entry_conditions(new_entry, checkpoint, settled_until)
+        )).lateral('new_entries')
+        from_clause = self.wallet_table.outerjoin(
+            checkpoint, true(),
+        ).join(last_entry, true()).join(new_entries, true())
+        if self.archive_summary_table is not None:
+            from_clause = from_clause.outerjoin(
+                self.archive_summary_table, self.archive_summary_table.c.wallet_id == self.wallet_table.c.id,
+            )
+        query = select([
+            self.wallet_table.c.id,
+            last_entry.c.timestamp,
+            last_entry.c.transaction_id,
+            self._make_base_balance(checkpoint) + new_entries.c.delta,
+        ]).select_from(from_clause).where(and_(
+            self.wallet_table.c.id.in_(wallet_ids),
+            new_entries.c.entry_count >= min_entries,
+        ))
+        query = insert(self.table).from_select(
+            ['wallet_id', 'timestamp', 'transaction_id', 'balance'], query,
+        ).on_conflict_do_nothing().returning(self.table.c.wallet_id)
+        return len(await self.database.fetch_all(query))
+
+    def _make_checkpoint_lateral(self, timestamp: datetime.datetime):
+        return select([
+            self.table.c.timestamp,
+            self.table.c.transaction_id,
+            self.table.c.balance,
+        ]).where(and_(
+            self.table.c.wallet_id == self.wallet_table.c.id,
+            self.table.c.timestamp <= timestamp,
+        )).order_by(
+            self.table.c.timestamp.desc(), self.table.c.transaction_id.desc(),
+        ).limit(1).lateral('checkpoint')
+
+    def _make_entry_conditions(
+            self,
+            entry_table: Table,
+            checkpoint,
+            timestamp: datetime.datetime,
+    ) -> t.List[ColumnElement]:
+        return [
+            entry_table.c.wallet_id == self.wallet_table.c.id,
+            entry_table.c.timestamp <= timestamp,
+            or_(
+                checkpoint.c.timestamp.is_(None),
+                tuple_(entry_table.c.timestamp, entry_table.c.transaction_id)
+                > tuple_(checkpoint.c.timestamp, checkpoint.c.transaction_id),
+            ),
+        ]
+
+    def _make_base_balance(self, checkpoint) -> ColumnElement:
+        base_balance = func.coalesce(checkpoint.c.balance, 0)
+        if self.archive_summary_table is None:
+            return base_balance
+        # Checkpoints older than the archive cutoff are followed by archived entries, which the summary already sums
+        summary = self.archive_summary_table
+        return case([(
+            and_(
+                summary.c.archived_until.isnot(None),
+                or_(checkpoint.c.timestamp.is_(None), checkpoint.c.timestamp < summary.c.archived_until),
+            ),
+            summary.c.balance,
+        )], else_=base_balance)
+
+
+# noinspection PyPropertyAccess
+class SpendingLimitDatabaseAdapter:
+    WINDOWS = {
+        enums.SpendingLimitWindow.hourly: datetime.timedelta(hours=1),
+        enums.SpendingLimitWindow.daily: datetime.timedelta(days=1),
+    }
+
+    def __init__(
+            self,
+            db_model: t.Type[models.SpendingLimitDB],
+            database: Database,
+            table: Table,
+            bucket_table: Table,
+            bucket_seconds: int,
+    ):
+        self.db_model = db_model
+        self.database = database
+        self.table = table
+        self.bucket_table = bucket_table
+        self.bucket_seconds = bucket_seconds
+        self.slot_count = int(max(self.WINDOWS.values()).total_seconds()) // bucket_seconds
+
+    @tracing.traced
+    async def set(self, wallet_id: UUID4, limits: models.SpendingLimits):
+        if limits.hourly is None and limits.daily is None:
+            await self.database.execute(self.table.delete().where(self.table.c.wallet_id == wallet_id))
+            return
+        values = {
+            'hourly_limit': models.to_storage_amount(limits.hourly),
+            'daily_limit': models.to_storage_amount(limits.daily),
+        }
+        query = insert(self.table).values(wallet_id=wallet_id, **values).on_conflict_do_update(
+            index_elements=[self.table.c.wallet_id],
+            set_=values,
+        )
+        await self.database.execute(query)
+
+    # A primary key lookup plus two index range scans of at most a day of buckets, whatever the transfer rate
+    @tracing.traced
+    async def get_spent(self, wallet_id: UUID4, now: datetime.datetime) -> t.Optional[models.SpendingLimitDB]:
+        spent_columns = [
+            select([
+                func.coalesce(func.sum(self.bucket_table.c.spent), 0),
+            ]).where(and_(
+                self.bucket_table.c.wallet_id == self.table.c.wallet_id,
+                self.bucket_table.c.bucket_start >= self._get_bucket_start(now - window),
+            )).as_scalar().label(f'{name.value}_spent')
+            for name, window in self.WINDOWS.items()
+        ]
+        query = select([
+            self.table.c.wallet_id,
+            self.table.c.hourly_limit,
+            self.table.c.daily_limit,
+            *spent_columns,
+        ]).where(self.table.c.wallet_id == wallet_id)
+        limit_dict = await self.database.fetch_one(query)
+        if not limit_dict:
+            return None
+        return self.db_model(**{
+            key: value if key == 'wallet_id' else models.from_storage_amount(value)
+            for key, value in dict(limit_dict).items()
+        })
+
+    @tracing.traced
+    async def record(self, wallet_id: UUID4, now: datetime.datetime, value: decimal.Decimal):
+        bucket_start = self._get_bucket_start(now)
+        slot = int((bucket_start - datetime.datetime(1970, 1, 1)).total_seconds()) // self.bucket_seconds
+        query = insert(self.bucket_table).values(
+            wallet_id=wallet_id,
+            slot=slot % self.slot_count,
+            bucket_start=bucket_start,
+            spent=models.to_storage_amount(value),
+        )
+        # The slot still holds a bucket from a day ago when the wallet is first spending in this bucket
+        query = query.on_conflict_do_update(
+            index_elements=[self.bucket_table.c.wallet_id, self.bucket_table.c.slot],
+            set_={
+                'bucket_start': query.excluded.bucket_start,
+                'spent': case(
+                    [(self.bucket_table.c.bucket_start == query.excluded.bucket_start,
+                      self.bucket_table.c.spent + query.excluded.spent)],
+                    else_=query.excluded.spent,
+                ),
+            },
+        )
+        await self.database.execute(query)
+
+    def _get_bucket_start(self, timestamp: datetime.datetime) -> datetime.datetime:
+        timestamp = to_naive_utc(timestamp)
+        seconds = int((timestamp - datetime.datetime(1970, 1, 1)).total_seconds())
+        return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=seconds - seconds % self.bucket_seconds)
+
+
+# noinspection PyPropertyAccess
+class HoldDatabaseAdapter:
+    def __init__(
+            self,
+            db_model: t.Type[models.HoldDB],
+            database: Database,
+            table: Table,
+            wallet_table: Table,
+    ):
+        self.db_model = db_model
+        self.database = database
+        self.table = table
+        self.wallet_table = wallet_table
+
+    @tracing.traced
+    async def create(self, hold: models.HoldDB) -> models.HoldDB:
+        query = self.table.insert(values={
+            'id': uuid.uuid4(),
+            'wallet_id': hold.wallet_id,
+            'recipient_wallet_id': hold.recipient_wallet_id,
+            'value': models.to_storage_amount(hold.value),
+            'status': enums.HoldStatus.held.value,
+            'created_at': hold.created_at,
+            'expires_at': hold.expires_at,
+        }).returning(*self.table.c)
+        return self._to_model(await self.database.fetch_one(query))
+
+    @tracing.traced
+    async def get(self, wallet_id: UUID4, hold_id: UUID4) -> t.Optional[models.HoldDB]:
+        query = self.table.select().where(and_(self.table.c.id == hold_id, self.table.c.wallet_id == wallet_id))
+        hold_dict = await self.database.fetch_one(query)
+        return self._to_model(hold_dict) if hold_dict else None
+
+    @tracing.traced
+    async def get_active(self, wallet_id: UUID4) -> t.List[models.HoldDB]:
+        query = self.table.select().where(and_(
+            self.table.c.wallet_id == wallet_id,
+            self.table.c.status == enums.HoldStatus.held.value,
+        )).order_by(self.table.c.expires_at)
+        return [self._to_model(hold_dict) for hold_dict in await self.database.fetch_all(query)]
+
+    # Locks the hold row, None when it is already resolved. Callers lock wallets only after that, like expire().
+    @tracing.traced
+    async def resolve(
+            self,
+            wallet_id: UUID4,
+            hold_id: UUID4,
+            status: enums.HoldStatus,
+            now: datetime.datetime,
+    ) -> t.Optional[models.HoldDB]:
+        query = self.table.update().where(and_(
+            self.table.c.id == hold_id,
+            self.table.c.wallet_id == wallet_id,
+            self.table.c.status == enums.HoldStatus.held.value,
+        )).values(
+            status=status.value,
+            resolved_at=now,
+        ).returning(*self.table.c)
+        hold_dict = await self.database.fetch_one(query)
+        return self._to_model(hold_dict) if hold_dict else None
+
+    async def get_expiring(self, until: datetime.datetime, limit: int) -> t.List[models.HoldDB]:
+        query = self.table.select().where(and_(
+            self.table.c.status == enums.HoldStatus.held.value,
+            self.table.c.expires_at <= until,
+        )).order_by(self.table.c.expires_at).limit(limit)
+        return [self._to_model(hold_dict) for hold_dict in await self.database.fetch_all(query)]
+
+    # False when the hold was resolved (or expired by another process) in the meantime
+    async def expire(self, hold_id: UUID4, now: datetime.datetime) -> bool:
+        async with self.database.transaction():
+            query = self.table.update().where(and_(
+                self.table.c.id == hold_id,
+                self.table.c.status == enums.HoldStatus.held.value,
+                self.table.c.expires_at <= now,
+            )).values(
+                status=enums.HoldStatus.expired.value,
+                resolved_at=now,
+            ).returning(self.table.c.wallet_id, self.table.c.value)
+            hold_dict = await self.database.fetch_one(query)
+            if not hold_dict:
+                return False
+            query = self.wallet_table.update(
+                self.wallet_table.c.id == hold_dict['wallet_id']
+            ).values(
+                held=self.wallet_table.c.held - hold_dict['value'],
+                version=self.wallet_table.c.version + 1,
+            )
+            await self.database.execute(query)
+            return True
+
+    def _to_model(self, hold_dict: t.Mapping[str, t.Any]) -> models.HoldDB:
+        hold = self.db_model(**hold_dict)
+        hold.value = models.from_storage_amount(hold.value)
+        return hold
+
+
+class WebhookEndpointDatabaseAdapter:
+    def __init__(self, database: Database, table: Table):
+        self.database = database
+        self.table = table
+
+    @tracing.traced
+    async def set(self, user_id: UUID4, url: str):
+        query = insert(self.table).values(user_id=user_id, url=url).on_conflict_do_update(
+            index_elements=[self.table.c.user_id],
+            set_={'url': url},
+        )
+        await self.database.execute(query)
+
+    @tracing.traced
+    async def get(self, user_id: UUID4) -> t.Optional[str]:
+        return await self.database.fetch_val(select([self.table.c.url]).where(self.table.c.user_id == user_id))
+
+    @tracing.traced
+    async def delete(self, user_id: UUID4):
+        await self.database.execute(self.table.delete().where(self.table.c.user_id == user_id))
+
+
+class OutboxDatabaseAdapter:
+    def __init__(self, db_model: t.Type[models.OutboxEventDB], database: Database, table: Table, endpoint_table: Table):
+        self.db_model = db_model
+        self.database = database
+        self.table = table
+        self.endpoint_table = endpoint_table
+
+    # One statement whatever the number of users, users without an endpoint get no rows
+    @tracing.traced
+    async def add(self, user_ids: t.Iterable[UUID4], payload: str, now: datetime.datetime):
+        endpoints = select([
+            self.endpoint_table.c.user_id,
+            self.endpoint_table.c.url,
+            literal(payload, Text),
+            literal(now, TIMESTAMP),
+            literal(now, TIMESTAMP),
+        ]).where(self.endpoint_table.c.user_id.in_(list(user_ids)))
+        query = self.table.insert().from_select([
+            self.table.c.user_id,
+            self.table.c.url,
+            self.table.c.payload,
+            self.table.c.created_at,
+            self.table.c.next_attempt_at,
+        ], endpoints)
+        await self.database.execute(query)
+
+    # Claimed events are hidden from other dispatchers until the lease runs out
+    async def claim(
+            self,
+            now: datetime.datetime,
+            limit: int,
+            lease: datetime.timedelta,
+    ) -> t.List[models.OutboxEventDB]:
+        claimable_ids = select([
+            self.table.c.id,
+        ]).where(
+            self.table.c.next_attempt_at <= now
+        ).order_by(self.table.c.next_attempt_at).limit(limit).with_for_update(skip_locked=True)
+        query = self.table.update().where(
+            self.table.c.id.in_(claimable_ids)
+        ).values(
+            attempts=self.table.c.attempts + 1,
+            next_attempt_at=now + lease,
+        ).returning(*self.table.c)
+        return [self.db_model(**event_dict) for event_dict in await self.database.fetch_all(query)]
+
+    async def delete(self, event_ids: t.List[int]):
+        await self.database.execute(self.table.delete().where(self.table.c.id.in_(event_ids)))
+
+    # Events rescheduled without a time are parked and have to be requeued by hand
+    async def reschedule(self, event_ids: t.List[int], next_attempt_at: t.Optional[datetime.datetime]):
+        query = self.table.update().where(self.table.c.id.in_(event_ids)).values(next_attempt_at=next_attempt_at)
+        await self.database.execute(query)
+
+
+# noinspection PyPropertyAccess
+class ExportJobDatabaseAdapter:
+    def __init__(
+            self,
+            db_model: t.Type[models.ExportJobDB],
+            database: Database,
+            table: Table,
+    ):
+        self.db_model = db_model
+        self.database = database
+        self.table = table
+
+    @tracing.traced
+    async def create(self, job: models.ExportJobDB) -> UUID4:
+        query = self.table.insert(values={
+            'id': uuid.uuid4(),
+            'user_id': job.user_id,
+            'wallet_id': job.wallet_id,
+            'from_timestamp': job.from_timestamp,
+            'to_timestamp': job.to_timestamp,
+            'side': job.side.value if job.side else None,
+            'status': job.status.value,
+            'rows_written': job.rows_written,
+            'created_at': job.created_at,
+            'updated_at': job.updated_at,
+        }).returning(self.table.c.id)
+        return await self.database.fetch_val(query)
+
+    @tracing.traced
+    async def get(self, job_id: UUID4) -> t.Optional[models.ExportJobDB]:
+        query = self.table.select().where(self.table.c.id == job_id)
+        job_dict = await self.database.fetch_one(query)
+        return self.db_model(**job_dict) if job_dict else None
+
+    async def claim(self, stale_after: datetime.timedelta) -> t.Optional[models.ExportJobDB]:
+        now = datetime.datetime.utcnow()
+        claimable_id = self.table.select().where(or_(
+            self.table.c.status == enums.ExportJobStatus.pending.value,
+            and_(
+                self.table.c.status == enums.ExportJobStatus.running.value,
+                self.table.c.updated_at < now - stale_after,
+            ),
+        )).with_only_columns([
+            self.table.c.id,
+        ]).order_by(self.table.c.created_at).limit(1).with_for_update(skip_locked=True)
+        query = self.table.update(
+            self.table.c.id == claimable_id.as_scalar()
+        ).values(
+            status=enums.ExportJobStatus.running.value,
+            rows_written=0,
+            updated_at=now,
+        ).returning(*self.table.c)
+        job_dict = await self.database.fetch_one(query)
+        return self.db_model(**job_dict) if job_dict else None
+
+    async def update_progress(self, job_id: UUID4, rows_written: int, rows_total: int = None):
+        values = {'rows_written': rows_written, 'updated_at': datetime.datetime.utcnow()}
+        if rows_total is not None:
+            values['rows_total'] = rows_total
+        await self.database.execute(self.table.update(self.table.c.id == job_id).values(values))
+
+    async def finish(self, job_id: UUID4, status: enums.ExportJobStatus, expires_at: datetime.datetime):
+        query = self.table.update(
+            self.table.c.id == job_id
+        ).values(
+            status=status.value,
+            updated_at=datetime.datetime.utcnow(),
+            expires_at=expires_at,
+        )
+        await self.database.execute(query)
 
-        transaction_dicts = await self.database.fetch_all(query)
-        return [models.TransactionDB(**transaction_dict) for transaction_dict in transaction_dicts]
+    async def delete_expired(self, now: datetime.datetime) -> t.List[UUID4]:
+        query = self.table.delete().where(self.table.c.expires_at < now).returning(self.table.c.id)
+        job_dicts = await self.database.fetch_all(query)
+        return [job_dict['id'] for job_dict in job_dicts]
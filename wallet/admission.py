@@ -0,0 +1,149 @@
+import collections
+import contextlib
+import math
+import time
+import typing as t
+
+import asyncpg
+from databases import Database
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import metrics
+import shards
+import tracing
+from services import make_simple_error_message
+
+
+REJECTIONS = metrics.Counter('admission_rejections_total', 'Requests rejected by admission control')
+POOL_WAIT = metrics.Gauge('admission_pool_wait_seconds', 'Smoothed time spent waiting for a DB connection')
+
+
+def reject(status_code: int, msg: str, retry_after: float, limiter: str):
+    REJECTIONS.inc(limiter=limiter, status_code=status_code)
+    raise HTTPException(
+        status_code=status_code,
+        detail=make_simple_error_message(msg),
+        headers={'Retry-After': str(max(math.ceil(retry_after), 1))},
+    )
+
+
+# Lock waits and statements cut short by the timeouts are rejected at once, so clients back off instead of piling up
+@contextlib.contextmanager
+def fail_fast(name: str, retry_after: float):
+    try:
+        yield
+    except asyncpg.LockNotAvailableError:
+        reject(409, 'Wallet is busy', retry_after, name)
+    except asyncpg.QueryCanceledError:
+        reject(503, 'Request timed out', retry_after, name)
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated_at')
+
+    def __init__(self, capacity: float):
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+
+class RateLimiter:
+    def __init__(self, name: str, rate: float, burst: int, max_keys: int):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: t.MutableMapping[t.Any, TokenBucket] = collections.OrderedDict()
+
+    def check(self, key: t.Any):
+        if self.rate <= 0:
+            return
+        bucket = self._buckets.pop(key, None) or TokenBucket(self.burst)
+        self._buckets[key] = bucket
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+        now = time.monotonic()
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated_at) * self.rate)
+        bucket.updated_at = now
+        if bucket.tokens < 1:
+            reject(429, 'Too many requests', (1 - bucket.tokens) / self.rate, self.name)
+        bucket.tokens -= 1
+
+
+class ConcurrencyLimiter:
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+
+    async def __call__(self):
+        if 0 < self.limit <= self.active:
+            reject(503, 'Too many concurrent requests', 1, self.name)
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+
+
+# Holds one pooled connection for the whole request and sheds load once acquiring it gets slow or too many requests
+# queue for it. The wait estimate decays while requests are being shed, so admission resumes by itself.
+class PoolGuard:
+    def __init__(self, name: str, database: Database, threshold: float, half_life: float = 1.0, max_waiting: int = 0):
+        self.name = name
+        self.database = database
+        self.threshold = threshold
+        self.half_life = half_life
+        self.max_waiting = max_waiting
+        self.wait = 0.0
+        self.updated_at = time.monotonic()
+        self.waiting = 0
+
+    def _decayed_wait(self, now: float) -> float:
+        return self.wait * 0.5 ** ((now - self.updated_at) / self.half_life)
+
+    async def __call__(self):
+        async with self.acquire():
+            yield
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        now = time.monotonic()
+        if 0 < self.threshold < self._decayed_wait(now) or 0 < self.max_waiting <= self.waiting:
+            reject(503, 'Service overloaded', self.half_life, self.name)
+        acquire_span = tracing.start_span('db.pool.acquire', pool=self.name)
+        async with contextlib.AsyncExitStack() as stack:
+            self.waiting += 1
+            try:
+                await stack.enter_async_context(self.database.connection())
+            finally:
+                self.waiting -= 1
+            acquire_span.end()
+            acquired_at = time.monotonic()
+            self.wait = max(self._decayed_wait(acquired_at), acquired_at - now)
+            self.updated_at = acquired_at
+            POOL_WAIT.set(self.wait, pool=self.name)
+            yield
+
+
+# One guard per shard, picked by the wallet of the request path, so that a slow shard sheds its own requests and the
+# connection held for the request is the one its queries run on. Requests not about one wallet use the first shard.
+class ShardedPoolGuard:
+    def __init__(self, name: str, router: shards.ShardRouter, threshold: float, **kwargs):
+        self.router = router
+        self.guards = [
+            PoolGuard(name if len(router.databases) == 1 else f'{name}-{index}', database, threshold, **kwargs)
+            for index, database in enumerate(router.databases)
+        ]
+
+    def get_guard(self, wallet_id: t.Optional[str]) -> PoolGuard:
+        # Malformed ids are rejected later by path validation
+        with contextlib.suppress(ValueError):
+            if wallet_id:
+                return self.guards[self.router.get_index(wallet_id)]
+        return self.guards[0]
+
+    async def __call__(self, request: Request):
+        async with self.get_guard(request.path_params.get('wallet_id')).acquire():
+            yield
@@ -0,0 +1,48 @@
+import datetime
+import decimal
+import typing as t
+import uuid
+import zlib
+
+from pydantic.types import UUID4
+
+
+# Archived wallet entries are stored per wallet in batches of tab separated lines, compressed with zlib
+def encode_entries(entries: t.Iterable[t.Mapping[str, t.Any]]) -> bytes:
+    lines = (
+        '\t'.join((
+            entry['timestamp'].isoformat(),
+            str(entry['transaction_id']),
+            str(entry['counterparty_wallet_id'] or ''),
+            str(entry['value']),
+        ))
+        for entry in entries
+    )
+    return zlib.compress('\n'.join(lines).encode())
+
+
+def decode_entries(wallet_id: UUID4, data: bytes) -> t.List[t.Dict[str, t.Any]]:
+    entries = []
+    for line in zlib.decompress(data).decode().split('\n'):
+        timestamp, transaction_id, counterparty_wallet_id, value = line.split('\t')
+        entries.append({
+            'wallet_id': wallet_id,
+            'timestamp': datetime.datetime.fromisoformat(timestamp),
+            'transaction_id': int(transaction_id),
+            'counterparty_wallet_id': uuid.UUID(counterparty_wallet_id) if counterparty_wallet_id else None,
+            'value': decimal.Decimal(value),
+        })
+    return entries
+
+
+# Rewrites the amounts of a batch in other units: positive places convert to minor units, see tools/migrate_amounts.py
+def rescale_entries(data: bytes, places: int) -> bytes:
+    entries = decode_entries(None, data)
+    for entry in entries:
+        value = entry['value'].scaleb(places)
+        if places > 0:
+            if value != value.to_integral_value():
+                raise ValueError(f'Archived value {entry["value"]} has more than {places} decimal places')
+            value = int(value)
+        entry['value'] = value
+    return encode_entries(entries)
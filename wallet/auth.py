@@ -1,17 +1,73 @@
+import typing as t
+
 import databases
-from fastapi import FastAPI
+from fastapi import APIRouter, FastAPI, HTTPException
+from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_users import FastAPIUsers
 from fastapi_users.authentication import JWTAuthentication
-from fastapi_users.db import SQLAlchemyUserDatabase
+from fastapi_users.db import BaseUserDatabase, SQLAlchemyUserDatabase
+from fastapi_users.router.common import ErrorCode
+from sqlalchemy import Table
 
 import config
 import models
 import tables
+import tracing
+from passwords import PasswordHasher
+
+
+class TracedJWTAuthentication(JWTAuthentication):
+    async def __call__(self, credentials: t.Optional[str], user_db: BaseUserDatabase) -> t.Optional[models.UserDB]:
+        with tracing.span('auth.jwt'):
+            return await super().__call__(credentials, user_db)
+
+
+class UserDatabase(SQLAlchemyUserDatabase):
+    def __init__(
+            self,
+            user_db_model: t.Type[models.UserDB],
+            database: databases.Database,
+            users: Table,
+            password_hasher: PasswordHasher,
+    ):
+        super().__init__(user_db_model, database, users)
+        self.password_hasher = password_hasher
+
+    async def authenticate(self, credentials: OAuth2PasswordRequestForm) -> t.Optional[models.UserDB]:
+        user = await self.get_by_email(credentials.username)
+        if user is None:
+            # Hash anyway, so that response time does not reveal whether the email is registered
+            await self.password_hasher.hash(credentials.password)
+            return None
+        verified, updated_password_hash = await self.password_hasher.verify_and_update(
+            credentials.password, user.hashed_password,
+        )
+        if not verified:
+            return None
+        if updated_password_hash is not None:
+            user.hashed_password = updated_password_hash
+            await self.update(user)
+        return user
+
+
+def get_register_router(user_db: UserDatabase) -> APIRouter:
+    router = APIRouter()
+
+    @router.post('/register', response_model=models.User, status_code=201)
+    async def register(user: models.UserCreate):
+        existing_user = await user_db.get_by_email(user.email)
+        if existing_user is not None:
+            raise HTTPException(status_code=400, detail=ErrorCode.REGISTER_USER_ALREADY_EXISTS)
+        hashed_password = await user_db.password_hasher.hash(user.password)
+        return await user_db.create(models.UserDB(**user.create_update_dict(), hashed_password=hashed_password))
+
+    return router
 
 
 def setup_auth(app: FastAPI, database: databases.Database):
-    user_db = SQLAlchemyUserDatabase(models.UserDB, database, tables.users)
-    jwt_authentication = JWTAuthentication(
+    password_hasher = PasswordHasher(config.PASSWORD_HASH_WORKERS, config.PASSWORD_HASH_MAX_PENDING)
+    user_db = UserDatabase(models.UserDB, database, tables.users, password_hasher)
+    jwt_authentication = TracedJWTAuthentication(
         secret=config.JWT_SECRET, lifetime_seconds=config.JWT_LIFETIME, tokenUrl="/auth/jwt/login"
     )
     fastapi_users = FastAPIUsers(
@@ -21,7 +77,7 @@ def setup_auth(app: FastAPI, database: databases.Database):
         fastapi_users.get_auth_router(jwt_authentication), prefix="/auth/jwt", tags=["auth"]
     )
     app.include_router(
-        fastapi_users.get_register_router(), prefix="/auth", tags=["auth"]
+        get_register_router(user_db), prefix="/auth", tags=["auth"]
     )
     app.include_router(
         fastapi_users.get_reset_password_router(config.JWT_SECRET),
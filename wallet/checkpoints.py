@@ -0,0 +1,67 @@
+import asyncio
+import datetime
+import logging
+import typing as t
+
+import adapters
+import metrics
+
+
+_LOGGER = logging.getLogger(__name__)
+
+CHECKPOINTS = metrics.Counter('balance_checkpoints_total', 'Wallet balance checkpoints written')
+
+
+# Every worker process runs a writer, but a pass only happens in the one holding the advisory lock.
+# Wallets are walked in id order, so a pass touches every wallet once and a crash loses at most one batch.
+class BalanceCheckpointer:
+    def __init__(
+            self,
+            db_adapter: adapters.BalanceCheckpointDatabaseAdapter,
+            interval: float,
+            batch_size: int,
+            min_entries: int,
+            settle_seconds: int,
+    ):
+        self.db_adapter = db_adapter
+        self.interval = interval
+        self.batch_size = batch_size
+        self.min_entries = min_entries
+        self.settle_seconds = settle_seconds
+        self._task: t.Optional[asyncio.Future] = None
+
+    def start(self):
+        if self.interval > 0:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run()
+            except Exception:
+                _LOGGER.exception('Balance checkpoint pass failed')
+
+    async def run(self) -> t.Optional[int]:
+        settled_until = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.settle_seconds)
+        async with self.db_adapter.lock_writer() as locked:
+            if not locked:
+                return None
+            written = 0
+            after = None
+            while True:
+                wallet_ids = await self.db_adapter.get_wallet_ids(after, self.batch_size)
+                if not wallet_ids:
+                    break
+                count = await self.db_adapter.write(wallet_ids, settled_until, self.min_entries)
+                CHECKPOINTS.inc(count)
+                written += count
+                after = wallet_ids[-1]
+            _LOGGER.info(f'Wrote {written} balance checkpoints up to {settled_until}')
+            return written
@@ -1,6 +1,131 @@
-from decouple import config
+import os
+import tempfile
+
+from decouple import Csv, config
 
 APP_PORT = config('APP_PORT', default=8080, cast=int)
+APP_WORKERS = config('APP_WORKERS', default=1, cast=int)
+APP_LOOP = config('APP_LOOP', default='uvloop')
+APP_HTTP = config('APP_HTTP', default='httptools')
+APP_GRACEFUL_TIMEOUT = config('APP_GRACEFUL_TIMEOUT', default=30, cast=int)
+
+WALLET_LIST_MAX_LIMIT = config('WALLET_LIST_MAX_LIMIT', default=1000, cast=int)
+# 'random' or 'time_ordered' (see ids.py), existing ids keep working with either
+WALLET_ID_STRATEGY = config('WALLET_ID_STRATEGY', default='random')
+
+# Store balances and transaction values as BIGINT units of 1e-8, the schema is converted by tools/migrate_amounts.py
+AMOUNTS_AS_MINOR_UNITS = config('AMOUNTS_AS_MINOR_UNITS', default=False, cast=bool)
+
+# Read history from wallet_entry_archive too, enable once tools/archive_transactions.py has been run
+TRANSACTION_ARCHIVE_ENABLED = config('TRANSACTION_ARCHIVE_ENABLED', default=False, cast=bool)
+TRANSACTION_ARCHIVE_BATCH_SIZE = config('TRANSACTION_ARCHIVE_BATCH_SIZE', default=10000, cast=int)
+
+# Per-wallet balance checkpoints behind point-in-time balance queries, written by one worker process at a time.
+# A wallet gets a new checkpoint once this many settled entries follow its last one, 0 interval disables the writer.
+BALANCE_CHECKPOINT_INTERVAL = config('BALANCE_CHECKPOINT_INTERVAL', default=3600.0, cast=float)
+BALANCE_CHECKPOINT_MIN_ENTRIES = config('BALANCE_CHECKPOINT_MIN_ENTRIES', default=1000, cast=int)
+BALANCE_CHECKPOINT_BATCH_SIZE = config('BALANCE_CHECKPOINT_BATCH_SIZE', default=1000, cast=int)
+# Transactions get their timestamp before commit, so only entries older than this are checkpointed
+BALANCE_CHECKPOINT_SETTLE_SECONDS = config('BALANCE_CHECKPOINT_SETTLE_SECONDS', default=60, cast=int)
+BALANCE_QUERY_MAX_WALLETS = config('BALANCE_QUERY_MAX_WALLETS', default=1000, cast=int)
+
+# Granularity of per-wallet spending limit windows, has to divide a day. Windows may count up to one bucket more.
+SPENDING_LIMIT_BUCKET_SECONDS = config('SPENDING_LIMIT_BUCKET_SECONDS', default=300, cast=int)
+
+# Per-user token bucket for money-moving and wallet-creating requests, 0 rate disables it
+ADMISSION_MUTATION_RATE = config('ADMISSION_MUTATION_RATE', default=10.0, cast=float)
+ADMISSION_MUTATION_BURST = config('ADMISSION_MUTATION_BURST', default=20, cast=int)
+ADMISSION_MAX_TRACKED_USERS = config('ADMISSION_MAX_TRACKED_USERS', default=100000, cast=int)
+# Concurrent exports per worker process, 0 disables the cap
+ADMISSION_EXPORT_CONCURRENCY = config('ADMISSION_EXPORT_CONCURRENCY', default=4, cast=int)
+# Requests are shed with 503 while DB pool acquisition takes longer than this many seconds, 0 disables it
+ADMISSION_POOL_WAIT_THRESHOLD = config('ADMISSION_POOL_WAIT_THRESHOLD', default=0.5, cast=float)
+# Requests queued for a connection of each DB pool, more are shed with 503, 0 disables it
+ADMISSION_WRITE_POOL_MAX_WAITING = config('ADMISSION_WRITE_POOL_MAX_WAITING', default=100, cast=int)
+ADMISSION_READ_POOL_MAX_WAITING = config('ADMISSION_READ_POOL_MAX_WAITING', default=50, cast=int)
+ADMISSION_EXPORT_POOL_MAX_WAITING = config('ADMISSION_EXPORT_POOL_MAX_WAITING', default=10, cast=int)
+
+# How deposits and transfers wait for a locked wallet row: 'wait' blocks, 'nowait' fails at once and 'timeout'
+# gives up after WALLET_LOCK_TIMEOUT_MS. Failed locks are answered with 409 and a Retry-After hint.
+WALLET_LOCK_MODE = config('WALLET_LOCK_MODE', default='wait')
+WALLET_LOCK_TIMEOUT_MS = config('WALLET_LOCK_TIMEOUT_MS', default=1000, cast=int)
+WALLET_LOCK_RETRY_AFTER = config('WALLET_LOCK_RETRY_AFTER', default=1.0, cast=float)
+# lock_timeout of cross-shard transfers in every lock mode: their locks are ordered, but a deadlock spanning shards
+# (e.g. with a hold or an expiry) is invisible to Postgres, so they never wait unbounded
+SHARD_TRANSFER_LOCK_TIMEOUT_MS = config('SHARD_TRANSFER_LOCK_TIMEOUT_MS', default=5000, cast=int)
+# 'pessimistic' or 'optimistic' (see enums.WalletConcurrency). With 'optimistic', wallets marked 'pessimistic' in
+# wallet.concurrency still take locks, and transfers fall back to locks after this many version conflicts.
+WALLET_CONCURRENCY = config('WALLET_CONCURRENCY', default='pessimistic')
+WALLET_OPTIMISTIC_RETRIES = config('WALLET_OPTIMISTIC_RETRIES', default=3, cast=int)
+# statement_timeout of every statement in the transaction of the endpoint, answered with 503 once hit, 0 disables it
+DEPOSIT_STATEMENT_TIMEOUT_MS = config('DEPOSIT_STATEMENT_TIMEOUT_MS', default=0, cast=int)
+TRANSFER_STATEMENT_TIMEOUT_MS = config('TRANSFER_STATEMENT_TIMEOUT_MS', default=0, cast=int)
+
+# Disk cache of exports with a closed range in the past, 0 size disables it
+EXPORT_CACHE_DIR = config('EXPORT_CACHE_DIR', default=os.path.join(tempfile.gettempdir(), 'wallet-export-cache'))
+EXPORT_CACHE_MAX_BYTES = config('EXPORT_CACHE_MAX_BYTES', default=1024 ** 3, cast=int)
+EXPORT_CACHE_SETTLE_SECONDS = config('EXPORT_CACHE_SETTLE_SECONDS', default=60, cast=int)
+
+# Exports of several wallets in one response. Pages of different wallets are read by up to
+# OPERATIONS_EXPORT_PARALLELISM queries at once, each over its own connection of the request pool,
+# and pages are sized so that about OPERATIONS_EXPORT_ROW_BUDGET rows are held in memory per export.
+OPERATIONS_EXPORT_MAX_WALLETS = config('OPERATIONS_EXPORT_MAX_WALLETS', default=1000, cast=int)
+OPERATIONS_EXPORT_PARALLELISM = config('OPERATIONS_EXPORT_PARALLELISM', default=4, cast=int)
+OPERATIONS_EXPORT_PAGE_SIZE = config('OPERATIONS_EXPORT_PAGE_SIZE', default=1000, cast=int)
+OPERATIONS_EXPORT_ROW_BUDGET = config('OPERATIONS_EXPORT_ROW_BUDGET', default=100000, cast=int)
+
+# Operations of one wallet spanning at least two OPERATIONS_PARALLEL_MIN_CHUNK_SECONDS are read in up to
+# OPERATIONS_PARALLEL_WORKERS time chunks at once, each over its own connection of the export pool but all in one
+# exported snapshot. A chunk ahead of the output buffers at most OPERATIONS_PARALLEL_BUFFER_PAGES pages.
+# 1 worker reads the whole range with one query, as does an export whose chunks do not all get a connection
+# within OPERATIONS_PARALLEL_ACQUIRE_TIMEOUT seconds.
+OPERATIONS_PARALLEL_WORKERS = config('OPERATIONS_PARALLEL_WORKERS', default=1, cast=int)
+OPERATIONS_PARALLEL_MIN_CHUNK_SECONDS = config('OPERATIONS_PARALLEL_MIN_CHUNK_SECONDS', default=7 * 86400, cast=int)
+OPERATIONS_PARALLEL_BUFFER_PAGES = config('OPERATIONS_PARALLEL_BUFFER_PAGES', default=2, cast=int)
+OPERATIONS_PARALLEL_ACQUIRE_TIMEOUT = config('OPERATIONS_PARALLEL_ACQUIRE_TIMEOUT', default=1.0, cast=float)
+
+# Background exports, run by every worker process on its own small connection pool shared with balance checkpoints
+EXPORT_JOBS_DIR = config('EXPORT_JOBS_DIR', default=os.path.join(tempfile.gettempdir(), 'wallet-export-jobs'))
+EXPORT_JOBS_WORKERS = config('EXPORT_JOBS_WORKERS', default=2, cast=int)
+EXPORT_JOBS_PAGE_SIZE = config('EXPORT_JOBS_PAGE_SIZE', default=10000, cast=int)
+EXPORT_JOBS_TTL_SECONDS = config('EXPORT_JOBS_TTL_SECONDS', default=86400, cast=int)
+EXPORT_JOBS_POLL_INTERVAL = config('EXPORT_JOBS_POLL_INTERVAL', default=5.0, cast=float)
+# Running jobs without progress for this long are considered abandoned by a dead process and retried
+EXPORT_JOBS_STALE_SECONDS = config('EXPORT_JOBS_STALE_SECONDS', default=300, cast=int)
+
+# Webhooks are delivered from the outbox_event table by a dispatcher per shard in every worker process.
+# Claimed events are retried after the lease when a process dies, so delivery is at least once.
+WEBHOOKS_BATCH_SIZE = config('WEBHOOKS_BATCH_SIZE', default=100, cast=int)
+WEBHOOKS_EVENTS_PER_REQUEST = config('WEBHOOKS_EVENTS_PER_REQUEST', default=20, cast=int)
+WEBHOOKS_ENDPOINT_CONCURRENCY = config('WEBHOOKS_ENDPOINT_CONCURRENCY', default=2, cast=int)
+WEBHOOKS_MAX_CONNECTIONS = config('WEBHOOKS_MAX_CONNECTIONS', default=100, cast=int)
+WEBHOOKS_TIMEOUT = config('WEBHOOKS_TIMEOUT', default=10.0, cast=float)
+WEBHOOKS_MAX_ATTEMPTS = config('WEBHOOKS_MAX_ATTEMPTS', default=10, cast=int)
+WEBHOOKS_RETRY_BASE_SECONDS = config('WEBHOOKS_RETRY_BASE_SECONDS', default=5.0, cast=float)
+WEBHOOKS_RETRY_MAX_SECONDS = config('WEBHOOKS_RETRY_MAX_SECONDS', default=3600.0, cast=float)
+WEBHOOKS_LEASE_SECONDS = config('WEBHOOKS_LEASE_SECONDS', default=60, cast=int)
+WEBHOOKS_POLL_INTERVAL = config('WEBHOOKS_POLL_INTERVAL', default=1.0, cast=float)
+
+# Holds reserve funds of a wallet until captured, released or expired. Every worker process keeps the holds due within
+# HOLDS_EXPIRY_HORIZON_SECONDS in memory, loading up to HOLDS_EXPIRY_BATCH_SIZE of them per shard every
+# HOLDS_EXPIRY_LOAD_INTERVAL seconds, and expires them on time.
+HOLDS_DEFAULT_TTL_SECONDS = config('HOLDS_DEFAULT_TTL_SECONDS', default=7 * 86400, cast=int)
+HOLDS_MAX_TTL_SECONDS = config('HOLDS_MAX_TTL_SECONDS', default=30 * 86400, cast=int)
+HOLDS_EXPIRY_HORIZON_SECONDS = config('HOLDS_EXPIRY_HORIZON_SECONDS', default=300, cast=int)
+HOLDS_EXPIRY_LOAD_INTERVAL = config('HOLDS_EXPIRY_LOAD_INTERVAL', default=60.0, cast=float)
+HOLDS_EXPIRY_BATCH_SIZE = config('HOLDS_EXPIRY_BATCH_SIZE', default=1000, cast=int)
+
+# Spans are exported to a JSON lines file or an OTLP/HTTP collector, 'none' disables tracing
+TRACING_EXPORTER = config('TRACING_EXPORTER', default='none')
+# Share of requests without incoming trace context that are traced
+TRACING_SAMPLE_RATIO = config('TRACING_SAMPLE_RATIO', default=0.01, cast=float)
+TRACING_FILE = config('TRACING_FILE', default=os.path.join(tempfile.gettempdir(), 'wallet-traces.jsonl'))
+TRACING_OTLP_ENDPOINT = config('TRACING_OTLP_ENDPOINT', default='http://127.0.0.1:4318')
+TRACING_SERVICE_NAME = config('TRACING_SERVICE_NAME', default='wallet')
+
+# bcrypt runs in a thread pool of every worker process, checks beyond the pending limit get 503
+PASSWORD_HASH_WORKERS = config('PASSWORD_HASH_WORKERS', default=max((os.cpu_count() or 1) // APP_WORKERS, 1), cast=int)
+PASSWORD_HASH_MAX_PENDING = config('PASSWORD_HASH_MAX_PENDING', default=64, cast=int)
 
 JWT_SECRET = config('JWT_SECRET', default='SECRET')
 JWT_LIFETIME = config('JWT_LIFETIME', default=315360000, cast=int)
@@ -11,3 +136,38 @@ POSTGRES_PASSWORD = config('POSTGRES_PASSWORD', default='wallet')
 POSTGRES_DB = config('POSTGRES_DB', default='wallet')
 
 POSTGRES_DSN = f'postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}/{POSTGRES_DB}'
+# Wallets, their history and checkpoints are spread over POSTGRES_DSN and these databases by a hash of the wallet id,
+# users and export jobs stay in POSTGRES_DSN. Shards cannot be added to a database with wallets.
+POSTGRES_SHARD_DSNS = [POSTGRES_DSN] + config('POSTGRES_EXTRA_SHARD_DSNS', default='', cast=Csv())
+
+# Connection budget of the whole deployment per database, split evenly between worker processes.
+# Each export job worker, the balance checkpoint writer, the webhook dispatcher and the hold expiry scheduler hold
+# at most one connection, taken out of the process share.
+POSTGRES_MAX_CONNECTIONS = config('POSTGRES_MAX_CONNECTIONS', default=80, cast=int)
+POSTGRES_POOL_MIN_SIZE = config('POSTGRES_POOL_MIN_SIZE', default=1, cast=int)
+POSTGRES_POOL_MAX_SIZE = config(
+    'POSTGRES_POOL_MAX_SIZE',
+    default=max(POSTGRES_MAX_CONNECTIONS // APP_WORKERS - EXPORT_JOBS_WORKERS - 3, 1),
+    cast=int,
+)
+# The process share is split between pools of money movement (writes), point reads and long exports or reports, so
+# that exports holding connections cannot make transfers wait. statement_timeout is set on every connection of a pool,
+# 0 disables it. Transactions of deposits and transfers override it with *_STATEMENT_TIMEOUT_MS when those are set.
+POSTGRES_EXPORT_POOL_MAX_SIZE = config(
+    'POSTGRES_EXPORT_POOL_MAX_SIZE',
+    default=max(POSTGRES_POOL_MAX_SIZE // 4, 1),
+    cast=int,
+)
+POSTGRES_READ_POOL_MAX_SIZE = config(
+    'POSTGRES_READ_POOL_MAX_SIZE',
+    default=max((POSTGRES_POOL_MAX_SIZE - POSTGRES_EXPORT_POOL_MAX_SIZE) // 2, 1),
+    cast=int,
+)
+POSTGRES_WRITE_POOL_MAX_SIZE = config(
+    'POSTGRES_WRITE_POOL_MAX_SIZE',
+    default=max(POSTGRES_POOL_MAX_SIZE - POSTGRES_EXPORT_POOL_MAX_SIZE - POSTGRES_READ_POOL_MAX_SIZE, 1),
+    cast=int,
+)
+POSTGRES_WRITE_STATEMENT_TIMEOUT_MS = config('POSTGRES_WRITE_STATEMENT_TIMEOUT_MS', default=0, cast=int)
+POSTGRES_READ_STATEMENT_TIMEOUT_MS = config('POSTGRES_READ_STATEMENT_TIMEOUT_MS', default=5000, cast=int)
+POSTGRES_EXPORT_STATEMENT_TIMEOUT_MS = config('POSTGRES_EXPORT_STATEMENT_TIMEOUT_MS', default=60000, cast=int)
@@ -4,3 +4,45 @@ from enum import Enum
 class TransferSide(str, Enum):
     deposit = 'deposit'
     withdraw = 'withdraw'
+
+
+class WalletLockMode(str, Enum):
+    wait = 'wait'
+    nowait = 'nowait'
+    timeout = 'timeout'
+
+
+# Pessimistic transfers lock both wallets before reading them. Optimistic ones read without locks and debit the
+# sender only if its version is unchanged, so the sender row is locked from the debit to the commit only.
+class WalletConcurrency(str, Enum):
+    pessimistic = 'pessimistic'
+    optimistic = 'optimistic'
+
+
+class ExportFormat(str, Enum):
+    csv = 'csv'
+    zip = 'zip'
+
+
+class ExportJobStatus(str, Enum):
+    pending = 'pending'
+    running = 'running'
+    done = 'done'
+    failed = 'failed'
+
+
+class SpendingLimitWindow(str, Enum):
+    hourly = 'hourly'
+    daily = 'daily'
+
+
+class HoldStatus(str, Enum):
+    held = 'held'
+    captured = 'captured'
+    released = 'released'
+    expired = 'expired'
+
+
+class WebhookEventType(str, Enum):
+    deposit = 'deposit'
+    transfer = 'transfer'
@@ -0,0 +1,97 @@
+import contextlib
+import datetime
+import hashlib
+import os
+import typing as t
+import uuid
+from functools import partial
+from io import StringIO
+
+import aiofiles
+
+import metrics
+from services import to_naive_utc
+
+
+CHUNK_SIZE = 64 * 1024
+
+HITS = metrics.Counter('export_cache_hits_total', 'Exports served from the disk cache')
+MISSES = metrics.Counter('export_cache_misses_total', 'Cacheable exports rendered from the database')
+EVICTIONS = metrics.Counter('export_cache_evictions_total', 'Cached exports removed to stay within the size limit')
+
+
+# Content-addressed cache of rendered exports whose range is closed in the past and so can never change.
+# Files are touched on every hit, so eviction by mtime is LRU; several worker processes may share the directory.
+class ExportCache:
+    def __init__(self, directory: str, max_bytes: int, settle_seconds: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Transactions get their timestamp before they commit, so the most recent past is not final yet
+        self.settle_seconds = settle_seconds
+
+    def is_cacheable(self, to_timestamp: t.Optional[datetime.datetime]) -> bool:
+        if self.max_bytes <= 0 or to_timestamp is None:
+            return False
+        settled_until = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.settle_seconds)
+        return to_naive_utc(to_timestamp) < settled_until
+
+    def make_path(self, *key_parts: t.Any) -> str:
+        key_parts = tuple(to_naive_utc(part) if isinstance(part, datetime.datetime) else part for part in key_parts)
+        digest = hashlib.sha256('\x1f'.join(str(part) for part in key_parts).encode()).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def get(self, path: str) -> t.Optional[str]:
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            MISSES.inc()
+            return None
+        HITS.inc()
+        return path
+
+    async def fill(self, path: str, content: t.Union[StringIO, t.AsyncIterator[str]]) -> t.AsyncIterator[bytes]:
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            async with aiofiles.open(temporary_path, 'wb') as file:
+                async for chunk in self._read_chunks(content):
+                    data = chunk.encode()
+                    await file.write(data)
+                    yield data
+        except BaseException:
+            # The file is not there when opening it failed, the original error is the one to raise
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temporary_path)
+            raise
+        os.replace(temporary_path, path)
+        self.evict()
+
+    @staticmethod
+    async def _read_chunks(content: t.Union[StringIO, t.AsyncIterator[str]]) -> t.AsyncIterator[str]:
+        if isinstance(content, StringIO):
+            for chunk in iter(partial(content.read, CHUNK_SIZE), ''):
+                yield chunk
+        else:
+            async for chunk in content:
+                yield chunk
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            EVICTIONS.inc()
@@ -0,0 +1,135 @@
+import asyncio
+import datetime
+import logging
+import os
+import typing as t
+import uuid
+
+import aiofiles
+from pydantic.types import UUID4
+
+import adapters
+import enums
+import metrics
+import models
+from services import make_csv_stream
+
+
+_LOGGER = logging.getLogger(__name__)
+
+JOBS = metrics.Counter('export_jobs_total', 'Background exports finished, by status')
+ROWS = metrics.Counter('export_jobs_rows_total', 'Rows written by background exports')
+
+
+# Fixed number of worker coroutines per process, fed from the export_job table.
+# Rows are read page by page so that no connection is held between pages and progress can be reported.
+class ExportJobRunner:
+    def __init__(
+            self,
+            job_db_adapter: adapters.ExportJobDatabaseAdapter,
+            transaction_db_adapter: adapters.TransactionDatabaseAdapter,
+            directory: str,
+            workers: int,
+            page_size: int,
+            ttl_seconds: int,
+            poll_interval: float,
+            stale_seconds: int,
+    ):
+        self.job_db_adapter = job_db_adapter
+        self.transaction_db_adapter = transaction_db_adapter
+        self.directory = directory
+        self.workers = workers
+        self.page_size = page_size
+        self.ttl_seconds = ttl_seconds
+        self.poll_interval = poll_interval
+        self.stale_seconds = stale_seconds
+        self._tasks: t.List[asyncio.Future] = []
+        self._wakeup: t.Optional[asyncio.Event] = None
+
+    def make_path(self, job_id: UUID4) -> str:
+        return os.path.join(self.directory, f'{job_id}.csv')
+
+    def start(self):
+        # The event is bound to the running loop, so it cannot be created at import time
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self):
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _work(self):
+        stale_after = datetime.timedelta(seconds=self.stale_seconds)
+        while True:
+            try:
+                job = await self.job_db_adapter.claim(stale_after)
+                if job:
+                    await self.run(job)
+                    continue
+                await self.remove_expired()
+            except Exception:
+                _LOGGER.exception('Export job worker failed')
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def run(self, job: models.ExportJobDB):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.make_path(job.id)
+        temporary_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            await self._export(job, temporary_path)
+            os.replace(temporary_path, path)
+            status = enums.ExportJobStatus.done
+        except Exception:
+            _LOGGER.exception(f'Export job {job.id} failed')
+            status = enums.ExportJobStatus.failed
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttl_seconds)
+        await self.job_db_adapter.finish(job.id, status, expires_at)
+        JOBS.inc(status=status.value)
+
+    async def _export(self, job: models.ExportJobDB, path: str):
+        rows_total = await self.transaction_db_adapter.count(
+            wallet_id=job.wallet_id,
+            from_timestamp=job.from_timestamp,
+            to_timestamp=job.to_timestamp,
+            transfer_side=job.side,
+        )
+        await self.job_db_adapter.update_progress(job.id, 0, rows_total)
+        rows_written = 0
+        after = None
+        async with aiofiles.open(path, 'w', newline='') as file:
+            while True:
+                transactions = await self.transaction_db_adapter.get_page(
+                    wallet_id=job.wallet_id,
+                    from_timestamp=job.from_timestamp,
+                    to_timestamp=job.to_timestamp,
+                    transfer_side=job.side,
+                    after=after,
+                    limit=self.page_size,
+                )
+                await file.write(make_csv_stream(transactions, header=after is None).getvalue())
+                rows_written += len(transactions)
+                ROWS.inc(len(transactions))
+                await self.job_db_adapter.update_progress(job.id, rows_written)
+                if len(transactions) < self.page_size:
+                    break
+                after = (transactions[-1].timestamp, transactions[-1].id)
+
+    async def remove_expired(self):
+        for job_id in await self.job_db_adapter.delete_expired(datetime.datetime.utcnow()):
+            try:
+                os.remove(self.make_path(job_id))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,9 @@
+import config
+
+
+bind = f'0.0.0.0:{config.APP_PORT}'
+workers = config.APP_WORKERS
+worker_class = 'workers.UvicornWorker'
+graceful_timeout = config.APP_GRACEFUL_TIMEOUT
+# Each worker imports the app on its own, so startup/shutdown hooks and the DB pool are per-process
+preload_app = False
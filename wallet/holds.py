@@ -0,0 +1,100 @@
+import asyncio
+import datetime
+import heapq
+import logging
+import typing as t
+
+from pydantic.types import UUID4
+
+import adapters
+import metrics
+
+
+_LOGGER = logging.getLogger(__name__)
+
+EXPIRED = metrics.Counter('wallet_holds_expired_total', 'Holds expired by the scheduler')
+
+
+# Holds due within the horizon are kept in a heap by expiry time and expired right when due, instead of
+# polling the table. The heap is refilled from the partial index every load interval and holds made in this
+# process are added on creation. Every worker process runs a scheduler: expiry is a conditional update, so a hold
+# expired elsewhere, captured or released is skipped, and one whose expiry failed is found again by the next load.
+class HoldExpiryScheduler:
+    def __init__(
+            self,
+            db_adapters: t.List[adapters.HoldDatabaseAdapter],
+            horizon_seconds: int,
+            load_interval: float,
+            batch_size: int,
+    ):
+        self.db_adapters = db_adapters
+        self.horizon_seconds = horizon_seconds
+        self.load_interval = load_interval
+        self.batch_size = batch_size
+        self._heap: t.List[t.Tuple[datetime.datetime, UUID4, int]] = []
+        self._scheduled: t.Set[UUID4] = set()
+        self._wakeup: t.Optional[asyncio.Event] = None
+        self._task: t.Optional[asyncio.Future] = None
+
+    def start(self):
+        if self.load_interval > 0:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def schedule(self, shard_index: int, hold_id: UUID4, expires_at: datetime.datetime):
+        horizon = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.horizon_seconds)
+        if hold_id in self._scheduled or expires_at > horizon:
+            return
+        heapq.heappush(self._heap, (expires_at, hold_id, shard_index))
+        self._scheduled.add(hold_id)
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def load(self) -> int:
+        until = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.horizon_seconds)
+        loaded = 0
+        for shard_index, db_adapter in enumerate(self.db_adapters):
+            for hold in await db_adapter.get_expiring(until, self.batch_size):
+                self.schedule(shard_index, hold.id, hold.expires_at)
+                loaded += 1
+        return loaded
+
+    async def expire_due(self) -> int:
+        now = datetime.datetime.utcnow()
+        expired = 0
+        while self._heap and self._heap[0][0] <= now:
+            _, hold_id, shard_index = heapq.heappop(self._heap)
+            self._scheduled.discard(hold_id)
+            try:
+                if await self.db_adapters[shard_index].expire(hold_id, now):
+                    expired += 1
+            except Exception:
+                _LOGGER.warning(f'Expiring hold {hold_id} failed', exc_info=True)
+        EXPIRED.inc(expired)
+        return expired
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        next_load_at = loop.time()
+        while True:
+            if loop.time() >= next_load_at:
+                try:
+                    await self.load()
+                except Exception:
+                    _LOGGER.exception('Loading expiring holds failed')
+                next_load_at = loop.time() + self.load_interval
+            await self.expire_due()
+            timeout = next_load_at - loop.time()
+            if self._heap:
+                timeout = min(timeout, (self._heap[0][0] - datetime.datetime.utcnow()).total_seconds())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
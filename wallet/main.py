@@ -1,38 +1,252 @@
 import asyncio
 import datetime
+import decimal
+import os
 import typing as t
 
 import databases
 import uvicorn
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import Depends, FastAPI, Header, HTTPException, Query
 from fastapi.openapi.docs import get_swagger_ui_html
 from pydantic.types import UUID4
-from starlette.responses import RedirectResponse, StreamingResponse
+from starlette.responses import FileResponse, PlainTextResponse, RedirectResponse, Response, StreamingResponse
 from starlette.staticfiles import StaticFiles
 
 import adapters
+import admission
+import checkpoints
 import config
 import enums
+import export_cache
+import export_jobs
+import holds
+import metrics
 import models
+import operations_export
+import shards
 import tables
+import tracing
+import webhooks
 from auth import setup_auth
-from services import make_csv_stream, make_filename
+from services import (
+    etag_matches, find_exceeded_spending_limit, make_csv_stream, make_etag, make_export_job, make_filename,
+    make_simple_error_message,
+)
+
 
+def make_router(max_size: int, statement_timeout: int) -> shards.ShardRouter:
+    server_settings = {'statement_timeout': str(statement_timeout)} if statement_timeout else {}
+    return shards.ShardRouter([
+        databases.Database(
+            dsn, min_size=config.POSTGRES_POOL_MIN_SIZE, max_size=max_size, server_settings=server_settings,
+        )
+        for dsn in config.POSTGRES_SHARD_DSNS
+    ])
 
-db = databases.Database(config.POSTGRES_DSN)
+
+# Each workload gets pools of its own and adapters are built per pool: money movement and other writes, point reads,
+# and long exports or reports. Endpoints guard and read through the pool of their workload, so an export holding
+# connections for minutes leaves those of transfers alone.
+write_router = make_router(config.POSTGRES_WRITE_POOL_MAX_SIZE, config.POSTGRES_WRITE_STATEMENT_TIMEOUT_MS)
+read_router = make_router(config.POSTGRES_READ_POOL_MAX_SIZE, config.POSTGRES_READ_STATEMENT_TIMEOUT_MS)
+export_router = make_router(config.POSTGRES_EXPORT_POOL_MAX_SIZE, config.POSTGRES_EXPORT_STATEMENT_TIMEOUT_MS)
+db = write_router.databases[0]
+read_db = read_router.databases[0]
+# Export jobs, balance checkpoints, webhooks and hold expiry never compete with requests for connections
+background_router = shards.ShardRouter([
+    databases.Database(dsn, min_size=1, max_size=config.EXPORT_JOBS_WORKERS + 3)
+    for dsn in config.POSTGRES_SHARD_DSNS
+])
+background_db = background_router.databases[0]
+two_phase_commit = shards.TwoPhaseCommit(db, tables.shard_transactions)
 
 app = FastAPI()
-fastapi_users = setup_auth(app, db)
-wallet_db_adapter = adapters.WalletDatabaseAdapter(models.WalletDB, db, tables.wallets)
-transaction_db_adapter = adapters.TransactionDatabaseAdapter(models.TransactionDB, db, tables.transactions)
+tracer = tracing.Tracer(
+    tracing.make_exporter(
+        config.TRACING_EXPORTER,
+        path=config.TRACING_FILE,
+        endpoint=config.TRACING_OTLP_ENDPOINT,
+        service_name=config.TRACING_SERVICE_NAME,
+    ),
+    sample_ratio=config.TRACING_SAMPLE_RATIO,
+)
+app.add_middleware(tracing.TracingMiddleware, tracer=tracer)
+# Users are looked up on every authenticated request, which must not take connections of the write pool
+fastapi_users = setup_auth(app, read_db)
+wallet_entry_archives = tables.wallet_entry_archives if config.TRANSACTION_ARCHIVE_ENABLED else None
+wallet_archive_summaries = tables.wallet_archive_summaries if config.TRANSACTION_ARCHIVE_ENABLED else None
+
+
+def make_transaction_db_adapter(router: shards.ShardRouter) -> shards.ShardedTransactionDatabaseAdapter:
+    return shards.ShardedTransactionDatabaseAdapter(router, [
+        adapters.TransactionDatabaseAdapter(
+            models.TransactionDB, database, tables.transactions, tables.wallet_entries, wallet_entry_archives,
+        )
+        for database in router.databases
+    ])
+
+
+def make_balance_db_adapters(router: shards.ShardRouter) -> t.List[adapters.BalanceCheckpointDatabaseAdapter]:
+    return [
+        adapters.BalanceCheckpointDatabaseAdapter(
+            models.WalletBalanceDB, database, tables.wallet_balance_checkpoints, tables.wallets,
+            tables.wallet_entries, wallet_entry_archives, wallet_archive_summaries,
+        )
+        for database in router.databases
+    ]
+
+
+wallet_concurrency = enums.WalletConcurrency(config.WALLET_CONCURRENCY)
+wallet_lock_mode = enums.WalletLockMode(config.WALLET_LOCK_MODE)
+wallet_lock_timeout = config.WALLET_LOCK_TIMEOUT_MS if wallet_lock_mode is enums.WalletLockMode.timeout else 0
+
+
+def make_wallet_db_adapter(router: shards.ShardRouter) -> shards.ShardedWalletDatabaseAdapter:
+    return shards.ShardedWalletDatabaseAdapter(router, [
+        adapters.WalletDatabaseAdapter(
+            models.WalletDB, database, tables.wallets, lock_nowait=wallet_lock_mode is enums.WalletLockMode.nowait,
+        )
+        for database in router.databases
+    ], shards.TwoPhaseCommit(router.databases[0], tables.shard_transactions), tables.wallet_names)
+
+
+def make_spending_limit_db_adapter(router: shards.ShardRouter) -> shards.ShardedSpendingLimitDatabaseAdapter:
+    return shards.ShardedSpendingLimitDatabaseAdapter(router, [
+        adapters.SpendingLimitDatabaseAdapter(
+            models.SpendingLimitDB, database, tables.wallet_spending_limits, tables.wallet_spending_buckets,
+            config.SPENDING_LIMIT_BUCKET_SECONDS,
+        )
+        for database in router.databases
+    ])
+
+
+def make_webhook_endpoint_db_adapter(router: shards.ShardRouter) -> shards.ShardedWebhookEndpointDatabaseAdapter:
+    return shards.ShardedWebhookEndpointDatabaseAdapter([
+        adapters.WebhookEndpointDatabaseAdapter(database, tables.webhook_endpoints) for database in router.databases
+    ])
+
+
+def make_hold_db_adapter(router: shards.ShardRouter) -> shards.ShardedHoldDatabaseAdapter:
+    return shards.ShardedHoldDatabaseAdapter(router, [
+        adapters.HoldDatabaseAdapter(models.HoldDB, database, tables.wallet_holds, tables.wallets)
+        for database in router.databases
+    ])
+
+
+wallet_db_adapter = make_wallet_db_adapter(write_router)
+transaction_db_adapter = make_transaction_db_adapter(write_router)
+export_job_db_adapter = adapters.ExportJobDatabaseAdapter(models.ExportJobDB, db, tables.export_jobs)
+spending_limit_db_adapter = make_spending_limit_db_adapter(write_router)
+webhook_endpoint_db_adapter = make_webhook_endpoint_db_adapter(write_router)
+hold_db_adapter = make_hold_db_adapter(write_router)
+# Reads outside the transactions that move money
+wallet_read_db_adapter = make_wallet_db_adapter(read_router)
+export_job_read_db_adapter = adapters.ExportJobDatabaseAdapter(models.ExportJobDB, read_db, tables.export_jobs)
+spending_limit_read_db_adapter = make_spending_limit_db_adapter(read_router)
+webhook_endpoint_read_db_adapter = make_webhook_endpoint_db_adapter(read_router)
+hold_read_db_adapter = make_hold_db_adapter(read_router)
+# Operation exports and balance reports
+export_transaction_db_adapter = make_transaction_db_adapter(export_router)
+balance_db_adapter = shards.ShardedBalanceCheckpointDatabaseAdapter(
+    export_router, make_balance_db_adapters(export_router),
+)
+outbox_db_adapter = shards.ShardedOutboxDatabaseAdapter(write_router, [
+    adapters.OutboxDatabaseAdapter(models.OutboxEventDB, database, tables.outbox_events, tables.webhook_endpoints)
+    for database in write_router.databases
+])
+
+mutation_rate_limiter = admission.RateLimiter(
+    'mutation',
+    rate=config.ADMISSION_MUTATION_RATE,
+    burst=config.ADMISSION_MUTATION_BURST,
+    max_keys=config.ADMISSION_MAX_TRACKED_USERS,
+)
+export_concurrency_limiter = admission.ConcurrencyLimiter('export', config.ADMISSION_EXPORT_CONCURRENCY)
+write_pool_guard = admission.ShardedPoolGuard(
+    'write', write_router, config.ADMISSION_POOL_WAIT_THRESHOLD, max_waiting=config.ADMISSION_WRITE_POOL_MAX_WAITING,
+)
+read_pool_guard = admission.ShardedPoolGuard(
+    'read', read_router, config.ADMISSION_POOL_WAIT_THRESHOLD, max_waiting=config.ADMISSION_READ_POOL_MAX_WAITING,
+)
+export_pool_guard = admission.ShardedPoolGuard(
+    'export', export_router, config.ADMISSION_POOL_WAIT_THRESHOLD, max_waiting=config.ADMISSION_EXPORT_POOL_MAX_WAITING,
+)
+# Chunks of a parallel export read next to the connection held by the request, all from the export pool
+operations_parallel_workers = min(config.OPERATIONS_PARALLEL_WORKERS, config.POSTGRES_EXPORT_POOL_MAX_SIZE - 1)
+operations_cache = export_cache.ExportCache(
+    config.EXPORT_CACHE_DIR,
+    max_bytes=config.EXPORT_CACHE_MAX_BYTES,
+    settle_seconds=config.EXPORT_CACHE_SETTLE_SECONDS,
+)
+export_job_runner = export_jobs.ExportJobRunner(
+    adapters.ExportJobDatabaseAdapter(models.ExportJobDB, background_db, tables.export_jobs),
+    make_transaction_db_adapter(background_router),
+    directory=config.EXPORT_JOBS_DIR,
+    workers=config.EXPORT_JOBS_WORKERS,
+    page_size=config.EXPORT_JOBS_PAGE_SIZE,
+    ttl_seconds=config.EXPORT_JOBS_TTL_SECONDS,
+    poll_interval=config.EXPORT_JOBS_POLL_INTERVAL,
+    stale_seconds=config.EXPORT_JOBS_STALE_SECONDS,
+)
+# One writer per shard, each with its own advisory lock
+balance_checkpointers = [
+    checkpoints.BalanceCheckpointer(
+        shard_balance_db_adapter,
+        interval=config.BALANCE_CHECKPOINT_INTERVAL,
+        batch_size=config.BALANCE_CHECKPOINT_BATCH_SIZE,
+        min_entries=config.BALANCE_CHECKPOINT_MIN_ENTRIES,
+        settle_seconds=config.BALANCE_CHECKPOINT_SETTLE_SECONDS,
+    )
+    for shard_balance_db_adapter in make_balance_db_adapters(background_router)
+]
+webhook_dispatcher = webhooks.WebhookDispatcher(
+    [
+        adapters.OutboxDatabaseAdapter(models.OutboxEventDB, database, tables.outbox_events, tables.webhook_endpoints)
+        for database in background_router.databases
+    ],
+    batch_size=config.WEBHOOKS_BATCH_SIZE,
+    events_per_request=config.WEBHOOKS_EVENTS_PER_REQUEST,
+    endpoint_concurrency=config.WEBHOOKS_ENDPOINT_CONCURRENCY,
+    max_connections=config.WEBHOOKS_MAX_CONNECTIONS,
+    timeout=config.WEBHOOKS_TIMEOUT,
+    max_attempts=config.WEBHOOKS_MAX_ATTEMPTS,
+    retry_base_seconds=config.WEBHOOKS_RETRY_BASE_SECONDS,
+    retry_max_seconds=config.WEBHOOKS_RETRY_MAX_SECONDS,
+    lease_seconds=config.WEBHOOKS_LEASE_SECONDS,
+    poll_interval=config.WEBHOOKS_POLL_INTERVAL,
+)
+hold_expiry_scheduler = holds.HoldExpiryScheduler(
+    [
+        adapters.HoldDatabaseAdapter(models.HoldDB, database, tables.wallet_holds, tables.wallets)
+        for database in background_router.databases
+    ],
+    horizon_seconds=config.HOLDS_EXPIRY_HORIZON_SECONDS,
+    load_interval=config.HOLDS_EXPIRY_LOAD_INTERVAL,
+    batch_size=config.HOLDS_EXPIRY_BATCH_SIZE,
+)
 
 app.mount('/static', StaticFiles(directory='static'), name='static')
 
 
-def make_simple_error_message(msg: str, **kwargs) -> t.List[t.Dict[str, t.Any]]:
-    kwargs = kwargs.copy()
-    kwargs['msg'] = msg
-    return [kwargs]
+async def limit_mutation_rate(user: models.User = Depends(fastapi_users.get_current_user)):
+    mutation_rate_limiter.check(user.id)
+
+
+async def get_operation_filter(
+        counterparty_wallet_id: UUID4 = None,
+        min_value: decimal.Decimal = Query(None, ge=0),
+        max_value: decimal.Decimal = Query(None, ge=0),
+        from_transaction_id: int = None,
+        to_transaction_id: int = None,
+) -> t.Optional[models.OperationFilter]:
+    operation_filter = models.OperationFilter(
+        counterparty_wallet_id=counterparty_wallet_id,
+        min_value=min_value,
+        max_value=max_value,
+        from_transaction_id=from_transaction_id,
+        to_transaction_id=to_transaction_id,
+    )
+    return operation_filter if operation_filter.dict(exclude_none=True) else None
 
 
 @app.get('/docs', include_in_schema=False)
@@ -51,11 +265,17 @@ async def root():  # pragma: no cover
     return RedirectResponse('/docs')
 
 
+@app.get('/metrics', include_in_schema=False)
+async def get_metrics():  # pragma: no cover
+    return PlainTextResponse(metrics.render())
+
+
 @app.post(
     '/wallet',
     summary='Create wallet',
     response_model=models.WalletId,
-    responses={409: {'model': models.ErrorDetails}},
+    responses={409: {'model': models.ErrorDetails}, 429: {'model': models.ErrorDetails}},
+    dependencies=[Depends(limit_mutation_rate), Depends(write_pool_guard)],
 )
 async def create_wallet(
         wallet_create: models.WalletCreate,
@@ -74,11 +294,38 @@ async def create_wallet(
     '/wallet',
     summary='Get wallet list',
     response_model=models.WalletList,
+    response_model_exclude_none=True,
+    dependencies=[Depends(read_pool_guard)],
 )
-async def get_wallets(user: models.User = Depends(fastapi_users.get_current_user)):
-    wallets = await wallet_db_adapter.get_many(user_id=user.id)
+async def get_wallets(
+        response: Response,
+        after: UUID4 = None,
+        limit: int = Query(None, ge=1, le=config.WALLET_LIST_MAX_LIMIT),
+        include_balance: bool = False,
+        if_none_match: str = Header(None),
+        user: models.User = Depends(fastapi_users.get_current_user),
+):
+    if if_none_match:
+        wallet_count, version_sum = await wallet_read_db_adapter.get_list_version(user.id)
+        etag = make_etag('wallets', wallet_count, version_sum, after, limit, include_balance)
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={'ETag': etag})
+
+    wallet_list = await wallet_read_db_adapter.get_many(
+        user_id=user.id,
+        after=after,
+        limit=limit,
+        include_balance=include_balance,
+    )
+    if wallet_list.wallet_count is not None:
+        response.headers['ETag'] = make_etag(
+            'wallets', wallet_list.wallet_count, wallet_list.version_sum, after, limit, include_balance,
+        )
+    wallets = wallet_list.wallets
     return models.WalletList(
-        wallets=wallets
+        wallets=wallets,
+        total_balance=wallet_list.total_balance,
+        next_after=wallets[-1].id if limit and len(wallets) == limit else None,
     )
 
 
@@ -90,12 +337,15 @@ async def get_wallets(user: models.User = Depends(fastapi_users.get_current_user
         403: {'model': models.ErrorDetails},
         404: {'model': models.ErrorDetails},
     },
+    dependencies=[Depends(read_pool_guard)],
 )
 async def get_wallet(
         wallet_id: UUID4,
+        response: Response,
+        if_none_match: str = Header(None),
         user: models.User = Depends(fastapi_users.get_current_user),
 ):
-    wallet = await wallet_db_adapter.get(wallet_id=wallet_id)
+    wallet = await wallet_read_db_adapter.get(wallet_id=wallet_id)
     if not wallet:
         raise HTTPException(
             status_code=404,
@@ -103,14 +353,80 @@ async def get_wallet(
         )
     if wallet.user_id != user.id:
         raise HTTPException(status_code=403, detail=make_simple_error_message('User does not own the wallet'))
+    etag = make_etag('wallet', wallet.id, wallet.version)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+    response.headers['ETag'] = etag
     return wallet
 
 
+@app.get(
+    '/wallet/{wallet_id}/balance',
+    summary='Get wallet balance at a point in time',
+    response_model=models.WalletBalance,
+    responses={
+        403: {'model': models.ErrorDetails},
+        404: {'model': models.ErrorDetails},
+    },
+    dependencies=[Depends(export_pool_guard)],
+)
+async def get_wallet_balance(
+        wallet_id: UUID4,
+        timestamp: datetime.datetime,
+        user: models.User = Depends(fastapi_users.get_current_user),
+):
+    balances = await get_owned_wallet_balances([wallet_id], timestamp, user)
+    return balances.balances[0]
+
+
+@app.post(
+    '/wallet/balance',
+    summary='Get balances of many wallets at a point in time',
+    response_model=models.WalletBalanceList,
+    responses={
+        403: {'model': models.ErrorDetails},
+        404: {'model': models.ErrorDetails},
+    },
+    dependencies=[Depends(export_pool_guard)],
+)
+async def get_wallet_balances(
+        balance_query: models.WalletBalanceQuery,
+        user: models.User = Depends(fastapi_users.get_current_user),
+):
+    return await get_owned_wallet_balances(balance_query.wallet_ids, balance_query.timestamp, user)
+
+
+async def get_owned_wallet_balances(
+        wallet_ids: t.List[UUID4],
+        timestamp: datetime.datetime,
+        user: models.User,
+) -> models.WalletBalanceList:
+    balances = {balance.id: balance for balance in await balance_db_adapter.get_many(wallet_ids, timestamp)}
+    for wallet_id in wallet_ids:
+        if wallet_id not in balances:
+            raise HTTPException(
+                status_code=404,
+                detail=make_simple_error_message('Wallet does not exist', entity='wallet', wallet_id=str(wallet_id)),
+            )
+        if balances[wallet_id].user_id != user.id:
+            raise HTTPException(status_code=403, detail=make_simple_error_message('User does not own the wallet'))
+    return models.WalletBalanceList(balances=[
+        models.WalletBalance(wallet_id=wallet_id, timestamp=timestamp, balance=balances[wallet_id].balance)
+        for wallet_id in wallet_ids
+    ])
+
+
 @app.post(
     '/wallet/{wallet_id}/deposit',
     summary='Deposit funds to wallet',
     response_model=models.WalletValueBalance,
-    responses={404: {'model': models.ErrorDetails}},
+    responses={
+        404: {'model': models.ErrorDetails},
+        409: {'model': models.ErrorDetails},
+        429: {'model': models.ErrorDetails},
+        503: {'model': models.ErrorDetails},
+    },
+    dependencies=[Depends(limit_mutation_rate), Depends(write_pool_guard)],
 )
 async def deposit_to_wallet(
         wallet_id: UUID4,
@@ -118,19 +434,34 @@ async def deposit_to_wallet(
         user: models.User = Depends(fastapi_users.get_current_user),
 ):
     now = datetime.datetime.utcnow()
-    async with db.transaction():
-        wallet = await wallet_db_adapter.lock(wallet_id)
-        if not wallet:
-            raise HTTPException(
-                status_code=404,
-                detail=make_simple_error_message('Wallet does not exist', entity='wallet'),
+    database = write_router.get_database(wallet_id)
+    with admission.fail_fast('deposit', config.WALLET_LOCK_RETRY_AFTER):
+        async with tracing.transaction(database):
+            await adapters.set_local_timeouts(database, wallet_lock_timeout, config.DEPOSIT_STATEMENT_TIMEOUT_MS)
+            optimistic = wallet_concurrency is enums.WalletConcurrency.optimistic
+            if optimistic:
+                wallet = await wallet_db_adapter.deposit(wallet_id, wallet_deposit.value)
+            else:
+                wallet = await wallet_db_adapter.lock(wallet_id)
+            if not wallet:
+                raise HTTPException(
+                    status_code=404,
+                    detail=make_simple_error_message('Wallet does not exist', entity='wallet'),
+                )
+            if optimistic:
+                new_balance = wallet.balance
+            else:
+                new_balance = await wallet_db_adapter.increase_balance(wallet_id, wallet_deposit.value)
+            transaction = models.TransactionDB(
+                recipient_wallet_id=wallet_id,
+                value=wallet_deposit.value,
+                timestamp=now,
             )
-        new_balance = await wallet_db_adapter.increase_balance(wallet_id, wallet_deposit.value)
-        await transaction_db_adapter.create(models.TransactionDB(
-            recipient_wallet_id=wallet_id,
-            value=wallet_deposit.value,
-            timestamp=now,
-        ))
+            transaction_id = await transaction_db_adapter.create(transaction)
+            # The event commits or rolls back together with the money
+            event = webhooks.make_event(transaction, transaction_id)
+            await outbox_db_adapter.add(wallet_id, [wallet.user_id], event, now)
+    webhook_dispatcher.notify()
     if wallet.user_id == user.id:
         return models.WalletValueBalance(
             value=wallet_deposit.value,
@@ -150,7 +481,11 @@ async def deposit_to_wallet(
         400: {'model': models.ErrorDetails},
         403: {'model': models.ErrorDetails},
         404: {'model': models.ErrorDetails},
+        409: {'model': models.ErrorDetails},
+        429: {'model': models.ErrorDetails},
+        503: {'model': models.ErrorDetails},
     },
+    dependencies=[Depends(limit_mutation_rate), Depends(write_pool_guard)],
 )
 async def transfer(
         wallet_id: UUID4,
@@ -161,45 +496,420 @@ async def transfer(
     now = datetime.datetime.utcnow()
     if wallet_id == recipient_wallet_id:
         raise HTTPException(status_code=400, detail=make_simple_error_message('Cannot transfer to self'))
-    async with db.transaction():
-        sender_wallet, recipient_wallet = await asyncio.gather(
-            wallet_db_adapter.lock(wallet_id),
-            wallet_db_adapter.lock(recipient_wallet_id),
-        )
-        if not sender_wallet:
-            raise HTTPException(
-                status_code=404,
-                detail=make_simple_error_message('Sender wallet does not exist', entity='sender_wallet'),
-            )
-        if sender_wallet.user_id != user.id:
-            raise HTTPException(
-                status_code=403,
-                detail=make_simple_error_message('User does not own the sender wallet'),
-            )
-        if sender_wallet.balance < wallet_transfer.value:
-            raise HTTPException(status_code=400, detail=make_simple_error_message('Insufficient funds'))
-        if not recipient_wallet:
-            raise HTTPException(
-                status_code=404,
-                detail=make_simple_error_message('Recipient wallet does not exist', entity='recipient_wallet'),
-            )
+    shard_dbs, db_transaction = make_transfer_transaction(wallet_id, recipient_wallet_id)
+    with admission.fail_fast('transfer', config.WALLET_LOCK_RETRY_AFTER):
+        async with db_transaction:
+            for shard_db in shard_dbs:
+                await adapters.set_local_timeouts(
+                    shard_db, get_transfer_lock_timeout(shard_dbs), config.TRANSFER_STATEMENT_TIMEOUT_MS,
+                )
+            # An optimistic debit locks the sender before the recipient, which is not the shard lock order
+            optimistic = wallet_concurrency is enums.WalletConcurrency.optimistic and len(shard_dbs) == 1
+            retries = config.WALLET_OPTIMISTIC_RETRIES
+            while True:
+                if optimistic:
+                    sender_wallet, recipient_wallet = await asyncio.gather(
+                        wallet_db_adapter.read(wallet_id), wallet_db_adapter.read(recipient_wallet_id),
+                    )
+                else:
+                    sender_wallet, recipient_wallet = await wallet_db_adapter.lock_many(
+                        [wallet_id, recipient_wallet_id],
+                    )
+                if not sender_wallet:
+                    raise HTTPException(
+                        status_code=404,
+                        detail=make_simple_error_message('Sender wallet does not exist', entity='sender_wallet'),
+                    )
+                if sender_wallet.user_id != user.id:
+                    raise HTTPException(
+                        status_code=403,
+                        detail=make_simple_error_message('User does not own the sender wallet'),
+                    )
+                if sender_wallet.available < wallet_transfer.value:
+                    raise HTTPException(status_code=400, detail=make_simple_error_message('Insufficient funds'))
+                if not recipient_wallet:
+                    raise HTTPException(
+                        status_code=404,
+                        detail=make_simple_error_message('Recipient wallet does not exist', entity='recipient_wallet'),
+                    )
+
+                # Spending of the sender is serialized by its row lock or version, so the check cannot race the update
+                spending = await spending_limit_db_adapter.get_spent(wallet_id, now)
+                exceeded_window = find_exceeded_spending_limit(spending, wallet_transfer.value) if spending else None
+                if exceeded_window:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=make_simple_error_message('Spending limit exceeded', window=exceeded_window.value),
+                    )
 
-        new_balance, _, _ = await asyncio.gather(
-            wallet_db_adapter.decrease_balance(wallet_id, wallet_transfer.value),
-            wallet_db_adapter.increase_balance(recipient_wallet_id, wallet_transfer.value),
-            transaction_db_adapter.create(models.TransactionDB(
+                if optimistic and enums.WalletConcurrency.pessimistic in (
+                        sender_wallet.concurrency, recipient_wallet.concurrency,
+                ):
+                    optimistic = False
+                    continue
+                if not optimistic:
+                    break
+                # Nothing is written before the debit, so a conflict is retried within the same transaction
+                new_balance = await wallet_db_adapter.decrease_balance_if_unchanged(
+                    wallet_id, wallet_transfer.value, sender_wallet.version,
+                )
+                if new_balance is not None:
+                    break
+                retries -= 1
+                optimistic = retries >= 0
+
+            transaction = models.TransactionDB(
                 sender_wallet_id=wallet_id,
                 recipient_wallet_id=recipient_wallet_id,
                 value=wallet_transfer.value,
                 timestamp=now,
-            )),
-        )
+            )
+            updates = [
+                transaction_db_adapter.create(transaction),
+                wallet_db_adapter.increase_balance(recipient_wallet_id, wallet_transfer.value),
+            ]
+            if not optimistic:
+                updates.append(wallet_db_adapter.decrease_balance(wallet_id, wallet_transfer.value))
+            if spending:
+                updates.append(spending_limit_db_adapter.record(wallet_id, now, wallet_transfer.value))
+            transaction_id, _, *results = await asyncio.gather(*updates)
+            if not optimistic:
+                new_balance = results[0]
+            await outbox_db_adapter.add(
+                wallet_id,
+                {sender_wallet.user_id, recipient_wallet.user_id},
+                webhooks.make_event(transaction, transaction_id),
+                now,
+            )
+    webhook_dispatcher.notify()
     return models.WalletValueBalance(
         value=wallet_transfer.value,
         balance=new_balance,
     )
 
 
+def make_transfer_transaction(
+        wallet_id: UUID4,
+        recipient_wallet_id: UUID4,
+) -> t.Tuple[t.List[databases.Database], t.AsyncContextManager]:
+    sender_db = write_router.get_database(wallet_id)
+    recipient_db = write_router.get_database(recipient_wallet_id)
+    if sender_db is recipient_db:
+        return [sender_db], tracing.transaction(sender_db)
+    shard_dbs = [sender_db, recipient_db]
+    return shard_dbs, two_phase_commit.transaction(shard_dbs)
+
+
+def get_transfer_lock_timeout(shard_dbs: t.List[databases.Database]) -> int:
+    if len(shard_dbs) == 1:
+        return wallet_lock_timeout
+    return min(wallet_lock_timeout or config.SHARD_TRANSFER_LOCK_TIMEOUT_MS, config.SHARD_TRANSFER_LOCK_TIMEOUT_MS)
+
+
+@app.post(
+    '/wallet/{wallet_id}/holds',
+    summary='Hold funds of wallet for a later transfer',
+    status_code=201,
+    response_model=models.Hold,
+    responses={
+        400: {'model': models.ErrorDetails},
+        403: {'model': models.ErrorDetails},
+        404: {'model': models.ErrorDetails},
+        409: {'model': models.ErrorDetails},
+        429: {'model': models.ErrorDetails},
+        503: {'model': models.ErrorDetails},
+    },
+    dependencies=[Depends(limit_mutation_rate), Depends(write_pool_guard)],
+)
+async def create_hold(
+        wallet_id: UUID4,
+        hold_create: models.HoldCreate,
+        user: models.User = Depends(fastapi_users.get_current_user),
+):
+    now = datetime.datetime.utcnow()
+    if wallet_id == hold_create.recipient_wallet_id:
+        raise HTTPException(status_code=400, detail=make_simple_error_message('Cannot transfer to self'))
+    # Checked again when the hold is captured, wallets are never deleted though
+    if not await wallet_read_db_adapter.get(hold_create.recipient_wallet_id):
+        raise HTTPException(
+            status_code=404,
+            detail=make_simple_error_message('Recipient wallet does not exist', entity='recipient_wallet'),
+        )
+    database = write_router.get_database(wallet_id)
+    with admission.fail_fast('hold', config.WALLET_LOCK_RETRY_AFTER):
+        async with tracing.transaction(database):
+            await adapters.set_local_timeouts(database, wallet_lock_timeout, config.TRANSFER_STATEMENT_TIMEOUT_MS)
+            wallet = await wallet_db_adapter.lock(wallet_id)
+            if not wallet:
+                raise HTTPException(
+                    status_code=404,
+                    detail=make_simple_error_message('Wallet does not exist', entity='wallet'),
+                )
+            if wallet.user_id != user.id:
+                raise HTTPException(status_code=403, detail=make_simple_error_message('User does not own the wallet'))
+            if wallet.available < hold_create.value:
+                raise HTTPException(status_code=400, detail=make_simple_error_message('Insufficient funds'))
+            # Limits are checked against the hold, the spending is recorded once it is captured
+            spending = await spending_limit_db_adapter.get_spent(wallet_id, now)
+            exceeded_window = find_exceeded_spending_limit(spending, hold_create.value) if spending else None
+            if exceeded_window:
+                raise HTTPException(
+                    status_code=400,
+                    detail=make_simple_error_message('Spending limit exceeded', window=exceeded_window.value),
+                )
+            await wallet_db_adapter.increase_held(wallet_id, hold_create.value)
+            ttl_seconds = hold_create.ttl_seconds or config.HOLDS_DEFAULT_TTL_SECONDS
+            hold = await hold_db_adapter.create(models.HoldDB(
+                wallet_id=wallet_id,
+                recipient_wallet_id=hold_create.recipient_wallet_id,
+                value=hold_create.value,
+                created_at=now,
+                expires_at=now + datetime.timedelta(seconds=ttl_seconds),
+            ))
+    hold_expiry_scheduler.schedule(write_router.get_index(wallet_id), hold.id, hold.expires_at)
+    return hold
+
+
+@app.get(
+    '/wallet/{wallet_id}/holds',
+    summary='Get active holds of wallet',
+    response_model=models.HoldList,
+    responses={
+        403: {'model': models.ErrorDetails},
+        404: {'model': models.ErrorDetails},
+    },
+    dependencies=[Depends(read_pool_guard)],
+)
+async def get_holds(
+        wallet_id: UUID4,
+        user: models.User = Depends(fastapi_users.get_current_user),
+):
+    wallet = await get_owned_wallet(wallet_id, user)
+    active_holds = await hold_read_db_adapter.get_active(wallet_id)
+    return models.HoldList(
+        holds=active_holds,
+        balance=wallet.balance,
+        held=wallet.held,
+        available=wallet.available,
+    )
+
+
+async def get_owned_hold(
+        wallet_id: UUID4,
+        hold_id: UUID4,
+        user: models.User = Depends(fastapi_users.get_current_user),
+) -> models.HoldDB:
+    await get_owned_wallet(wallet_id, user)
+    hold = await hold_read_db_adapter.get(wallet_id, hold_id)
+    if not hold:
+        raise HTTPException(status_code=404, detail=make_simple_error_message('Hold does not exist', entity='hold'))
+    return hold
+
+
+def make_inactive_hold_error(hold: models.HoldDB) -> HTTPException:
+    return HTTPException(status_code=409, detail=make_simple_error_message('Hold is not active', status=hold.status))
+
+
+@app.post(
+    '/wallet/{wallet_id}/holds/{hold_id}/capture',
+    summary='Transfer held funds to the recipient of the hold',
+    response_model=models.WalletValueBalance,
+    responses={
+        400: {'model': models.ErrorDetails},
+        403: {'model': models.ErrorDetails},
+        404: {'model': models.ErrorDetails},
+        409: {'model': models.ErrorDetails},
+        429: {'model': models.ErrorDetails},
+        503: {'model': models.ErrorDetails},
+    },
+    dependencies=[Depends(limit_mutation_rate), Depends(write_pool_guard)],
+)
+async def capture_hold(
+        hold_capture: models.HoldCapture,
+        hold: models.HoldDB = Depends(get_owned_hold),
+):
+    now = datetime.datetime.utcnow()
+    value = hold_capture.value or hold.value
+    if value > hold.value:
+        raise HTTPException(status_code=400, detail=make_simple_error_message('Cannot capture more than held'))
+    wallet_id, recipient_wallet_id = hold.wallet_id, hold.recipient_wallet_id
+    shard_dbs, db_transaction = make_transfer_transaction(wallet_id, recipient_wallet_id)
+    with admission.fail_fast('capture', config.WALLET_LOCK_RETRY_AFTER):
+        async with db_transaction:
+            for shard_db in shard_dbs:
+                await adapters.set_local_timeouts(
+                    shard_db, get_transfer_lock_timeout(shard_dbs), config.TRANSFER_STATEMENT_TIMEOUT_MS,
+                )
+            # The hold row is locked before the wallets, like expiry does
+            if not await hold_db_adapter.resolve(wallet_id, hold.id, enums.HoldStatus.captured, now):
+                raise make_inactive_hold_error(await hold_db_adapter.get(wallet_id, hold.id))
+            sender_wallet, recipient_wallet = await wallet_db_adapter.lock_many([wallet_id, recipient_wallet_id])
+            if not recipient_wallet:
+                raise HTTPException(
+                    status_code=404,
+                    detail=make_simple_error_message('Recipient wallet does not exist', entity='recipient_wallet'),
+                )
+            transaction = models.TransactionDB(
+                sender_wallet_id=wallet_id,
+                recipient_wallet_id=recipient_wallet_id,
+                value=value,
+                timestamp=now,
+            )
+            # The whole hold leaves wallet.held, so the rest of a partial capture becomes available again
+            spending = await spending_limit_db_adapter.get_spent(wallet_id, now)
+            updates = [
+                transaction_db_adapter.create(transaction),
+                wallet_db_adapter.increase_balance(recipient_wallet_id, value),
+                wallet_db_adapter.decrease_held(wallet_id, hold.value),
+                wallet_db_adapter.decrease_balance(wallet_id, value),
+            ]
+            if spending:
+                updates.append(spending_limit_db_adapter.record(wallet_id, now, value))
+            transaction_id, _, _, new_balance, *_ = await asyncio.gather(*updates)
+            await outbox_db_adapter.add(
+                wallet_id,
+                {sender_wallet.user_id, recipient_wallet.user_id},
+                webhooks.make_event(transaction, transaction_id),
+                now,
+            )
+    webhook_dispatcher.notify()
+    return models.WalletValueBalance(
+        value=value,
+        balance=new_balance,
+    )
+
+
+@app.post(
+    '/wallet/{wallet_id}/holds/{hold_id}/release',
+    summary='Release held funds',
+    response_model=models.Hold,
+    responses={
+        403: {'model': models.ErrorDetails},
+        404: {'model': models.ErrorDetails},
+        409: {'model': models.ErrorDetails},
+        429: {'model': models.ErrorDetails},
+        503: {'model': models.ErrorDetails},
+    },
+    dependencies=[Depends(limit_mutation_rate), Depends(write_pool_guard)],
+)
+async def release_hold(hold: models.HoldDB = Depends(get_owned_hold)):
+    now = datetime.datetime.utcnow()
+    database = write_router.get_database(hold.wallet_id)
+    with admission.fail_fast('release', config.WALLET_LOCK_RETRY_AFTER):
+        async with tracing.transaction(database):
+            await adapters.set_local_timeouts(database, wallet_lock_timeout, config.TRANSFER_STATEMENT_TIMEOUT_MS)
+            released_hold = await hold_db_adapter.resolve(hold.wallet_id, hold.id, enums.HoldStatus.released, now)
+            if not released_hold:
+                raise make_inactive_hold_error(await hold_db_adapter.get(hold.wallet_id, hold.id))
+            await wallet_db_adapter.decrease_held(hold.wallet_id, hold.value)
+    return released_hold
+
+
+@app.get(
+    '/wallet/{wallet_id}/spending-limits',
+    summary='Get wallet spending limits',
+    response_model=models.SpendingLimitsState,
+    responses={
+        403: {'model': models.ErrorDetails},
+        404: {'model': models.ErrorDetails},
+    },
+    dependencies=[Depends(read_pool_guard)],
+)
+async def get_spending_limits(
+        wallet_id: UUID4,
+        user: models.User = Depends(fastapi_users.get_current_user),
+):
+    await get_owned_wallet(wallet_id, user)
+    spending = await spending_limit_read_db_adapter.get_spent(wallet_id, datetime.datetime.utcnow())
+    if not spending:
+        return models.SpendingLimitsState(hourly_spent=0, daily_spent=0)
+    return models.SpendingLimitsState(
+        hourly=spending.hourly_limit,
+        daily=spending.daily_limit,
+        hourly_spent=spending.hourly_spent,
+        daily_spent=spending.daily_spent,
+    )
+
+
+@app.put(
+    '/wallet/{wallet_id}/spending-limits',
+    summary='Set wallet spending limits',
+    response_model=models.SpendingLimits,
+    responses={
+        403: {'model': models.ErrorDetails},
+        404: {'model': models.ErrorDetails},
+        429: {'model': models.ErrorDetails},
+    },
+    dependencies=[Depends(limit_mutation_rate), Depends(write_pool_guard)],
+)
+async def set_spending_limits(
+        wallet_id: UUID4,
+        limits: models.SpendingLimits,
+        user: models.User = Depends(fastapi_users.get_current_user),
+):
+    await get_owned_wallet(wallet_id, user)
+    # Only wallets with limits have their spending recorded, so windows start empty
+    await spending_limit_db_adapter.set(wallet_id, limits)
+    return limits
+
+
+@app.get(
+    '/webhook',
+    summary='Get webhook endpoint',
+    response_model=models.WebhookEndpoint,
+    responses={404: {'model': models.ErrorDetails}},
+    dependencies=[Depends(read_pool_guard)],
+)
+async def get_webhook(user: models.User = Depends(fastapi_users.get_current_user)):
+    url = await webhook_endpoint_read_db_adapter.get(user.id)
+    if not url:
+        raise HTTPException(
+            status_code=404,
+            detail=make_simple_error_message('Webhook endpoint is not set', entity='webhook'),
+        )
+    return models.WebhookEndpoint(url=url)
+
+
+@app.put(
+    '/webhook',
+    summary='Set webhook endpoint',
+    response_model=models.WebhookEndpoint,
+    responses={429: {'model': models.ErrorDetails}},
+    dependencies=[Depends(limit_mutation_rate), Depends(write_pool_guard)],
+)
+async def set_webhook(
+        endpoint: models.WebhookEndpoint,
+        user: models.User = Depends(fastapi_users.get_current_user),
+):
+    # Events already in the outbox keep going to the previous URL
+    await webhook_endpoint_db_adapter.set(user.id, endpoint.url)
+    return endpoint
+
+
+@app.delete(
+    '/webhook',
+    summary='Remove webhook endpoint',
+    status_code=204,
+    responses={429: {'model': models.ErrorDetails}},
+    dependencies=[Depends(limit_mutation_rate), Depends(write_pool_guard)],
+)
+async def delete_webhook(user: models.User = Depends(fastapi_users.get_current_user)):
+    await webhook_endpoint_db_adapter.delete(user.id)
+    return Response(status_code=204)
+
+
+async def get_owned_wallet(wallet_id: UUID4, user: models.User) -> models.WalletDB:
+    wallet = await wallet_read_db_adapter.get(wallet_id)
+    if not wallet:
+        raise HTTPException(
+            status_code=404,
+            detail=make_simple_error_message('Wallet does not exist', entity='wallet'),
+        )
+    if wallet.user_id != user.id:
+        raise HTTPException(status_code=403, detail=make_simple_error_message('User does not own the wallet'))
+    return wallet
+
+
 @app.get(
     '/wallet/{wallet_id}/operations',
     summary='Get wallet operations',
@@ -207,17 +917,21 @@ async def transfer(
     responses={
         200: {'content': {'text/csv': {}}},
         403: {'model': models.ErrorDetails},
-        404: {'model': models.ErrorDetails}
+        404: {'model': models.ErrorDetails},
+        503: {'model': models.ErrorDetails},
     },
+    dependencies=[Depends(export_concurrency_limiter), Depends(export_pool_guard)],
 )
 async def get_wallet_operations(
         wallet_id: UUID4,
         from_timestamp: datetime.datetime = None,
         to_timestamp: datetime.datetime = None,
         side: enums.TransferSide = None,
+        operation_filter: t.Optional[models.OperationFilter] = Depends(get_operation_filter),
+        if_none_match: str = Header(None),
         user: models.User = Depends(fastapi_users.get_current_user),
 ):
-    wallet = await wallet_db_adapter.get(wallet_id)
+    wallet = await wallet_read_db_adapter.get(wallet_id)
     if not wallet:
         raise HTTPException(
             status_code=404,
@@ -225,35 +939,275 @@ async def get_wallet_operations(
         )
     if wallet.user_id != user.id:
         raise HTTPException(status_code=403, detail=make_simple_error_message('User does not own the wallet'))
+    cacheable = operations_cache.is_cacheable(to_timestamp)
+    # The wallet version is bumped in the same DB transaction that adds its entries,
+    # and a closed range in the past cannot change at all
+    filter_key = (operation_filter.json(),) if operation_filter else ()
+    etag = make_etag(
+        'operations', wallet_id, None if cacheable else wallet.version, from_timestamp, to_timestamp, side, *filter_key,
+    )
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+
+    filename = make_filename(wallet_id, from_timestamp, to_timestamp, side, operation_filter=operation_filter)
+    headers = {
+        'Content-Disposition': f'attachment;filename={filename}',
+        'ETag': etag,
+    }
+    if cacheable:
+        cache_path = operations_cache.make_path(wallet_id, from_timestamp, to_timestamp, side, *filter_key, 'csv')
+        if operations_cache.get(cache_path):
+            return FileResponse(cache_path, media_type='text/csv', headers=headers)
 
-    transactions = await transaction_db_adapter.get_many(
+    if operations_parallel_workers > 1:
+        content = operations_export.stream_parallel_csv(
+            export_transaction_db_adapter,
+            wallet_id,
+            from_timestamp,
+            to_timestamp,
+            side,
+            operation_filter,
+            page_size=config.OPERATIONS_EXPORT_PAGE_SIZE,
+            workers=operations_parallel_workers,
+            min_chunk_seconds=config.OPERATIONS_PARALLEL_MIN_CHUNK_SECONDS,
+            buffer_pages=config.OPERATIONS_PARALLEL_BUFFER_PAGES,
+            acquire_timeout=config.OPERATIONS_PARALLEL_ACQUIRE_TIMEOUT,
+        )
+    else:
+        transactions = await export_transaction_db_adapter.get_many(
+            wallet_id=wallet_id,
+            from_timestamp=from_timestamp,
+            to_timestamp=to_timestamp,
+            transfer_side=side,
+            operation_filter=operation_filter,
+        )
+        content = make_csv_stream(transactions)
+    if cacheable:
+        content = operations_cache.fill(cache_path, content)
+
+    return StreamingResponse(
+        content,
+        media_type='text/csv',
+        headers=headers,
+    )
+
+
+@app.get(
+    '/operations',
+    summary='Get operations of several wallets',
+    response_class=StreamingResponse,
+    responses={
+        200: {'content': {'text/csv': {}, 'application/zip': {}}},
+        400: {'model': models.ErrorDetails},
+        403: {'model': models.ErrorDetails},
+        404: {'model': models.ErrorDetails},
+        503: {'model': models.ErrorDetails},
+    },
+    dependencies=[Depends(export_concurrency_limiter), Depends(export_pool_guard)],
+)
+async def get_operations(
+        wallet_ids: t.List[UUID4] = Query(None),
+        from_timestamp: datetime.datetime = None,
+        to_timestamp: datetime.datetime = None,
+        side: enums.TransferSide = None,
+        export_format: enums.ExportFormat = Query(enums.ExportFormat.csv, alias='format'),
+        operation_filter: t.Optional[models.OperationFilter] = Depends(get_operation_filter),
+        user: models.User = Depends(fastapi_users.get_current_user),
+):
+    max_wallets = config.OPERATIONS_EXPORT_MAX_WALLETS
+    if wallet_ids:
+        wallet_ids = list(dict.fromkeys(wallet_ids))
+    else:
+        wallet_list = await wallet_read_db_adapter.get_many(user_id=user.id, limit=max_wallets + 1)
+        wallet_ids = [wallet.id for wallet in wallet_list.wallets]
+    if len(wallet_ids) > max_wallets:
+        raise HTTPException(
+            status_code=400,
+            detail=make_simple_error_message(f'At most {max_wallets} wallets can be exported at once'),
+        )
+    wallets = await asyncio.gather(*(wallet_read_db_adapter.get(wallet_id) for wallet_id in wallet_ids))
+    for wallet_id, wallet in zip(wallet_ids, wallets):
+        if not wallet:
+            raise HTTPException(
+                status_code=404,
+                detail=make_simple_error_message('Wallet does not exist', entity='wallet', wallet_id=str(wallet_id)),
+            )
+        if wallet.user_id != user.id:
+            raise HTTPException(status_code=403, detail=make_simple_error_message('User does not own the wallet'))
+
+    parallelism = config.OPERATIONS_EXPORT_PARALLELISM
+    # The merge keeps every cursor open, the archive only the current one and those read ahead
+    open_cursors = len(wallet_ids) if export_format == enums.ExportFormat.csv else min(len(wallet_ids), parallelism + 1)
+    page_size = operations_export.get_page_size(
+        max(open_cursors, 1), config.OPERATIONS_EXPORT_ROW_BUDGET, config.OPERATIONS_EXPORT_PAGE_SIZE,
+    )
+    semaphore = asyncio.Semaphore(parallelism)
+    cursors = [
+        operations_export.WalletPages(
+            export_transaction_db_adapter, wallet_id, from_timestamp, to_timestamp, side, page_size, semaphore,
+            operation_filter,
+        )
+        for wallet_id in wallet_ids
+    ]
+
+    filename = make_filename('wallets', from_timestamp, to_timestamp, side, export_format.value, operation_filter)
+    if export_format == enums.ExportFormat.zip:
+        filenames = [
+            make_filename(wallet_id, from_timestamp, to_timestamp, side, operation_filter=operation_filter)
+            for wallet_id in wallet_ids
+        ]
+        return StreamingResponse(
+            operations_export.stream_zip(cursors, filenames, read_ahead=parallelism),
+            media_type='application/zip',
+            headers={'Content-Disposition': f'attachment;filename={filename}'},
+        )
+    return StreamingResponse(
+        operations_export.stream_merged_csv(cursors, chunk_size=page_size),
+        media_type='text/csv',
+        headers={'Content-Disposition': f'attachment;filename={filename}'},
+    )
+
+
+@app.post(
+    '/wallet/{wallet_id}/operations/export-jobs',
+    summary='Start background export of wallet operations',
+    status_code=202,
+    response_model=models.ExportJob,
+    responses={
+        403: {'model': models.ErrorDetails},
+        404: {'model': models.ErrorDetails},
+        429: {'model': models.ErrorDetails},
+    },
+    dependencies=[Depends(limit_mutation_rate), Depends(write_pool_guard)],
+)
+async def create_export_job(
+        wallet_id: UUID4,
+        from_timestamp: datetime.datetime = None,
+        to_timestamp: datetime.datetime = None,
+        side: enums.TransferSide = None,
+        user: models.User = Depends(fastapi_users.get_current_user),
+):
+    wallet = await wallet_read_db_adapter.get(wallet_id)
+    if not wallet:
+        raise HTTPException(
+            status_code=404,
+            detail=make_simple_error_message('Wallet does not exist', entity='wallet'),
+        )
+    if wallet.user_id != user.id:
+        raise HTTPException(status_code=403, detail=make_simple_error_message('User does not own the wallet'))
+    now = datetime.datetime.utcnow()
+    job = models.ExportJobDB(
+        user_id=user.id,
         wallet_id=wallet_id,
         from_timestamp=from_timestamp,
         to_timestamp=to_timestamp,
-        transfer_side=side,
+        side=side,
+        status=enums.ExportJobStatus.pending,
+        rows_written=0,
+        created_at=now,
+        updated_at=now,
     )
+    job.id = await export_job_db_adapter.create(job)
+    export_job_runner.notify()
+    return make_export_job(job)
 
-    io = make_csv_stream(transactions)
-    filename = make_filename(wallet_id, from_timestamp, to_timestamp, side)
 
-    return StreamingResponse(
-        io,
+async def get_owned_export_job(
+        job_id: UUID4,
+        user: models.User = Depends(fastapi_users.get_current_user),
+) -> models.ExportJobDB:
+    job = await export_job_read_db_adapter.get(job_id)
+    if not job:
+        raise HTTPException(
+            status_code=404,
+            detail=make_simple_error_message('Export job does not exist', entity='export_job'),
+        )
+    if job.user_id != user.id:
+        raise HTTPException(status_code=403, detail=make_simple_error_message('User does not own the export job'))
+    return job
+
+
+@app.get(
+    '/export-jobs/{job_id}',
+    summary='Get export job status',
+    response_model=models.ExportJob,
+    responses={
+        403: {'model': models.ErrorDetails},
+        404: {'model': models.ErrorDetails},
+    },
+    dependencies=[Depends(read_pool_guard)],
+)
+async def get_export_job(job: models.ExportJobDB = Depends(get_owned_export_job)):
+    return make_export_job(job)
+
+
+@app.get(
+    '/export-jobs/{job_id}/download',
+    summary='Download export job result',
+    response_class=FileResponse,
+    responses={
+        200: {'content': {'text/csv': {}}},
+        403: {'model': models.ErrorDetails},
+        404: {'model': models.ErrorDetails},
+        409: {'model': models.ErrorDetails},
+    },
+    dependencies=[Depends(read_pool_guard)],
+)
+async def download_export_job(job: models.ExportJobDB = Depends(get_owned_export_job)):
+    if job.status is not enums.ExportJobStatus.done:
+        raise HTTPException(
+            status_code=409,
+            detail=make_simple_error_message('Export job is not finished', status=job.status.value),
+        )
+    path = export_job_runner.make_path(job.id)
+    if job.expires_at < datetime.datetime.utcnow() or not os.path.exists(path):
+        raise HTTPException(
+            status_code=404,
+            detail=make_simple_error_message('Export job result has expired', entity='export_job'),
+        )
+    filename = make_filename(job.wallet_id, job.from_timestamp, job.to_timestamp, job.side)
+    return FileResponse(
+        path,
         media_type='text/csv',
-        headers={
-            'Content-Disposition': f'attachment;filename={filename}'
-        }
+        headers={'Content-Disposition': f'attachment;filename={filename}'},
     )
 
 
 @app.on_event("startup")
 async def startup():  # pragma: no cover
-    await db.connect()
+    if tracer.exporter:
+        tracer.exporter.start()
+    await write_router.connect()
+    await read_router.connect()
+    await export_router.connect()
+    await background_router.connect()
+    export_job_runner.start()
+    for balance_checkpointer in balance_checkpointers:
+        balance_checkpointer.start()
+    webhook_dispatcher.start()
+    hold_expiry_scheduler.start()
 
 
 @app.on_event("shutdown")
 async def shutdown():  # pragma: no cover
-    await db.disconnect()
+    await hold_expiry_scheduler.stop()
+    await webhook_dispatcher.stop()
+    await asyncio.gather(*(balance_checkpointer.stop() for balance_checkpointer in balance_checkpointers))
+    await export_job_runner.stop()
+    await background_router.disconnect()
+    await export_router.disconnect()
+    await read_router.disconnect()
+    await write_router.disconnect()
+    if tracer.exporter:
+        await tracer.exporter.stop()
 
 
 if __name__ == '__main__':  # pragma: no cover
-    uvicorn.run(app, host='0.0.0.0', port=config.APP_PORT)
+    uvicorn.run(
+        'main:app',
+        host='0.0.0.0',
+        port=config.APP_PORT,
+        workers=config.APP_WORKERS,
+        loop=config.APP_LOOP,
+        http=config.APP_HTTP,
+    )
@@ -0,0 +1,54 @@
+import typing as t
+
+
+class Metric:
+    type_name = 'untyped'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values: t.Dict[t.Tuple[t.Tuple[str, str], ...], float] = {}
+        REGISTRY.append(self)
+
+    @staticmethod
+    def _key(labels: t.Dict[str, t.Any]) -> t.Tuple[t.Tuple[str, str], ...]:
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> t.List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        for key, value in self._values.items():
+            labels = ','.join(f'{name}="{label}"' for name, label in key)
+            lines.append(f'{self.name}{{{labels}}} {value}' if labels else f'{self.name} {value}')
+        return lines
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+REGISTRY: t.List[Metric] = []
+
+
+def render() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
@@ -3,7 +3,28 @@ import decimal
 import typing as t
 
 from fastapi_users import models
-from pydantic import BaseModel as PydanticBaseModel, UUID4, validator
+from pydantic import BaseModel as PydanticBaseModel, HttpUrl, UUID4, validator
+
+import config
+import enums
+
+
+AMOUNT_DECIMAL_PLACES = 8
+
+
+# With AMOUNTS_AS_MINOR_UNITS amounts are stored as BIGINT counts of 1e-8 instead of unbounded NUMERIC
+def to_storage_amount(value: t.Optional[decimal.Decimal]) -> t.Union[decimal.Decimal, int, None]:
+    if value is None or not config.AMOUNTS_AS_MINOR_UNITS:
+        return value
+    return int(value.scaleb(AMOUNT_DECIMAL_PLACES))
+
+
+def from_storage_amount(value: t.Union[decimal.Decimal, int, None]) -> t.Optional[decimal.Decimal]:
+    if value is None or not config.AMOUNTS_AS_MINOR_UNITS:
+        return value
+    amount = decimal.Decimal(value).scaleb(-AMOUNT_DECIMAL_PLACES).normalize()
+    # normalize() would render whole amounts like 100 as 1E+2
+    return amount.quantize(1) if amount.as_tuple().exponent > 0 else amount
 
 
 # Pydantic models
@@ -43,6 +64,13 @@ class WalletDB(Wallet):
     user_id: t.Optional[UUID4]
     name: t.Optional[str]
     balance: t.Optional[decimal.Decimal]
+    version: t.Optional[int]
+    concurrency: t.Optional[enums.WalletConcurrency]
+    held: t.Optional[decimal.Decimal]
+
+    @property
+    def available(self) -> t.Optional[decimal.Decimal]:
+        return self.balance - (self.held or 0) if self.balance is not None else None
 
 
 class WalletCreate(BaseModel):
@@ -60,7 +88,7 @@ class WalletDeposit(BaseModel):
 
     @validator('value')
     def value_must_have_8_decimals(cls, v: decimal.Decimal):
-        if abs(v.as_tuple().exponent) > 8:
+        if abs(v.as_tuple().exponent) > AMOUNT_DECIMAL_PLACES:
             raise ValueError('Must have at most 8 decimal places')
         return v
 
@@ -69,6 +97,62 @@ class WalletTransfer(WalletDeposit):
     pass
 
 
+class HoldCreate(WalletDeposit):
+    recipient_wallet_id: UUID4
+    ttl_seconds: t.Optional[int]
+
+    @validator('ttl_seconds')
+    def ttl_must_be_limited(cls, v: t.Optional[int]):
+        if v is None:
+            return v
+        if not 0 < v <= config.HOLDS_MAX_TTL_SECONDS:
+            raise ValueError(f'Must be between 1 and {config.HOLDS_MAX_TTL_SECONDS}')
+        return v
+
+
+# Captures the whole hold by default, the rest of a partial capture is released
+class HoldCapture(BaseModel):
+    value: t.Optional[decimal.Decimal]
+
+    @validator('value')
+    def value_must_be_valid_amount(cls, v: t.Optional[decimal.Decimal]):
+        if v is None:
+            return v
+        if v <= decimal.Decimal(0):
+            raise ValueError('Must be positive')
+        if abs(v.as_tuple().exponent) > AMOUNT_DECIMAL_PLACES:
+            raise ValueError('Must have at most 8 decimal places')
+        return v
+
+
+class Hold(BaseModel):
+    id: UUID4
+    wallet_id: UUID4
+    recipient_wallet_id: UUID4
+    value: decimal.Decimal
+    status: enums.HoldStatus
+    created_at: datetime.datetime
+    expires_at: datetime.datetime
+
+
+class HoldList(BaseModel):
+    holds: t.List[Hold]
+    balance: decimal.Decimal
+    held: decimal.Decimal
+    available: decimal.Decimal
+
+
+class HoldDB(BaseModel):
+    id: t.Optional[UUID4]
+    wallet_id: t.Optional[UUID4]
+    recipient_wallet_id: t.Optional[UUID4]
+    value: t.Optional[decimal.Decimal]
+    status: t.Optional[enums.HoldStatus]
+    created_at: t.Optional[datetime.datetime]
+    expires_at: t.Optional[datetime.datetime]
+    resolved_at: t.Optional[datetime.datetime]
+
+
 class WalletValueBalance(BaseModel):
     value: decimal.Decimal
     balance: t.Optional[decimal.Decimal]
@@ -81,10 +165,77 @@ class WalletId(BaseModel):
 class WalletListItem(BaseModel):
     id: UUID4
     name: str
+    balance: t.Optional[decimal.Decimal]
 
 
 class WalletList(BaseModel):
     wallets: t.List[WalletListItem]
+    total_balance: t.Optional[decimal.Decimal]
+    next_after: t.Optional[UUID4]
+
+
+class WalletListDB(BaseModel):
+    wallets: t.List[WalletDB]
+    total_balance: t.Optional[decimal.Decimal]
+    wallet_count: t.Optional[int]
+    version_sum: t.Optional[int]
+
+
+class SpendingLimits(BaseModel):
+    hourly: t.Optional[decimal.Decimal]
+    daily: t.Optional[decimal.Decimal]
+
+    @validator('hourly', 'daily')
+    def limit_must_be_valid_amount(cls, v: t.Optional[decimal.Decimal]):
+        if v is None:
+            return v
+        if v <= decimal.Decimal(0):
+            raise ValueError('Must be positive')
+        if abs(v.as_tuple().exponent) > AMOUNT_DECIMAL_PLACES:
+            raise ValueError('Must have at most 8 decimal places')
+        return v
+
+
+class SpendingLimitsState(SpendingLimits):
+    hourly_spent: decimal.Decimal
+    daily_spent: decimal.Decimal
+
+
+class SpendingLimitDB(BaseModel):
+    wallet_id: t.Optional[UUID4]
+    hourly_limit: t.Optional[decimal.Decimal]
+    daily_limit: t.Optional[decimal.Decimal]
+    hourly_spent: t.Optional[decimal.Decimal]
+    daily_spent: t.Optional[decimal.Decimal]
+
+
+class WalletBalance(BaseModel):
+    wallet_id: UUID4
+    timestamp: datetime.datetime
+    balance: decimal.Decimal
+
+
+class WalletBalanceList(BaseModel):
+    balances: t.List[WalletBalance]
+
+
+class WalletBalanceQuery(BaseModel):
+    wallet_ids: t.List[UUID4]
+    timestamp: datetime.datetime
+
+    @validator('wallet_ids')
+    def wallet_ids_must_be_limited(cls, v: t.List[UUID4]):
+        if not v:
+            raise ValueError('Must not be empty')
+        if len(v) > config.BALANCE_QUERY_MAX_WALLETS:
+            raise ValueError(f'Must have at most {config.BALANCE_QUERY_MAX_WALLETS} wallets')
+        return v
+
+
+class WalletBalanceDB(BaseModel):
+    id: t.Optional[UUID4]
+    user_id: t.Optional[UUID4]
+    balance: t.Optional[decimal.Decimal]
 
 
 class TransactionDB(BaseModel):
@@ -93,3 +244,52 @@ class TransactionDB(BaseModel):
     recipient_wallet_id: t.Optional[UUID4]
     value: t.Optional[decimal.Decimal]
     timestamp: t.Optional[datetime.datetime]
+
+
+# Narrows wallet operations down, values are compared by absolute amount like they are exported
+class OperationFilter(BaseModel):
+    counterparty_wallet_id: t.Optional[UUID4]
+    min_value: t.Optional[decimal.Decimal]
+    max_value: t.Optional[decimal.Decimal]
+    from_transaction_id: t.Optional[int]
+    to_transaction_id: t.Optional[int]
+
+
+class WebhookEndpoint(BaseModel):
+    url: HttpUrl
+
+
+class OutboxEventDB(BaseModel):
+    id: t.Optional[int]
+    user_id: t.Optional[UUID4]
+    url: t.Optional[str]
+    payload: t.Optional[str]
+    created_at: t.Optional[datetime.datetime]
+    attempts: t.Optional[int]
+    next_attempt_at: t.Optional[datetime.datetime]
+
+
+class ExportJob(BaseModel):
+    id: UUID4
+    wallet_id: UUID4
+    status: enums.ExportJobStatus
+    rows_written: int
+    rows_total: t.Optional[int]
+    progress: t.Optional[float]
+    created_at: datetime.datetime
+    expires_at: t.Optional[datetime.datetime]
+
+
+class ExportJobDB(BaseModel):
+    id: t.Optional[UUID4]
+    user_id: t.Optional[UUID4]
+    wallet_id: t.Optional[UUID4]
+    from_timestamp: t.Optional[datetime.datetime]
+    to_timestamp: t.Optional[datetime.datetime]
+    side: t.Optional[enums.TransferSide]
+    status: t.Optional[enums.ExportJobStatus]
+    rows_written: t.Optional[int]
+    rows_total: t.Optional[int]
+    created_at: t.Optional[datetime.datetime]
+    updated_at: t.Optional[datetime.datetime]
+    expires_at: t.Optional[datetime.datetime]
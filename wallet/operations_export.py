@@ -0,0 +1,301 @@
+import asyncio
+import collections
+import contextvars
+import csv
+import datetime
+import heapq
+import io
+import typing as t
+import zipfile
+
+from pydantic.types import UUID4
+
+import enums
+import metrics
+import models
+import shards
+from services import make_csv_stream
+
+
+PARALLEL_FALLBACKS = metrics.Counter(
+    'operations_parallel_fallbacks_total', 'Parallel exports read by one connection as the pool had none to spare',
+)
+
+
+# An empty context keeps the connection bound to the caller out of the task, so the task reads over its own
+# pooled connection instead of queueing on (or joining the transaction of) the caller's one
+def _spawn(coroutine: t.Awaitable) -> asyncio.Future:
+    return contextvars.Context().run(asyncio.ensure_future, coroutine)
+
+
+# Keyset cursor over the history of one wallet, the next page is read while the current one is consumed
+class WalletPages:
+    def __init__(
+            self,
+            transaction_db_adapter: shards.ShardedTransactionDatabaseAdapter,
+            wallet_id: UUID4,
+            from_timestamp: t.Optional[datetime.datetime],
+            to_timestamp: t.Optional[datetime.datetime],
+            side: t.Optional[enums.TransferSide],
+            page_size: int,
+            semaphore: asyncio.Semaphore,
+            operation_filter: t.Optional[models.OperationFilter] = None,
+    ):
+        self.transaction_db_adapter = transaction_db_adapter
+        self.wallet_id = wallet_id
+        self.from_timestamp = from_timestamp
+        self.to_timestamp = to_timestamp
+        self.side = side
+        self.page_size = page_size
+        self.semaphore = semaphore
+        self.operation_filter = operation_filter
+        self._after: t.Optional[t.Tuple[datetime.datetime, int]] = None
+        self._done = False
+        self._next: t.Optional[asyncio.Future] = None
+
+    def prefetch(self):
+        if self._next is None and not self._done:
+            self._next = _spawn(self._read())
+
+    async def next_page(self) -> t.List[models.TransactionDB]:
+        self.prefetch()
+        if self._next is None:
+            return []
+        page, self._next = await self._next, None
+        if len(page) < self.page_size:
+            self._done = True
+        else:
+            self._after = (page[-1].timestamp, page[-1].id)
+            self.prefetch()
+        return page
+
+    async def _read(self) -> t.List[models.TransactionDB]:
+        async with self.semaphore:
+            return await self.transaction_db_adapter.get_page(
+                wallet_id=self.wallet_id,
+                from_timestamp=self.from_timestamp,
+                to_timestamp=self.to_timestamp,
+                transfer_side=self.side,
+                after=self._after,
+                limit=self.page_size,
+                operation_filter=self.operation_filter,
+            )
+
+    def close(self):
+        if self._next:
+            self._next.cancel()
+
+
+def make_header() -> str:
+    header = io.StringIO()
+    csv.DictWriter(header, fieldnames=models.TransactionDB.__fields__).writeheader()
+    return header.getvalue()
+
+
+# k-way merge by (timestamp, id) holding one page per wallet plus the one being read ahead.
+# Transfers between two of the exported wallets come from both and are written once.
+async def stream_merged_csv(cursors: t.List[WalletPages], chunk_size: int) -> t.AsyncIterator[str]:
+    try:
+        yield make_header()
+        for cursor in cursors:
+            cursor.prefetch()
+        pages = [collections.deque(await cursor.next_page()) for cursor in cursors]
+        heap = [(page[0].timestamp, page[0].id, index) for index, page in enumerate(pages) if page]
+        heapq.heapify(heap)
+        rows = []
+        last_id = None
+        while heap:
+            _, _, index = heapq.heappop(heap)
+            transaction = pages[index].popleft()
+            if transaction.id != last_id:
+                rows.append(transaction)
+                last_id = transaction.id
+            if not pages[index]:
+                pages[index].extend(await cursors[index].next_page())
+            if pages[index]:
+                heapq.heappush(heap, (pages[index][0].timestamp, pages[index][0].id, index))
+            if len(rows) >= chunk_size:
+                yield make_csv_stream(rows, header=False).getvalue()
+                rows = []
+        if rows:
+            yield make_csv_stream(rows, header=False).getvalue()
+    finally:
+        for cursor in cursors:
+            cursor.close()
+
+
+class _ChunkBuffer(io.RawIOBase):
+    def __init__(self):
+        self.chunks: t.List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+# Wallets are written one after another, the first pages of the next `read_ahead` wallets are read meanwhile.
+# The output is not seekable, so sizes go to data descriptors after every file.
+async def stream_zip(
+        cursors: t.List[WalletPages],
+        filenames: t.List[str],
+        read_ahead: int,
+) -> t.AsyncIterator[bytes]:
+    buffer = _ChunkBuffer()
+    try:
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for index, (cursor, filename) in enumerate(zip(cursors, filenames)):
+                for next_cursor in cursors[index:index + read_ahead + 1]:
+                    next_cursor.prefetch()
+                with archive.open(filename, 'w', force_zip64=True) as file:
+                    file.write(make_header().encode())
+                    while True:
+                        page = await cursor.next_page()
+                        if not page:
+                            break
+                        file.write(make_csv_stream(page, header=False).getvalue().encode())
+                        yield buffer.take()
+                yield buffer.take()
+        yield buffer.take()
+    finally:
+        for cursor in cursors:
+            cursor.close()
+
+
+# Two pages per open cursor (the current one and the one read ahead) fit in the row budget
+def get_page_size(open_cursors: int, row_budget: int, max_page_size: int) -> int:
+    return max(min(row_budget // (2 * open_cursors), max_page_size), 1)
+
+
+# Consecutive ranges covering first..last, the bounds are inclusive like from_timestamp and to_timestamp
+def split_time_range(
+        first: datetime.datetime,
+        last: datetime.datetime,
+        max_chunks: int,
+        min_chunk_seconds: int,
+) -> t.List[t.Tuple[datetime.datetime, datetime.datetime]]:
+    chunk_count = max(min(max_chunks, int((last - first).total_seconds() // max(min_chunk_seconds, 1))), 1)
+    step = (last - first) / chunk_count
+    starts = [first + step * index for index in range(chunk_count)]
+    # Postgres timestamps have microsecond resolution, so a chunk ends right before the next one starts
+    ends = [start - datetime.timedelta(microseconds=1) for start in starts[1:]] + [last]
+    return list(zip(starts, ends))
+
+
+async def _read_pages(
+        transaction_db_adapter: shards.ShardedTransactionDatabaseAdapter,
+        wallet_id: UUID4,
+        from_timestamp: t.Optional[datetime.datetime],
+        to_timestamp: t.Optional[datetime.datetime],
+        side: t.Optional[enums.TransferSide],
+        operation_filter: t.Optional[models.OperationFilter],
+        page_size: int,
+) -> t.AsyncIterator[t.List[models.TransactionDB]]:
+    after = None
+    while True:
+        page = await transaction_db_adapter.get_page(
+            wallet_id=wallet_id,
+            from_timestamp=from_timestamp,
+            to_timestamp=to_timestamp,
+            transfer_side=side,
+            after=after,
+            limit=page_size,
+            operation_filter=operation_filter,
+        )
+        yield page
+        if len(page) < page_size:
+            return
+        after = (page[-1].timestamp, page[-1].id)
+
+
+# Reads one chunk inside the exported snapshot. The queue is bounded, so a chunk far ahead of the output
+# waits for it instead of piling rows up. Failures are passed on to be raised once the output gets to the chunk.
+async def _read_chunk(
+        transaction_db_adapter: shards.ShardedTransactionDatabaseAdapter,
+        snapshot_id: str,
+        started: asyncio.Event,
+        queue: asyncio.Queue,
+        wallet_id: UUID4,
+        *args: t.Any,
+):
+    try:
+        async with transaction_db_adapter.use_snapshot(wallet_id, snapshot_id):
+            started.set()
+            async for page in _read_pages(transaction_db_adapter, wallet_id, *args):
+                await queue.put(page)
+        await queue.put(None)
+    except Exception as error:
+        started.set()
+        await queue.put(error)
+
+
+async def _cancel(tasks: t.List[asyncio.Future]):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# History of one wallet read by several connections at once: the range is split into time chunks read concurrently
+# in one snapshot, and their pages are written out chunk after chunk, so rows keep their (timestamp, id) order.
+# Chunks that cannot all get a connection within acquire_timeout are given up, and the connection of the request
+# reads the whole range, so concurrent exports holding the pool never wait on each other.
+async def stream_parallel_csv(
+        transaction_db_adapter: shards.ShardedTransactionDatabaseAdapter,
+        wallet_id: UUID4,
+        from_timestamp: t.Optional[datetime.datetime],
+        to_timestamp: t.Optional[datetime.datetime],
+        side: t.Optional[enums.TransferSide],
+        operation_filter: t.Optional[models.OperationFilter],
+        page_size: int,
+        workers: int,
+        min_chunk_seconds: int,
+        buffer_pages: int,
+        acquire_timeout: float,
+) -> t.AsyncIterator[str]:
+    yield make_header()
+    async with transaction_db_adapter.export_snapshot(wallet_id) as snapshot_id:
+        first, last = await transaction_db_adapter.get_time_bounds(wallet_id, from_timestamp, to_timestamp)
+        if first is None:
+            return
+        chunks = split_time_range(first, last, workers, min_chunk_seconds)
+        started = [asyncio.Event() for _ in chunks]
+        queues = [asyncio.Queue(buffer_pages) for _ in chunks]
+        tasks = [
+            _spawn(_read_chunk(
+                transaction_db_adapter, snapshot_id, chunk_started, queue,
+                wallet_id, chunk_from, chunk_to, side, operation_filter, page_size,
+            ))
+            for chunk_started, queue, (chunk_from, chunk_to) in zip(started, queues, chunks)
+        ] if len(chunks) > 1 else []
+        try:
+            if tasks:
+                try:
+                    await asyncio.wait_for(asyncio.gather(*(event.wait() for event in started)), acquire_timeout)
+                except asyncio.TimeoutError:
+                    PARALLEL_FALLBACKS.inc()
+                    await _cancel(tasks)
+                    tasks = []
+            if not tasks:
+                async for page in _read_pages(
+                        transaction_db_adapter, wallet_id, first, last, side, operation_filter, page_size,
+                ):
+                    if page:
+                        yield make_csv_stream(page, header=False).getvalue()
+                return
+            for queue in queues:
+                while True:
+                    page = await queue.get()
+                    if page is None:
+                        break
+                    if isinstance(page, Exception):
+                        raise page
+                    if page:
+                        yield make_csv_stream(page, header=False).getvalue()
+        finally:
+            await _cancel(tasks)
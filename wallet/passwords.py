@@ -0,0 +1,31 @@
+import asyncio
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi_users import password
+
+import admission
+
+
+# bcrypt releases the GIL, so a thread pool spreads hashing over cores and keeps it off the event loop.
+# Work beyond `max_pending` is rejected instead of queueing up behind a login storm.
+class PasswordHasher:
+    def __init__(self, workers: int, max_pending: int):
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password')
+
+    async def _run(self, function: t.Callable, *args: t.Any) -> t.Any:
+        if 0 < self.max_pending <= self.pending:
+            admission.reject(503, 'Too many password checks in progress', 1, 'password')
+        self.pending += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self._executor, function, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, plain_password: str) -> str:
+        return await self._run(password.get_password_hash, plain_password)
+
+    async def verify_and_update(self, plain_password: str, hashed_password: str) -> t.Tuple[bool, t.Optional[str]]:
+        return await self._run(password.verify_and_update_password, plain_password, hashed_password)
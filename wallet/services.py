@@ -1,5 +1,7 @@
 import csv
 import datetime
+import decimal
+import hashlib
 import typing as t
 from io import StringIO
 
@@ -9,23 +11,66 @@ import enums
 import models
 
 
-def make_csv_stream(transactions: t.List[models.TransactionDB]) -> StringIO:
+def make_simple_error_message(msg: str, **kwargs) -> t.List[t.Dict[str, t.Any]]:
+    kwargs = kwargs.copy()
+    kwargs['msg'] = msg
+    return [kwargs]
+
+
+def find_exceeded_spending_limit(
+        spending: models.SpendingLimitDB,
+        value: decimal.Decimal,
+) -> t.Optional[enums.SpendingLimitWindow]:
+    for window in enums.SpendingLimitWindow:
+        limit = getattr(spending, f'{window.value}_limit')
+        if limit is not None and getattr(spending, f'{window.value}_spent') + value > limit:
+            return window
+    return None
+
+
+def to_naive_utc(timestamp: datetime.datetime) -> datetime.datetime:
+    if timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def make_etag(*parts: t.Any) -> str:
+    digest = hashlib.sha1('\x1f'.join(str(part) for part in parts).encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: t.Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # If-None-Match uses weak comparison, so W/ prefixes are ignored
+    tags = (tag.strip() for tag in if_none_match.split(','))
+    return etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags)
+
+
+def make_csv_stream(transactions: t.List[models.TransactionDB], header: bool = True) -> StringIO:
     io = StringIO()
     writer = csv.DictWriter(io, fieldnames=models.TransactionDB.__fields__)
-    writer.writeheader()
+    if header:
+        writer.writeheader()
     for transaction in transactions:
-        if not transaction.sender_wallet_id:
-            transaction.sender_wallet_id = 'EXTERNAL_DEPOSIT'
-        writer.writerow(transaction.dict())
+        # Results may be shared between concurrent requests, so they are never modified in place
+        transaction_dict = transaction.dict()
+        if not transaction_dict['sender_wallet_id']:
+            transaction_dict['sender_wallet_id'] = 'EXTERNAL_DEPOSIT'
+        writer.writerow(transaction_dict)
     io.seek(0)
     return io
 
 
 def make_filename(
-        wallet_id: UUID4,
+        wallet_id: t.Union[UUID4, str],
         from_timestamp: datetime.datetime,
         to_timestamp: datetime.datetime,
         side: enums.TransferSide,
+        extension: str = 'csv',
+        operation_filter: models.OperationFilter = None,
 ) -> str:
     filename_suffixes = [str(wallet_id)]
 
@@ -41,6 +86,20 @@ def make_filename(
         filename_suffixes.append(side.value)
     elif side is enums.TransferSide.withdraw:
         filename_suffixes.append(side.value)
+
+    # Filtered exports of the same range get names of their own
+    if operation_filter:
+        filename_suffixes.extend(f'{name}{value}' for name, value in operation_filter.dict(exclude_none=True).items())
     filename_suffix = '-'.join(filename_suffixes)
-    filename = f'export-{filename_suffix}.csv'
+    filename = f'export-{filename_suffix}.{extension}'
     return filename
+
+
+def make_export_job(job: models.ExportJobDB) -> models.ExportJob:
+    if job.status is enums.ExportJobStatus.done:
+        progress = 1.0
+    elif job.rows_total:
+        progress = min(job.rows_written / job.rows_total, 1.0)
+    else:
+        progress = None
+    return models.ExportJob(progress=progress, **job.dict())
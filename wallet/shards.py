@@ -0,0 +1,379 @@
+import asyncio
+import contextlib
+import datetime
+import decimal
+import heapq
+import itertools
+import logging
+import typing as t
+import uuid
+import zlib
+
+import asyncpg
+from databases import Database
+from pydantic.types import UUID4
+from sqlalchemy import Table
+
+import adapters
+import enums
+import ids
+import metrics
+import models
+import tracing
+
+
+_LOGGER = logging.getLogger(__name__)
+
+IN_DOUBT = metrics.Counter('shard_transactions_in_doubt_total', 'Cross-shard transfers left for recovery')
+
+
+class ShardRouter:
+    def __init__(self, databases: t.List[Database]):
+        self.databases = databases
+
+    # The hash only depends on the wallet id and the number of shards, so it is the same in every process
+    def get_index(self, wallet_id: UUID4) -> int:
+        if len(self.databases) == 1:
+            return 0
+        return zlib.crc32(uuid.UUID(str(wallet_id)).bytes) % len(self.databases)
+
+    def get_database(self, wallet_id: UUID4) -> Database:
+        return self.databases[self.get_index(wallet_id)]
+
+    def group(self, wallet_ids: t.Iterable[UUID4]) -> t.Dict[int, t.List[UUID4]]:
+        groups = {}
+        for wallet_id in wallet_ids:
+            groups.setdefault(self.get_index(wallet_id), []).append(wallet_id)
+        return groups
+
+    async def connect(self):
+        await asyncio.gather(*(database.connect() for database in self.databases))
+
+    async def disconnect(self):
+        await asyncio.gather(*(database.disconnect() for database in self.databases))
+
+
+# Postgres two-phase commit: every shard prepares, the decision is written to the first database, then every
+# shard commits. Transfers left prepared by a crash are finished by tools/recover_transactions.py.
+class TwoPhaseCommit:
+    GID_PREFIX = 'wallet-'
+
+    def __init__(self, log_database: Database, log_table: Table):
+        self.log_database = log_database
+        self.log_table = log_table
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, databases: t.List[Database]):
+        gid = f'{self.GID_PREFIX}{uuid.uuid4()}'
+        with tracing.span('db.two_phase_commit', shards=len(databases)):
+            async with contextlib.AsyncExitStack() as stack:
+                # Connections are bound to the current task before any gather() in the body
+                for database in databases:
+                    await stack.enter_async_context(database.connection())
+                prepared = []
+                try:
+                    for database in databases:
+                        await database.execute('BEGIN')
+                    yield
+                    for database in databases:
+                        await database.execute(f"PREPARE TRANSACTION '{gid}'")
+                        prepared.append(database)
+                    # Without a decision row recovery rolls prepared transactions back
+                    await self.log_database.execute(self.log_table.insert().values(
+                        gid=gid,
+                        created_at=datetime.datetime.utcnow(),
+                    ))
+                except BaseException:
+                    for database in databases:
+                        await self._finish(database, 'ROLLBACK PREPARED' if database in prepared else 'ROLLBACK', gid)
+                    raise
+                with tracing.span('db.commit'):
+                    committed = [await self._finish(database, 'COMMIT PREPARED', gid) for database in databases]
+                if all(committed):
+                    await self.log_database.execute(self.log_table.delete().where(self.log_table.c.gid == gid))
+                else:
+                    IN_DOUBT.inc()
+
+    @staticmethod
+    async def _finish(database: Database, statement: str, gid: str) -> bool:
+        try:
+            await database.execute(statement if statement == 'ROLLBACK' else f"{statement} '{gid}'")
+            return True
+        except Exception:
+            _LOGGER.exception(f'{statement} of {gid} failed')
+            return False
+
+
+class ShardedWalletDatabaseAdapter:
+    def __init__(
+            self,
+            router: ShardRouter,
+            shards: t.List[adapters.WalletDatabaseAdapter],
+            two_phase_commit: TwoPhaseCommit = None,
+            name_table: Table = None,
+    ):
+        self.router = router
+        self.shards = shards
+        self.two_phase_commit = two_phase_commit
+        self.name_table = name_table
+
+    def get_shard(self, wallet_id: UUID4) -> adapters.WalletDatabaseAdapter:
+        return self.shards[self.router.get_index(wallet_id)]
+
+    async def create(self, wallet: models.WalletCreate, user_id: UUID4) -> UUID4:
+        wallet_id = ids.make_wallet_id()
+        if len(self.shards) == 1:
+            return await self.shards[0].create(wallet, user_id, wallet_id)
+        # The unique constraint of a shard only covers its own wallets, so the name is also claimed in the registry of
+        # the first database, atomically with the wallet row
+        log_database = self.router.databases[0]
+        database = self.router.get_database(wallet_id)
+        if database is log_database:
+            transaction = log_database.transaction()
+        else:
+            transaction = self.two_phase_commit.transaction([log_database, database])
+        async with transaction:
+            try:
+                await log_database.execute(self.name_table.insert().values(name=wallet.name, wallet_id=wallet_id))
+            except asyncpg.UniqueViolationError:
+                raise ValueError('Wallet with this name already exists')
+            return await self.get_shard(wallet_id).create(wallet, user_id, wallet_id)
+
+    async def get(self, wallet_id: UUID4) -> t.Optional[models.WalletDB]:
+        return await self.get_shard(wallet_id).get(wallet_id)
+
+    async def get_many(
+            self,
+            user_id: UUID4,
+            after: UUID4 = None,
+            limit: int = None,
+            include_balance: bool = False,
+    ) -> models.WalletListDB:
+        if len(self.shards) == 1:
+            return await self.shards[0].get_many(user_id, after, limit, include_balance)
+        wallet_lists = await asyncio.gather(*(
+            self._get_many_with_totals(shard, user_id, after, limit, include_balance) for shard in self.shards
+        ))
+        wallets = heapq.merge(*(wallet_list.wallets for wallet_list in wallet_lists), key=lambda wallet: wallet.id)
+        return models.WalletListDB(
+            wallets=list(itertools.islice(wallets, limit)),
+            total_balance=sum(wallet_list.total_balance for wallet_list in wallet_lists) if include_balance else None,
+            wallet_count=sum(wallet_list.wallet_count for wallet_list in wallet_lists),
+            version_sum=sum(wallet_list.version_sum for wallet_list in wallet_lists),
+        )
+
+    @staticmethod
+    async def _get_many_with_totals(
+            shard: adapters.WalletDatabaseAdapter,
+            user_id: UUID4,
+            after: t.Optional[UUID4],
+            limit: t.Optional[int],
+            include_balance: bool,
+    ) -> models.WalletListDB:
+        wallet_list = await shard.get_many(user_id, after, limit, include_balance)
+        # Totals come along with the first row, so a shard with an empty page is asked separately
+        if wallet_list.wallets:
+            return wallet_list
+        wallet_list.wallet_count, wallet_list.version_sum = await shard.get_list_version(user_id)
+        if include_balance:
+            wallet_list.total_balance = await shard.get_total_balance(user_id)
+        return wallet_list
+
+    async def get_list_version(self, user_id: UUID4) -> t.Tuple[int, int]:
+        versions = await asyncio.gather(*(shard.get_list_version(user_id) for shard in self.shards))
+        return sum(count for count, _ in versions), sum(version_sum for _, version_sum in versions)
+
+    async def lock(self, wallet_id: UUID4) -> t.Optional[models.WalletDB]:
+        return await self.get_shard(wallet_id).lock(wallet_id)
+
+    # One lock at a time in (shard, id) order, so that transfers in opposite directions cannot each hold one lock and
+    # wait for the other. Across shards no database would detect that deadlock.
+    async def lock_many(self, wallet_ids: t.List[UUID4]) -> t.List[t.Optional[models.WalletDB]]:
+        wallets = {}
+        for wallet_id in sorted(wallet_ids, key=lambda wallet_id: (self.router.get_index(wallet_id), str(wallet_id))):
+            wallets[wallet_id] = await self.lock(wallet_id)
+        return [wallets[wallet_id] for wallet_id in wallet_ids]
+
+    async def read(self, wallet_id: UUID4) -> t.Optional[models.WalletDB]:
+        return await self.get_shard(wallet_id).read(wallet_id)
+
+    async def deposit(self, wallet_id: UUID4, delta: decimal.Decimal) -> t.Optional[models.WalletDB]:
+        return await self.get_shard(wallet_id).deposit(wallet_id, delta)
+
+    async def decrease_balance_if_unchanged(
+            self,
+            wallet_id: UUID4,
+            delta: decimal.Decimal,
+            version: int,
+    ) -> t.Optional[decimal.Decimal]:
+        return await self.get_shard(wallet_id).decrease_balance_if_unchanged(wallet_id, delta, version)
+
+    async def increase_balance(self, wallet_id: UUID4, delta: decimal.Decimal) -> decimal.Decimal:
+        return await self.get_shard(wallet_id).increase_balance(wallet_id, delta)
+
+    async def decrease_balance(self, wallet_id: UUID4, delta: decimal.Decimal) -> decimal.Decimal:
+        return await self.get_shard(wallet_id).decrease_balance(wallet_id, delta)
+
+    async def increase_held(self, wallet_id: UUID4, delta: decimal.Decimal) -> decimal.Decimal:
+        return await self.get_shard(wallet_id).increase_held(wallet_id, delta)
+
+    async def decrease_held(self, wallet_id: UUID4, delta: decimal.Decimal) -> decimal.Decimal:
+        return await self.get_shard(wallet_id).decrease_held(wallet_id, delta)
+
+
+class ShardedTransactionDatabaseAdapter:
+    def __init__(self, router: ShardRouter, shards: t.List[adapters.TransactionDatabaseAdapter]):
+        self.router = router
+        self.shards = shards
+
+    def get_shard(self, wallet_id: UUID4) -> adapters.TransactionDatabaseAdapter:
+        return self.shards[self.router.get_index(wallet_id)]
+
+    # The transaction row stays with the sender, transaction ids are unique across shards (see tools/create_tables.py)
+    async def create(self, transaction: models.TransactionDB) -> int:
+        recipient_shard = self.get_shard(transaction.recipient_wallet_id)
+        if not transaction.sender_wallet_id:
+            return await recipient_shard.create(transaction)
+        sender_shard = self.get_shard(transaction.sender_wallet_id)
+        if sender_shard is recipient_shard:
+            return await sender_shard.create(transaction)
+        transaction_id = await sender_shard.create(transaction, [transaction.sender_wallet_id])
+        await recipient_shard.create_entries(transaction, transaction_id, [transaction.recipient_wallet_id])
+        return transaction_id
+
+    async def get_many(
+            self,
+            wallet_id: UUID4,
+            from_timestamp: datetime.datetime = None,
+            to_timestamp: datetime.datetime = None,
+            transfer_side: enums.TransferSide = None,
+            operation_filter: models.OperationFilter = None,
+    ) -> t.List[models.TransactionDB]:
+        return await self.get_shard(wallet_id).get_many(
+            wallet_id, from_timestamp, to_timestamp, transfer_side, operation_filter,
+        )
+
+    async def get_page(
+            self,
+            wallet_id: UUID4,
+            from_timestamp: datetime.datetime = None,
+            to_timestamp: datetime.datetime = None,
+            transfer_side: enums.TransferSide = None,
+            after: t.Tuple[datetime.datetime, int] = None,
+            limit: int = None,
+            operation_filter: models.OperationFilter = None,
+    ) -> t.List[models.TransactionDB]:
+        return await self.get_shard(wallet_id).get_page(
+            wallet_id, from_timestamp, to_timestamp, transfer_side, after, limit, operation_filter,
+        )
+
+    async def count(
+            self,
+            wallet_id: UUID4,
+            from_timestamp: datetime.datetime = None,
+            to_timestamp: datetime.datetime = None,
+            transfer_side: enums.TransferSide = None,
+            operation_filter: models.OperationFilter = None,
+    ) -> int:
+        return await self.get_shard(wallet_id).count(
+            wallet_id, from_timestamp, to_timestamp, transfer_side, operation_filter,
+        )
+
+    async def get_time_bounds(
+            self,
+            wallet_id: UUID4,
+            from_timestamp: datetime.datetime = None,
+            to_timestamp: datetime.datetime = None,
+    ) -> t.Tuple[t.Optional[datetime.datetime], t.Optional[datetime.datetime]]:
+        return await self.get_shard(wallet_id).get_time_bounds(wallet_id, from_timestamp, to_timestamp)
+
+    # Snapshots belong to one database, so both sides are routed by the wallet
+    def export_snapshot(self, wallet_id: UUID4) -> t.AsyncContextManager[str]:
+        return self.get_shard(wallet_id).export_snapshot()
+
+    def use_snapshot(self, wallet_id: UUID4, snapshot_id: str) -> t.AsyncContextManager[None]:
+        return self.get_shard(wallet_id).use_snapshot(snapshot_id)
+
+
+class ShardedBalanceCheckpointDatabaseAdapter:
+    def __init__(self, router: ShardRouter, shards: t.List[adapters.BalanceCheckpointDatabaseAdapter]):
+        self.router = router
+        self.shards = shards
+
+    async def get_many(self, wallet_ids: t.List[UUID4], timestamp: datetime.datetime) -> t.List[models.WalletBalanceDB]:
+        groups = self.router.group(wallet_ids)
+        balance_lists = await asyncio.gather(*(
+            self.shards[index].get_many(shard_wallet_ids, timestamp) for index, shard_wallet_ids in groups.items()
+        ))
+        return list(itertools.chain.from_iterable(balance_lists))
+
+
+class ShardedSpendingLimitDatabaseAdapter:
+    def __init__(self, router: ShardRouter, shards: t.List[adapters.SpendingLimitDatabaseAdapter]):
+        self.router = router
+        self.shards = shards
+
+    def get_shard(self, wallet_id: UUID4) -> adapters.SpendingLimitDatabaseAdapter:
+        return self.shards[self.router.get_index(wallet_id)]
+
+    async def set(self, wallet_id: UUID4, limits: models.SpendingLimits):
+        await self.get_shard(wallet_id).set(wallet_id, limits)
+
+    async def get_spent(self, wallet_id: UUID4, now: datetime.datetime) -> t.Optional[models.SpendingLimitDB]:
+        return await self.get_shard(wallet_id).get_spent(wallet_id, now)
+
+    async def record(self, wallet_id: UUID4, now: datetime.datetime, value: decimal.Decimal):
+        await self.get_shard(wallet_id).record(wallet_id, now, value)
+
+
+# Holds live on the shard of the wallet they reserve funds of
+class ShardedHoldDatabaseAdapter:
+    def __init__(self, router: ShardRouter, shards: t.List[adapters.HoldDatabaseAdapter]):
+        self.router = router
+        self.shards = shards
+
+    def get_shard(self, wallet_id: UUID4) -> adapters.HoldDatabaseAdapter:
+        return self.shards[self.router.get_index(wallet_id)]
+
+    async def create(self, hold: models.HoldDB) -> models.HoldDB:
+        return await self.get_shard(hold.wallet_id).create(hold)
+
+    async def get(self, wallet_id: UUID4, hold_id: UUID4) -> t.Optional[models.HoldDB]:
+        return await self.get_shard(wallet_id).get(wallet_id, hold_id)
+
+    async def get_active(self, wallet_id: UUID4) -> t.List[models.HoldDB]:
+        return await self.get_shard(wallet_id).get_active(wallet_id)
+
+    async def resolve(
+            self,
+            wallet_id: UUID4,
+            hold_id: UUID4,
+            status: enums.HoldStatus,
+            now: datetime.datetime,
+    ) -> t.Optional[models.HoldDB]:
+        return await self.get_shard(wallet_id).resolve(wallet_id, hold_id, status, now)
+
+
+# Endpoints are copied to every shard, reads go to the first one
+class ShardedWebhookEndpointDatabaseAdapter:
+    def __init__(self, shards: t.List[adapters.WebhookEndpointDatabaseAdapter]):
+        self.shards = shards
+
+    async def set(self, user_id: UUID4, url: str):
+        await asyncio.gather(*(shard.set(user_id, url) for shard in self.shards))
+
+    async def get(self, user_id: UUID4) -> t.Optional[str]:
+        return await self.shards[0].get(user_id)
+
+    async def delete(self, user_id: UUID4):
+        await asyncio.gather(*(shard.delete(user_id) for shard in self.shards))
+
+
+# Events are written to the shard of the wallet whose transaction is being committed
+class ShardedOutboxDatabaseAdapter:
+    def __init__(self, router: ShardRouter, shards: t.List[adapters.OutboxDatabaseAdapter]):
+        self.router = router
+        self.shards = shards
+
+    async def add(self, wallet_id: UUID4, user_ids: t.Iterable[UUID4], payload: str, now: datetime.datetime):
+        await self.shards[self.router.get_index(wallet_id)].add(user_ids, payload, now)
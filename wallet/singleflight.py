@@ -0,0 +1,64 @@
+import asyncio
+import contextvars
+import typing as t
+
+import metrics
+
+
+T = t.TypeVar('T')
+
+CALLS = metrics.Counter('singleflight_calls_total', 'Calls that ran their own query')
+DEDUPLICATED = metrics.Counter('singleflight_deduplicated_total', 'Calls that joined an identical in-flight query')
+
+
+class _Call:
+    __slots__ = ('task', 'waiters')
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: t.Dict[t.Hashable, _Call] = {}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    # Runs `function` unless an identical call is already running, in which case its result is shared.
+    # The shared call is cancelled only once every caller waiting on it has been cancelled. It runs in an empty
+    # context, so it reads over a pooled connection of its own rather than the one (or the transaction) of the
+    # caller that happened to start it.
+    async def do(self, key: t.Hashable, function: t.Callable[[], t.Awaitable[T]]) -> T:
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(contextvars.Context().run(asyncio.ensure_future, function()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._on_done(key, call))
+            CALLS.inc(name=self.name)
+        else:
+            DEDUPLICATED.inc(name=self.name)
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if call.waiters == 1 and not call.task.done():
+                self._forget(key, call)
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    def _on_done(self, key: t.Hashable, call: _Call):
+        self._forget(key, call)
+        if not call.task.cancelled():
+            # Marks a failure as retrieved even if every waiter is already gone
+            call.task.exception()
+
+    def _forget(self, key: t.Hashable, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
@@ -2,12 +2,18 @@ import uuid
 
 from fastapi_users.db import SQLAlchemyBaseUserTable
 from fastapi_users.db.sqlalchemy import GUID
-from sqlalchemy import Column, String, DECIMAL, Integer, TIMESTAMP, Index
+from sqlalchemy import (
+    BigInteger, Column, String, DECIMAL, Integer, LargeBinary, SmallInteger, Text, TIMESTAMP, Index, text,
+)
 from sqlalchemy.ext.declarative import DeclarativeMeta, declarative_base
 
+import config
+
 
 Base: DeclarativeMeta = declarative_base()
 
+Amount = BigInteger if config.AMOUNTS_AS_MINOR_UNITS else DECIMAL
+
 
 class UserTable(Base, SQLAlchemyBaseUserTable):
     pass
@@ -19,7 +25,13 @@ class WalletTable(Base):
     id = Column(GUID, primary_key=True, default=uuid.uuid4)
     user_id = Column(GUID)
     name = Column(String, unique=True)
-    balance = Column(DECIMAL)
+    balance = Column(Amount)
+    # Bumped on every balance change, used for ETags and optimistic balance updates
+    version = Column(BigInteger, nullable=False, server_default='0')
+    # Overrides WALLET_CONCURRENCY for the wallet, see enums.WalletConcurrency
+    concurrency = Column(String, nullable=True)
+    # Sum of active holds, part of the balance that transfers cannot spend
+    held = Column(Amount, nullable=False, server_default='0')
 
 
 class TransactionTable(Base):
@@ -28,7 +40,7 @@ class TransactionTable(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     sender_wallet_id = Column(GUID, nullable=True)
     recipient_wallet_id = Column(GUID)
-    value = Column(DECIMAL)
+    value = Column(Amount)
     timestamp = Column(TIMESTAMP)
 
     __table_args__ = (
@@ -37,6 +49,183 @@ class TransactionTable(Base):
     )
 
 
+# One row per wallet per transaction side, so that wallet history is a single index range scan
+class WalletEntryTable(Base):
+    __tablename__ = 'wallet_entry'
+
+    wallet_id = Column(GUID, primary_key=True)
+    timestamp = Column(TIMESTAMP, primary_key=True)
+    transaction_id = Column(Integer, primary_key=True)
+    counterparty_wallet_id = Column(GUID, nullable=True)
+    value = Column(Amount)
+
+
+# Old wallet entries moved out of wallet_entry by tools/archive_transactions.py, see archive.py for the format
+class WalletEntryArchiveTable(Base):
+    __tablename__ = 'wallet_entry_archive'
+
+    wallet_id = Column(GUID, primary_key=True)
+    from_timestamp = Column(TIMESTAMP, primary_key=True)
+    from_transaction_id = Column(Integer, primary_key=True)
+    to_timestamp = Column(TIMESTAMP, nullable=False)
+    entry_count = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
+
+# What is left of archived history in the hot tables, updated in the same DB transaction as the archive
+class WalletArchiveSummaryTable(Base):
+    __tablename__ = 'wallet_archive_summary'
+
+    wallet_id = Column(GUID, primary_key=True)
+    archived_until = Column(TIMESTAMP, nullable=False)
+    entry_count = Column(BigInteger, nullable=False)
+    balance = Column(Amount, nullable=False)
+
+
+# Balance of a wallet including all its entries up to (timestamp, transaction_id), written by checkpoints.py
+class WalletBalanceCheckpointTable(Base):
+    __tablename__ = 'wallet_balance_checkpoint'
+
+    wallet_id = Column(GUID, primary_key=True)
+    timestamp = Column(TIMESTAMP, primary_key=True)
+    transaction_id = Column(Integer, primary_key=True)
+    balance = Column(Amount, nullable=False)
+
+
+class WalletSpendingLimitTable(Base):
+    __tablename__ = 'wallet_spending_limit'
+
+    wallet_id = Column(GUID, primary_key=True)
+    hourly_limit = Column(Amount, nullable=True)
+    daily_limit = Column(Amount, nullable=True)
+
+
+# Outgoing transfers of wallets with limits, summed per SPENDING_LIMIT_BUCKET_SECONDS.
+# A wallet has one row per bucket of a day and stale buckets are overwritten in place, so nothing is ever cleaned up.
+class WalletSpendingBucketTable(Base):
+    __tablename__ = 'wallet_spending_bucket'
+
+    wallet_id = Column(GUID, primary_key=True)
+    slot = Column(SmallInteger, primary_key=True)
+    bucket_start = Column(TIMESTAMP, nullable=False)
+    spent = Column(Amount, nullable=False)
+
+
+# Funds reserved on the wallet (counted in wallet.held) until captured as a transfer to the recipient, released or
+# expired. Only active holds are indexed, so the expiry scheduler and hold lists never scan resolved ones.
+class WalletHoldTable(Base):
+    __tablename__ = 'wallet_hold'
+
+    id = Column(GUID, primary_key=True, default=uuid.uuid4)
+    wallet_id = Column(GUID, nullable=False)
+    recipient_wallet_id = Column(GUID, nullable=False)
+    value = Column(Amount, nullable=False)
+    status = Column(String, nullable=False)
+    created_at = Column(TIMESTAMP, nullable=False)
+    expires_at = Column(TIMESTAMP, nullable=False)
+    resolved_at = Column(TIMESTAMP, nullable=True)
+
+    __table_args__ = (
+        Index('wallet_hold_expires_at_idx', 'expires_at', postgresql_where=text("status = 'held'")),
+        Index('wallet_hold_wallet_id_idx', 'wallet_id', postgresql_where=text("status = 'held'")),
+    )
+
+
+# Copied to every shard, so that outbox events can be written in the transaction that moves the money
+class WebhookEndpointTable(Base):
+    __tablename__ = 'webhook_endpoint'
+
+    user_id = Column(GUID, primary_key=True)
+    url = Column(String, nullable=False)
+
+
+# Webhook events not delivered yet, claimed by webhooks.py with SKIP LOCKED and deleted once delivered.
+# Events without next_attempt_at ran out of delivery attempts.
+class OutboxEventTable(Base):
+    __tablename__ = 'outbox_event'
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    user_id = Column(GUID, nullable=False)
+    url = Column(String, nullable=False)
+    payload = Column(Text, nullable=False)
+    created_at = Column(TIMESTAMP, nullable=False)
+    attempts = Column(Integer, nullable=False, server_default='0')
+    next_attempt_at = Column(TIMESTAMP, nullable=True)
+
+    __table_args__ = (
+        Index('outbox_event_next_attempt_at_idx', 'next_attempt_at'),
+    )
+
+
+# Commit decisions of cross-shard transfers, kept in the first database until every shard has committed
+class ShardTransactionTable(Base):
+    __tablename__ = 'shard_transaction'
+
+    gid = Column(String, primary_key=True)
+    created_at = Column(TIMESTAMP, nullable=False)
+
+
+# Names of wallets on every shard, kept in the first database so that names are unique across shards
+class WalletNameTable(Base):
+    __tablename__ = 'wallet_name'
+
+    name = Column(String, primary_key=True)
+    wallet_id = Column(GUID, nullable=False)
+
+
+# Queue of background exports, claimed by worker processes with SKIP LOCKED
+class ExportJobTable(Base):
+    __tablename__ = 'export_job'
+
+    id = Column(GUID, primary_key=True, default=uuid.uuid4)
+    user_id = Column(GUID, nullable=False)
+    wallet_id = Column(GUID, nullable=False)
+    from_timestamp = Column(TIMESTAMP, nullable=True)
+    to_timestamp = Column(TIMESTAMP, nullable=True)
+    side = Column(String, nullable=True)
+    status = Column(String, nullable=False)
+    rows_written = Column(BigInteger, nullable=False, server_default='0')
+    rows_total = Column(BigInteger, nullable=True)
+    created_at = Column(TIMESTAMP, nullable=False)
+    # Refreshed on every written page, so jobs of a dead worker process can be told apart and retried
+    updated_at = Column(TIMESTAMP, nullable=False)
+    expires_at = Column(TIMESTAMP, nullable=True)
+
+    __table_args__ = (
+        Index('export_job_status_created_at_idx', 'status', 'created_at'),
+        Index('export_job_expires_at_idx', 'expires_at'),
+    )
+
+
+# Statements not expressible with SQLAlchemy 1.3 (e.g. covering indexes), applied idempotently by create_tables
+EXTRA_DDL = [
+    'ALTER TABLE wallet ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0',
+    'ALTER TABLE wallet ADD COLUMN IF NOT EXISTS concurrency VARCHAR',
+    f'ALTER TABLE wallet ADD COLUMN IF NOT EXISTS held {"BIGINT" if config.AMOUNTS_AS_MINOR_UNITS else "NUMERIC"} '
+    'NOT NULL DEFAULT 0',
+    # Replaces wallet_user_id_id_idx, which did not cover version: IF NOT EXISTS would keep the old one in place
+    'DROP INDEX IF EXISTS wallet_user_id_id_idx',
+    'CREATE INDEX IF NOT EXISTS wallet_user_id_id_version_idx ON wallet (user_id, id) INCLUDE (name, balance, version)',
+    # Operation filters (see models.OperationFilter). Deposits have no counterparty, so they are left out of its index,
+    # which keeps entries between two wallets in history order.
+    'CREATE INDEX IF NOT EXISTS wallet_entry_counterparty_idx ON wallet_entry '
+    '(wallet_id, counterparty_wallet_id, timestamp, transaction_id) WHERE counterparty_wallet_id IS NOT NULL',
+    'CREATE INDEX IF NOT EXISTS wallet_entry_abs_value_idx ON wallet_entry (wallet_id, abs(value))',
+    'CREATE INDEX IF NOT EXISTS wallet_entry_transaction_id_idx ON wallet_entry (wallet_id, transaction_id)',
+]
+
 users = UserTable.__table__
 wallets = WalletTable.__table__
 transactions = TransactionTable.__table__
+wallet_entries = WalletEntryTable.__table__
+export_jobs = ExportJobTable.__table__
+wallet_entry_archives = WalletEntryArchiveTable.__table__
+wallet_archive_summaries = WalletArchiveSummaryTable.__table__
+wallet_balance_checkpoints = WalletBalanceCheckpointTable.__table__
+shard_transactions = ShardTransactionTable.__table__
+wallet_names = WalletNameTable.__table__
+wallet_spending_limits = WalletSpendingLimitTable.__table__
+wallet_spending_buckets = WalletSpendingBucketTable.__table__
+wallet_holds = WalletHoldTable.__table__
+webhook_endpoints = WebhookEndpointTable.__table__
+outbox_events = OutboxEventTable.__table__
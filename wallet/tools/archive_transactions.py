@@ -0,0 +1,113 @@
+"""Moves wallet history older than a cutoff into compressed per-wallet batches in wallet_entry_archive.
+
+Every wallet is archived in its own DB transaction together with its wallet_archive_summary row,
+then archived rows are deleted from transaction. Reads merge the archive back once TRANSACTION_ARCHIVE_ENABLED is set.
+Usage example:
+    python tools/archive_transactions.py --before 2019-01-01
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import uuid
+
+import asyncpg
+
+import archive
+import config
+import tables
+
+
+_LOGGER = logging.getLogger(__name__)
+
+WALLET_BATCH_SIZE = 1000
+DELETE_BATCH_SIZE = 500_000
+
+SELECT_WALLETS_SQL = f'SELECT id FROM "{tables.wallets.name}" WHERE id > $1 ORDER BY id LIMIT $2'
+SELECT_ENTRIES_SQL = f'''
+    SELECT timestamp, transaction_id, counterparty_wallet_id, value
+    FROM "{tables.wallet_entries.name}"
+    WHERE wallet_id = $1 AND timestamp < $2
+    ORDER BY timestamp, transaction_id
+    FOR UPDATE
+'''
+INSERT_BATCH_SQL = f'''
+    INSERT INTO "{tables.wallet_entry_archives.name}"
+    (wallet_id, from_timestamp, from_transaction_id, to_timestamp, entry_count, data)
+    VALUES ($1, $2, $3, $4, $5, $6)
+'''
+UPSERT_SUMMARY_SQL = f'''
+    INSERT INTO "{tables.wallet_archive_summaries.name}" AS s (wallet_id, archived_until, entry_count, balance)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (wallet_id) DO UPDATE SET
+        archived_until = greatest(s.archived_until, excluded.archived_until),
+        entry_count = s.entry_count + excluded.entry_count,
+        balance = s.balance + excluded.balance
+'''
+DELETE_ENTRIES_SQL = f'DELETE FROM "{tables.wallet_entries.name}" WHERE wallet_id = $1 AND timestamp < $2'
+DELETE_TRANSACTIONS_SQL = f'''
+    DELETE FROM "{tables.transactions.name}" WHERE id BETWEEN $1 AND $2 AND timestamp < $3
+'''
+
+
+async def archive_wallet(connection: asyncpg.Connection, wallet_id: uuid.UUID, cutoff: datetime.datetime) -> int:
+    async with connection.transaction():
+        entries = await connection.fetch(SELECT_ENTRIES_SQL, wallet_id, cutoff)
+        if not entries:
+            return 0
+        batch_size = config.TRANSACTION_ARCHIVE_BATCH_SIZE
+        for batch_start in range(0, len(entries), batch_size):
+            batch = entries[batch_start:batch_start + batch_size]
+            await connection.execute(
+                INSERT_BATCH_SQL,
+                wallet_id,
+                batch[0]['timestamp'],
+                batch[0]['transaction_id'],
+                batch[-1]['timestamp'],
+                len(batch),
+                archive.encode_entries(batch),
+            )
+        balance = sum(entry['value'] for entry in entries)
+        await connection.execute(UPSERT_SUMMARY_SQL, wallet_id, cutoff, len(entries), balance)
+        await connection.execute(DELETE_ENTRIES_SQL, wallet_id, cutoff)
+    return len(entries)
+
+
+async def archive_before(connection: asyncpg.Connection, cutoff: datetime.datetime):
+    last_wallet_id = uuid.UUID(int=0)
+    archived_count = 0
+    while True:
+        rows = await connection.fetch(SELECT_WALLETS_SQL, last_wallet_id, WALLET_BATCH_SIZE)
+        wallet_ids = [row['id'] for row in rows]
+        if not wallet_ids:
+            break
+        for wallet_id in wallet_ids:
+            archived_count += await archive_wallet(connection, wallet_id, cutoff)
+        last_wallet_id = wallet_ids[-1]
+        _LOGGER.info(f'Archived {archived_count} wallet entries up to wallet {last_wallet_id}')
+
+    min_id, max_id = await connection.fetchrow(f'SELECT min(id), max(id) FROM "{tables.transactions.name}"')
+    if min_id is None:
+        return
+    for batch_start in range(min_id, max_id + 1, DELETE_BATCH_SIZE):
+        batch_end = min(batch_start + DELETE_BATCH_SIZE - 1, max_id)
+        await connection.execute(DELETE_TRANSACTIONS_SQL, batch_start, batch_end, cutoff)
+        _LOGGER.info(f'Deleted archived transactions {batch_start}..{batch_end}')
+
+
+async def main(cutoff: datetime.datetime):
+    # Entries, archives and summaries of a wallet live on its shard, so every shard is archived on its own
+    for dsn in config.POSTGRES_SHARD_DSNS:
+        connection = await asyncpg.connect(dsn)
+        try:
+            await archive_before(connection, cutoff)
+        finally:
+            await connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--before', type=datetime.datetime.fromisoformat, required=True)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(args.before))
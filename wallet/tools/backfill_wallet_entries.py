@@ -0,0 +1,51 @@
+import asyncio
+import logging
+
+import asyncpg
+
+import config
+import tables
+
+
+_LOGGER = logging.getLogger(__name__)
+
+BATCH_SIZE = 500_000
+
+BACKFILL_SQL = f'''
+    INSERT INTO "{tables.wallet_entries.name}" (wallet_id, timestamp, transaction_id, counterparty_wallet_id, value)
+    SELECT recipient_wallet_id, timestamp, id, sender_wallet_id, value
+    FROM "{tables.transactions.name}"
+    WHERE id BETWEEN $1 AND $2
+    UNION ALL
+    SELECT sender_wallet_id, timestamp, id, recipient_wallet_id, -value
+    FROM "{tables.transactions.name}"
+    WHERE id BETWEEN $1 AND $2 AND sender_wallet_id IS NOT NULL
+    ON CONFLICT DO NOTHING
+'''
+
+
+async def backfill(connection: asyncpg.Connection):
+    min_id, max_id = await connection.fetchrow(f'SELECT min(id), max(id) FROM "{tables.transactions.name}"')
+    if min_id is None:
+        _LOGGER.info('No transactions to backfill')
+        return
+    for batch_start in range(min_id, max_id + 1, BATCH_SIZE):
+        batch_end = min(batch_start + BATCH_SIZE - 1, max_id)
+        await connection.execute(BACKFILL_SQL, batch_start, batch_end)
+        _LOGGER.info(f'Backfilled wallet entries of transactions {batch_start}..{batch_end}')
+
+
+async def main():
+    if len(config.POSTGRES_SHARD_DSNS) > 1:
+        # Entries of recipients on other shards would be written next to the transaction instead of on their shard
+        raise SystemExit('Backfilling a sharded database is not supported, unset POSTGRES_EXTRA_SHARD_DSNS')
+    connection = await asyncpg.connect(config.POSTGRES_DSN)
+    try:
+        await backfill(connection)
+    finally:
+        await connection.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
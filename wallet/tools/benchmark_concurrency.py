@@ -0,0 +1,113 @@
+"""Compares pessimistic and optimistic transfers (see WALLET_CONCURRENCY) under different contention levels.
+
+Concurrent clients move money between random wallets of a scratch table with the statements the adapters use:
+locks on both wallets then two updates, or unlocked reads then a debit conditional on the sender version.
+Fewer wallets mean more clients hitting the same rows.
+
+Usage example:
+    python tools/benchmark_concurrency.py --wallets 2,20,2000 --clients 32 --seconds 10
+"""
+import argparse
+import asyncio
+import random
+import time
+import typing as t
+
+import asyncpg
+
+import config
+
+
+TABLE = 'benchmark_concurrency_wallet'
+
+CREATE_SQL = f'CREATE UNLOGGED TABLE IF NOT EXISTS {TABLE} (id int PRIMARY KEY, balance numeric, version bigint)'
+
+LOCK_SQL = f'SELECT id, balance FROM {TABLE} WHERE id = ANY($1::int[]) ORDER BY id FOR UPDATE'
+READ_SQL = f'SELECT id, balance, version FROM {TABLE} WHERE id = ANY($1::int[])'
+ALTER_SQL = f'UPDATE {TABLE} SET balance = balance + $2, version = version + 1 WHERE id = $1'
+DEBIT_IF_UNCHANGED_SQL = f'''
+    UPDATE {TABLE} SET balance = balance - $3, version = version + 1
+    WHERE id = $1 AND version = $2 AND balance >= $3
+    RETURNING balance
+'''
+
+
+class Result(t.NamedTuple):
+    transfers: int
+    conflicts: int
+    latencies: t.List[float]
+
+
+async def transfer_pessimistic(connection: asyncpg.Connection, sender: int, recipient: int, retries: int) -> int:
+    async with connection.transaction():
+        await connection.fetch(LOCK_SQL, [sender, recipient])
+        await connection.execute(ALTER_SQL, sender, -1)
+        await connection.execute(ALTER_SQL, recipient, 1)
+    return 0
+
+
+async def transfer_optimistic(connection: asyncpg.Connection, sender: int, recipient: int, retries: int) -> int:
+    async with connection.transaction():
+        for conflicts in range(retries + 1):
+            rows = {row['id']: row for row in await connection.fetch(READ_SQL, [sender, recipient])}
+            if await connection.fetchval(DEBIT_IF_UNCHANGED_SQL, sender, rows[sender]['version'], 1) is not None:
+                await connection.execute(ALTER_SQL, recipient, 1)
+                return conflicts
+        # Same fallback as the application once retries run out
+        await connection.fetch(LOCK_SQL, [sender, recipient])
+        await connection.execute(ALTER_SQL, sender, -1)
+        await connection.execute(ALTER_SQL, recipient, 1)
+        return retries + 1
+
+
+async def run_client(pool: asyncpg.Pool, transfer: t.Callable, wallets: int, retries: int, deadline: float) -> Result:
+    transfers = conflicts = 0
+    latencies = []
+    while time.perf_counter() < deadline:
+        sender, recipient = random.sample(range(wallets), 2)
+        started_at = time.perf_counter()
+        async with pool.acquire() as connection:
+            conflicts += await transfer(connection, sender, recipient, retries)
+        latencies.append(time.perf_counter() - started_at)
+        transfers += 1
+    return Result(transfers, conflicts, latencies)
+
+
+async def run(pool: asyncpg.Pool, mode: str, wallets: int, clients: int, seconds: float, retries: int):
+    await pool.execute(f'TRUNCATE {TABLE}')
+    await pool.execute(
+        f'INSERT INTO {TABLE} (id, balance, version) SELECT id, 1000000000, 0 FROM generate_series(0, $1 - 1) id',
+        wallets,
+    )
+    transfer = transfer_optimistic if mode == 'optimistic' else transfer_pessimistic
+    deadline = time.perf_counter() + seconds
+    results = await asyncio.gather(*(run_client(pool, transfer, wallets, retries, deadline) for _ in range(clients)))
+    transfers = sum(result.transfers for result in results)
+    conflicts = sum(result.conflicts for result in results)
+    latencies = sorted(latency for result in results for latency in result.latencies)
+    print(
+        f'{mode:>11} {wallets:>7} wallets: {transfers / seconds:8.0f} transfers/s, '
+        f'{conflicts / max(transfers, 1):.3f} conflicts/transfer, '
+        f'p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms'
+    )
+
+
+async def main(args: argparse.Namespace):
+    pool = await asyncpg.create_pool(config.POSTGRES_DSN, min_size=args.clients, max_size=args.clients)
+    await pool.execute(CREATE_SQL)
+    try:
+        for wallets in args.wallets:
+            for mode in ('pessimistic', 'optimistic'):
+                await run(pool, mode, wallets, args.clients, args.seconds, args.retries)
+    finally:
+        await pool.execute(f'DROP TABLE IF EXISTS {TABLE}')
+        await pool.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--wallets', type=lambda value: [int(part) for part in value.split(',')], default=[2, 20, 2000])
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--retries', type=int, default=config.WALLET_OPTIMISTIC_RETRIES)
+    asyncio.run(main(parser.parse_args()))
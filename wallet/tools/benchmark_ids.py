@@ -0,0 +1,89 @@
+"""Compares B-tree locality of random and time-ordered wallet ids.
+
+For every id strategy a scratch table keyed by UUID is filled in batches, the way wallets accumulate,
+then the most recent ids are looked up. Buffer usage comes from EXPLAIN (ANALYZE, BUFFERS):
+random ids dirty a page per row on insert, time-ordered ids keep writes and recent lookups on a few pages.
+
+Usage example:
+    python tools/benchmark_ids.py --rows 1000000 --batch 1000 --lookups 10000
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import typing as t
+
+import asyncpg
+
+import config
+import ids
+
+
+TABLE_NAME = 'benchmark_ids_{strategy}'
+
+INSERT_SQL = 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) INSERT INTO {table} (id) SELECT unnest($1::uuid[])'
+LOOKUP_SQL = 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) SELECT id FROM {table} WHERE id = ANY($1::uuid[])'
+INDEX_SIZE_SQL = "SELECT pg_relation_size('{table}_pkey')"
+
+
+class Buffers(t.NamedTuple):
+    hit: int
+    read: int
+    dirtied: int
+
+    def __add__(self, other: 'Buffers') -> 'Buffers':
+        return Buffers(self.hit + other.hit, self.read + other.read, self.dirtied + other.dirtied)
+
+
+async def explain_buffers(connection: asyncpg.Connection, sql: str, *args) -> Buffers:
+    plan = json.loads(await connection.fetchval(sql, *args))[0]['Plan']
+    return Buffers(plan['Shared Hit Blocks'], plan['Shared Read Blocks'], plan['Shared Dirtied Blocks'])
+
+
+async def run(connection: asyncpg.Connection, strategy: str, rows: int, batch: int, lookups: int):
+    table = TABLE_NAME.format(strategy=strategy)
+    make_id = ids.ID_FACTORIES[strategy]
+    await connection.execute(f'DROP TABLE IF EXISTS {table}')
+    await connection.execute(f'CREATE UNLOGGED TABLE {table} (id uuid PRIMARY KEY)')
+    try:
+        inserted = []
+        insert_buffers = Buffers(0, 0, 0)
+        started_at = time.perf_counter()
+        for _ in range(0, rows, batch):
+            batch_ids = [make_id() for _ in range(batch)]
+            insert_buffers += await explain_buffers(connection, INSERT_SQL.format(table=table), batch_ids)
+            inserted += batch_ids
+        insert_seconds = time.perf_counter() - started_at
+
+        recent_ids = random.sample(inserted[-max(rows // 10, lookups):], lookups)
+        started_at = time.perf_counter()
+        lookup_buffers = await explain_buffers(connection, LOOKUP_SQL.format(table=table), recent_ids)
+        lookup_seconds = time.perf_counter() - started_at
+
+        index_size = await connection.fetchval(INDEX_SIZE_SQL.format(table=table))
+        print(
+            f'{strategy:>12}: insert {insert_seconds:.2f}s, {insert_buffers.dirtied / rows:.3f} pages dirtied/row, '
+            f'{insert_buffers.hit + insert_buffers.read} touched; '
+            f'lookup of recent {lookup_seconds:.3f}s, {lookup_buffers.hit} hit, {lookup_buffers.read} read; '
+            f'index {index_size / 1024 ** 2:.1f} MiB'
+        )
+    finally:
+        await connection.execute(f'DROP TABLE IF EXISTS {table}')
+
+
+async def main(args: argparse.Namespace):
+    connection = await asyncpg.connect(config.POSTGRES_DSN)
+    try:
+        for strategy in ids.ID_FACTORIES:
+            await run(connection, strategy, args.rows, args.batch, args.lookups)
+    finally:
+        await connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--lookups', type=int, default=10_000)
+    asyncio.run(main(parser.parse_args()))
@@ -1,9 +1,26 @@
 import sqlalchemy
 
 import config
-from tables import Base
+from tables import Base, EXTRA_DDL
+
+
+# Transaction ids of shard N are congruent to N modulo the number of shards, so they are unique across shards
+SHARD_SEQUENCE_DDL = [
+    'ALTER SEQUENCE transaction_id_seq INCREMENT BY {shard_count}',
+    '''SELECT setval('transaction_id_seq', greatest(
+        (SELECT last_value FROM transaction_id_seq), (SELECT coalesce(max(id), 0) FROM "transaction")
+    ) / {shard_count} * {shard_count} + {shard_count} + {index})''',
+]
 
 
 if __name__ == '__main__':  # pragma: no cover
-    engine = sqlalchemy.create_engine(config.POSTGRES_DSN)
-    Base.metadata.create_all(engine)
+    shard_count = len(config.POSTGRES_SHARD_DSNS)
+    for index, dsn in enumerate(config.POSTGRES_SHARD_DSNS):
+        engine = sqlalchemy.create_engine(dsn)
+        Base.metadata.create_all(engine)
+        with engine.begin() as connection:
+            for statement in EXTRA_DDL:
+                connection.execute(statement)
+            if shard_count > 1:
+                for statement in SHARD_SEQUENCE_DDL:
+                    connection.execute(statement.format(shard_count=shard_count, index=index))
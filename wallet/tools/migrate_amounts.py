@@ -0,0 +1,103 @@
+"""Converts amount columns between NUMERIC and BIGINT units of 1e-8 (see AMOUNTS_AS_MINOR_UNITS).
+
+Every table is rewritten under an exclusive lock, so the application has to be stopped while it runs.
+Shards are converted one after another, each in its own transaction: a failed run is finished by running it again.
+Usage example:
+    python tools/migrate_amounts.py --to minor
+"""
+import argparse
+import asyncio
+import logging
+
+import asyncpg
+
+import archive
+import config
+import models
+import tables
+
+
+_LOGGER = logging.getLogger(__name__)
+
+SCALE = 10 ** models.AMOUNT_DECIMAL_PLACES
+
+AMOUNT_COLUMNS = [
+    (tables.wallets.name, tables.wallets.c.balance.name),
+    (tables.wallets.name, tables.wallets.c.held.name),
+    (tables.wallet_holds.name, tables.wallet_holds.c.value.name),
+    (tables.transactions.name, tables.transactions.c.value.name),
+    (tables.wallet_entries.name, tables.wallet_entries.c.value.name),
+    (tables.wallet_balance_checkpoints.name, tables.wallet_balance_checkpoints.c.balance.name),
+    (tables.wallet_spending_limits.name, tables.wallet_spending_limits.c.hourly_limit.name),
+    (tables.wallet_spending_limits.name, tables.wallet_spending_limits.c.daily_limit.name),
+    (tables.wallet_spending_buckets.name, tables.wallet_spending_buckets.c.spent.name),
+    (tables.wallet_archive_summaries.name, tables.wallet_archive_summaries.c.balance.name),
+]
+
+TO_MINOR_SQL = 'ALTER TABLE "{table}" ALTER COLUMN {column} TYPE BIGINT USING ({column} * {scale})::bigint'
+TO_NUMERIC_SQL = 'ALTER TABLE "{table}" ALTER COLUMN {column} TYPE NUMERIC USING {column}::numeric / {scale}'
+# Rows that would lose precision as minor units
+COUNT_INEXACT_SQL = 'SELECT count(*) FROM "{table}" WHERE {column} * {scale} <> trunc({column} * {scale})'
+SELECT_ARCHIVE_BATCHES_SQL = (
+    f'SELECT wallet_id, from_timestamp, from_transaction_id, data FROM "{tables.wallet_entry_archives.name}"'
+)
+UPDATE_ARCHIVE_BATCH_SQL = (
+    f'UPDATE "{tables.wallet_entry_archives.name}" SET data = $1 '
+    'WHERE wallet_id = $2 AND from_timestamp = $3 AND from_transaction_id = $4'
+)
+
+
+async def migrate(connection: asyncpg.Connection, to_minor: bool):
+    async with connection.transaction():
+        converted = []
+        for table, column in AMOUNT_COLUMNS:
+            data_type = await connection.fetchval(
+                'SELECT data_type FROM information_schema.columns WHERE table_name = $1 AND column_name = $2',
+                table, column,
+            )
+            if (data_type == 'bigint') is to_minor:
+                _LOGGER.info(f'{table}.{column} is already {data_type}')
+                continue
+            if to_minor:
+                inexact = await connection.fetchval(COUNT_INEXACT_SQL.format(table=table, column=column, scale=SCALE))
+                if inexact:
+                    raise ValueError(f'{table}.{column} has {inexact} values with more than 8 decimal places')
+            sql = TO_MINOR_SQL if to_minor else TO_NUMERIC_SQL
+            await connection.execute(sql.format(table=table, column=column, scale=SCALE))
+            converted.append((table, column))
+            _LOGGER.info(f'Converted {table}.{column}')
+        # Archived entries are text inside compressed batches, they are converted along with the archive summaries
+        if (tables.wallet_archive_summaries.name, tables.wallet_archive_summaries.c.balance.name) in converted:
+            await rescale_archive(connection, to_minor)
+        for table, _ in AMOUNT_COLUMNS:
+            await connection.execute(f'ANALYZE "{table}"')
+
+
+async def rescale_archive(connection: asyncpg.Connection, to_minor: bool):
+    places = models.AMOUNT_DECIMAL_PLACES if to_minor else -models.AMOUNT_DECIMAL_PLACES
+    batches = 0
+    async for batch in connection.cursor(SELECT_ARCHIVE_BATCHES_SQL):
+        await connection.execute(
+            UPDATE_ARCHIVE_BATCH_SQL,
+            archive.rescale_entries(batch['data'], places),
+            batch['wallet_id'], batch['from_timestamp'], batch['from_transaction_id'],
+        )
+        batches += 1
+    _LOGGER.info(f'Converted {batches} archived batches')
+
+
+async def main(to_minor: bool):
+    for dsn in config.POSTGRES_SHARD_DSNS:
+        connection = await asyncpg.connect(dsn)
+        try:
+            await migrate(connection, to_minor)
+        finally:
+            await connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--to', choices=('minor', 'numeric'), required=True)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(args.to == 'minor'))
@@ -0,0 +1,72 @@
+"""Finishes cross-shard transfers left prepared by a crashed worker process.
+
+A prepared transaction is committed on every shard when its commit decision is in shard_transaction
+of the first database and rolled back otherwise. Only transactions prepared more than --min-age seconds ago
+are touched, so transfers in progress are left alone.
+Usage example:
+    python tools/recover_transactions.py --min-age 60
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import typing as t
+
+import asyncpg
+
+import config
+import shards
+import tables
+
+
+_LOGGER = logging.getLogger(__name__)
+
+SELECT_PREPARED_SQL = '''
+    SELECT gid FROM pg_prepared_xacts
+    WHERE database = current_database() AND gid LIKE $1 AND prepared < now() - make_interval(secs => $2)
+'''
+SELECT_DECIDED_SQL = f'SELECT gid FROM "{tables.shard_transactions.name}" WHERE gid = ANY($1::text[])'
+DELETE_DECISIONS_SQL = f'''
+    DELETE FROM "{tables.shard_transactions.name}" WHERE created_at < $1 AND gid <> ALL($2::text[])
+'''
+
+
+async def recover(connections: t.List[asyncpg.Connection], min_age: float):
+    log_connection = connections[0]
+    started_at = datetime.datetime.utcnow()
+    in_doubt = []
+    for index, connection in enumerate(connections):
+        rows = await connection.fetch(SELECT_PREPARED_SQL, f'{shards.TwoPhaseCommit.GID_PREFIX}%', min_age)
+        in_doubt += [(index, row['gid']) for row in rows]
+    decided = {
+        row['gid'] for row in await log_connection.fetch(SELECT_DECIDED_SQL, [gid for _, gid in in_doubt])
+    }
+    remaining = []
+    for index, gid in in_doubt:
+        statement = 'COMMIT PREPARED' if gid in decided else 'ROLLBACK PREPARED'
+        try:
+            await connections[index].execute(f"{statement} '{gid}'")
+            _LOGGER.info(f'{statement} {gid} on shard {index}')
+        except asyncpg.PostgresError:
+            _LOGGER.exception(f'{statement} {gid} on shard {index} failed')
+            remaining.append(gid)
+    # Decisions of transfers committed everywhere are no longer needed
+    cutoff = started_at - datetime.timedelta(seconds=min_age)
+    await log_connection.execute(DELETE_DECISIONS_SQL, cutoff, remaining)
+
+
+async def main(min_age: float):
+    connections = [await asyncpg.connect(dsn) for dsn in config.POSTGRES_SHARD_DSNS]
+    try:
+        await recover(connections, min_age)
+    finally:
+        for connection in connections:
+            await connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--min-age', type=float, default=60)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(args.min_age))
@@ -0,0 +1,230 @@
+"""Generates a large synthetic dataset for reproducing performance problems locally.
+
+Usage example (50M transactions spread between 1M wallets of 200k users):
+    python tools/seed_data.py --users 200000 --wallets 1000000 --transactions 50000000 --processes 8
+
+Rows are copied into POSTGRES_DSN only, so it refuses to run when POSTGRES_EXTRA_SHARD_DSNS is set.
+"""
+import argparse
+import asyncio
+import datetime
+import decimal
+import functools
+import hashlib
+import logging
+import random
+import typing as t
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import asyncpg
+from fastapi_users.password import get_password_hash
+
+import config
+import models
+import tables
+from tools.backfill_wallet_entries import backfill
+
+
+_LOGGER = logging.getLogger(__name__)
+
+SEED_PASSWORD = 'test'
+BATCH_SIZE = 50_000
+VALUE_QUANT = decimal.Decimal('0.00000001')
+
+USER_COLUMNS = ['id', 'email', 'hashed_password', 'is_active', 'is_superuser']
+WALLET_COLUMNS = ['id', 'user_id', 'name', 'balance']
+TRANSACTION_COLUMNS = ['sender_wallet_id', 'recipient_wallet_id', 'value', 'timestamp']
+
+ADD_OPENING_DEPOSITS_SQL = f'''
+    INSERT INTO "{tables.transactions.name}" (sender_wallet_id, recipient_wallet_id, value, timestamp)
+    SELECT NULL, sender_wallet_id, sum(value), $1::timestamp
+    FROM "{tables.transactions.name}"
+    WHERE sender_wallet_id IS NOT NULL
+    GROUP BY sender_wallet_id
+'''
+SET_BALANCES_SQL = f'''
+    UPDATE "{tables.wallets.name}" AS w SET balance = e.balance
+    FROM (
+        SELECT wallet_id, sum(value) AS balance FROM "{tables.wallet_entries.name}" GROUP BY wallet_id
+    ) AS e
+    WHERE w.id = e.wallet_id
+'''
+
+
+class SeedOptions(t.NamedTuple):
+    seed: int
+    users: int
+    wallets: int
+    transactions: int
+    hot_skew: float
+    deposit_ratio: float
+    start: datetime.datetime
+    end: datetime.datetime
+    hashed_password: str
+
+
+def make_uuid(options: SeedOptions, kind: str, index: int) -> uuid.UUID:
+    """Deterministic UUID4-compatible ids, so that parallel streams agree on them without sharing state"""
+    digest = hashlib.md5(f'{options.seed}:{kind}:{index}'.encode()).digest()
+    return uuid.UUID(bytes=digest, version=4)
+
+
+def pick_skewed(rng: random.Random, count: int, skew: float) -> int:
+    """Power-law pick: with skew=3 the first 1% of indexes receive ~20% of picks"""
+    return int(count * rng.random() ** skew)
+
+
+def generate_users(options: SeedOptions, offset: int, count: int) -> t.Iterator[tuple]:
+    for index in range(offset, offset + count):
+        yield make_uuid(options, 'user', index), f'seed{index}@seed.test', options.hashed_password, True, False
+
+
+def generate_wallets(options: SeedOptions, offset: int, count: int) -> t.Iterator[tuple]:
+    rng = random.Random(f'{options.seed}:wallet:{offset}')
+    for index in range(offset, offset + count):
+        user_index = pick_skewed(rng, options.users, options.hot_skew)
+        yield (
+            make_uuid(options, 'wallet', index),
+            make_uuid(options, 'user', user_index),
+            f'seed-wallet-{index}',
+            models.to_storage_amount(decimal.Decimal(0)),
+        )
+
+
+def generate_transactions(options: SeedOptions, offset: int, count: int) -> t.Iterator[tuple]:
+    rng = random.Random(f'{options.seed}:transaction:{offset}')
+    span = (options.end - options.start).total_seconds()
+
+    @functools.lru_cache(maxsize=2 ** 16)
+    def wallet_id(index: int) -> uuid.UUID:
+        return make_uuid(options, 'wallet', index)
+
+    for _ in range(count):
+        recipient_index = pick_skewed(rng, options.wallets, options.hot_skew)
+        if rng.random() < options.deposit_ratio:
+            sender_id = None
+        else:
+            sender_index = pick_skewed(rng, options.wallets, options.hot_skew)
+            if sender_index == recipient_index:
+                sender_index = (sender_index + 1) % options.wallets
+            sender_id = wallet_id(sender_index)
+        value = decimal.Decimal(rng.lognormvariate(3, 1.5)).quantize(VALUE_QUANT)
+        timestamp = options.start + datetime.timedelta(seconds=rng.random() * span)
+        yield sender_id, wallet_id(recipient_index), models.to_storage_amount(value), timestamp
+
+
+GENERATORS = {
+    tables.users.name: (generate_users, USER_COLUMNS),
+    tables.wallets.name: (generate_wallets, WALLET_COLUMNS),
+    tables.transactions.name: (generate_transactions, TRANSACTION_COLUMNS),
+}
+
+
+async def copy_stream(options: SeedOptions, table_name: str, offset: int, count: int) -> int:
+    generator, columns = GENERATORS[table_name]
+    connection = await asyncpg.connect(config.POSTGRES_DSN)
+    try:
+        batch = []
+        for record in generator(options, offset, count):
+            batch.append(record)
+            if len(batch) == BATCH_SIZE:
+                await connection.copy_records_to_table(table_name, records=batch, columns=columns)
+                batch = []
+        if batch:
+            await connection.copy_records_to_table(table_name, records=batch, columns=columns)
+    finally:
+        await connection.close()
+    return count
+
+
+def run_copy_stream(options: SeedOptions, table_name: str, offset: int, count: int) -> int:
+    return asyncio.run(copy_stream(options, table_name, offset, count))
+
+
+def copy_in_parallel(executor: ProcessPoolExecutor, options: SeedOptions, table_name: str, total: int, streams: int):
+    _LOGGER.info(f'Copying {total} rows into "{table_name}" with {streams} streams...')
+    stream_size = -(-total // streams)
+    futures = [
+        executor.submit(run_copy_stream, options, table_name, offset, min(stream_size, total - offset))
+        for offset in range(0, total, stream_size)
+    ]
+    copied = sum(future.result() for future in futures)
+    _LOGGER.info(f'Copied {copied} rows into "{table_name}"')
+
+
+async def truncate_tables():
+    connection = await asyncpg.connect(config.POSTGRES_DSN)
+    try:
+        _LOGGER.info('Truncating tables...')
+        await connection.execute(
+            f'TRUNCATE "{tables.wallet_entries.name}", "{tables.transactions.name}", '
+            f'"{tables.wallet_entry_archives.name}", "{tables.wallet_archive_summaries.name}", '
+            f'"{tables.wallet_balance_checkpoints.name}", "{tables.wallet_spending_limits.name}", '
+            f'"{tables.wallet_spending_buckets.name}", "{tables.wallet_holds.name}", "{tables.outbox_events.name}", '
+            f'"{tables.webhook_endpoints.name}", "{tables.wallets.name}", "{tables.users.name}"'
+        )
+    finally:
+        await connection.close()
+
+
+async def finalize(options: SeedOptions):
+    connection = await asyncpg.connect(config.POSTGRES_DSN)
+    try:
+        _LOGGER.info('Adding opening deposits so that no balance ever goes negative...')
+        await connection.execute(ADD_OPENING_DEPOSITS_SQL, options.start - datetime.timedelta(seconds=1))
+        _LOGGER.info('Writing wallet entries...')
+        await backfill(connection)
+        _LOGGER.info('Setting wallet balances...')
+        await connection.execute(SET_BALANCES_SQL)
+        _LOGGER.info('Analyzing...')
+        await connection.execute('ANALYZE')
+    finally:
+        await connection.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--wallets', type=int, default=50_000)
+    parser.add_argument('--transactions', type=int, default=1_000_000)
+    parser.add_argument('--processes', type=int, default=4, help='number of parallel COPY streams')
+    parser.add_argument('--days', type=int, default=3 * 365, help='history length')
+    parser.add_argument('--hot-skew', type=float, default=3.0, help='1 is uniform, larger is hotter')
+    parser.add_argument('--deposit-ratio', type=float, default=0.2, help='share of external deposits')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--truncate', action='store_true', help='empty the tables before seeding')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if len(config.POSTGRES_SHARD_DSNS) > 1:
+        # Wallets hashed to the other shards would never be found there
+        raise SystemExit('Seeding a sharded database is not supported, unset POSTGRES_EXTRA_SHARD_DSNS')
+    end = datetime.datetime.utcnow().replace(microsecond=0)
+    options = SeedOptions(
+        seed=args.seed,
+        users=args.users,
+        wallets=args.wallets,
+        transactions=args.transactions,
+        hot_skew=args.hot_skew,
+        deposit_ratio=args.deposit_ratio,
+        start=end - datetime.timedelta(days=args.days),
+        end=end,
+        # Hashing once instead of per user: bcrypt would otherwise dominate seeding time
+        hashed_password=get_password_hash(SEED_PASSWORD),
+    )
+    if args.truncate:
+        asyncio.run(truncate_tables())
+    with ProcessPoolExecutor(max_workers=args.processes) as executor:
+        copy_in_parallel(executor, options, tables.users.name, options.users, args.processes)
+        copy_in_parallel(executor, options, tables.wallets.name, options.wallets, args.processes)
+        copy_in_parallel(executor, options, tables.transactions.name, options.transactions, args.processes)
+    asyncio.run(finalize(options))
+    _LOGGER.info('Done')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,309 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import time
+import typing as t
+import urllib.request
+
+from databases import Database
+
+import metrics
+
+
+_LOGGER = logging.getLogger(__name__)
+
+DROPPED = metrics.Counter('tracing_dropped_spans_total', 'Finished spans dropped because the export queue was full')
+
+_current_span: contextvars.ContextVar[t.Optional['Span']] = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    __slots__ = ('tracer', 'trace_id', 'span_id', 'parent_id', 'name', 'kind', 'attributes', 'error', 'start_ns',
+                 'end_ns')
+
+    def __init__(
+            self,
+            tracer: 'Tracer',
+            name: str,
+            trace_id: str,
+            parent_id: t.Optional[str],
+            kind: str = 'internal',
+            attributes: t.Dict[str, t.Any] = None,
+    ):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.error = False
+        self.start_ns = time.time_ns()
+        self.end_ns: t.Optional[int] = None
+
+    @property
+    def traceparent(self) -> str:
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+    def child(self, name: str, **attributes) -> 'Span':
+        return Span(self.tracer, name, self.trace_id, self.span_id, attributes=attributes)
+
+    def end(self):
+        self.end_ns = time.time_ns()
+        self.tracer.exporter.export(self)
+
+    def to_dict(self) -> t.Dict[str, t.Any]:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'start_ns': self.start_ns,
+            'end_ns': self.end_ns,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class _NoopSpan:
+    def end(self):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+# Spans of unsampled requests are never created, so the cost of an instrumentation point is a ContextVar lookup
+def start_span(name: str, **attributes) -> t.Union[Span, _NoopSpan]:
+    parent = _current_span.get()
+    return parent.child(name, **attributes) if parent else NOOP_SPAN
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes) -> t.Iterator[t.Optional[Span]]:
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = parent.child(name, **attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException:
+        child.error = True
+        raise
+    finally:
+        _current_span.reset(token)
+        child.end()
+
+
+def traced(function: t.Callable[..., t.Awaitable]) -> t.Callable[..., t.Awaitable]:
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        if _current_span.get() is None:
+            return await function(*args, **kwargs)
+        with span(function.__qualname__):
+            return await function(*args, **kwargs)
+    return wrapper
+
+
+@contextlib.asynccontextmanager
+async def transaction(database: Database):
+    with span('db.transaction'):
+        commit_span = None
+        async with database.transaction():
+            yield
+            commit_span = start_span('db.commit')
+        if commit_span:
+            commit_span.end()
+
+
+class SpanExporter:
+    def __init__(self, batch_size: int = 512, max_queue_size: int = 8192, interval: float = 1.0):
+        self.batch_size = batch_size
+        self.max_queue_size = max_queue_size
+        self.interval = interval
+        self._spans: t.List[Span] = []
+        self._task: t.Optional[asyncio.Future] = None
+
+    def export(self, span: Span):
+        if len(self._spans) >= self.max_queue_size:
+            DROPPED.inc()
+            return
+        self._spans.append(span)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        while self._spans:
+            batch, self._spans = self._spans[:self.batch_size], self._spans[self.batch_size:]
+            try:
+                # Writes block, so they are kept off the event loop
+                await asyncio.get_event_loop().run_in_executor(None, self.write, batch)
+            except Exception:
+                _LOGGER.exception(f'Failed to export {len(batch)} spans')
+
+    def write(self, spans: t.List[Span]):
+        raise NotImplementedError
+
+
+class FileExporter(SpanExporter):
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+
+    def write(self, spans: t.List[Span]):
+        with open(self.path, 'a') as file:
+            file.writelines(json.dumps(span.to_dict(), default=str) + '\n' for span in spans)
+
+
+# OTLP/HTTP with the JSON encoding, accepted by the OpenTelemetry collector and most tracing backends
+class OtlpExporter(SpanExporter):
+    KINDS = {'internal': 1, 'server': 2}
+
+    def __init__(self, endpoint: str, service_name: str, timeout: float = 5.0, **kwargs):
+        super().__init__(**kwargs)
+        self.url = endpoint.rstrip('/') + '/v1/traces'
+        self.service_name = service_name
+        self.timeout = timeout
+
+    def write(self, spans: t.List[Span]):
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(self.make_payload(spans)).encode(),
+            headers={'Content-Type': 'application/json'},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+    def make_payload(self, spans: t.List[Span]) -> t.Dict[str, t.Any]:
+        return {'resourceSpans': [{
+            'resource': {'attributes': self._make_attributes({'service.name': self.service_name})},
+            'scopeSpans': [{
+                'scope': {'name': self.service_name},
+                'spans': [{
+                    'traceId': span.trace_id,
+                    'spanId': span.span_id,
+                    'parentSpanId': span.parent_id or '',
+                    'name': span.name,
+                    'kind': self.KINDS[span.kind],
+                    'startTimeUnixNano': str(span.start_ns),
+                    'endTimeUnixNano': str(span.end_ns),
+                    'attributes': self._make_attributes(span.attributes),
+                    'status': {'code': 2 if span.error else 0},
+                } for span in spans],
+            }],
+        }]}
+
+    @staticmethod
+    def _make_attributes(attributes: t.Dict[str, t.Any]) -> t.List[t.Dict[str, t.Any]]:
+        values = []
+        for key, value in attributes.items():
+            if isinstance(value, bool):
+                values.append({'key': key, 'value': {'boolValue': value}})
+            elif isinstance(value, int):
+                values.append({'key': key, 'value': {'intValue': str(value)}})
+            elif isinstance(value, float):
+                values.append({'key': key, 'value': {'doubleValue': value}})
+            else:
+                values.append({'key': key, 'value': {'stringValue': str(value)}})
+        return values
+
+
+def parse_traceparent(traceparent: t.Optional[str]) -> t.Optional[t.Tuple[str, str, bool]]:
+    if not traceparent:
+        return None
+    parts = traceparent.strip().split('-')
+    if len(parts) < 4 or parts[0] == 'ff' or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        trace_id, parent_id, flags = parts[1].lower(), parts[2].lower(), int(parts[3][:2], 16)
+    except ValueError:
+        return None
+    if int(trace_id, 16) == 0 or int(parent_id, 16) == 0:
+        return None
+    return trace_id, parent_id, bool(flags & 1)
+
+
+# Incoming sampling decisions are honoured, requests without trace context are sampled with `sample_ratio`
+class Tracer:
+    def __init__(self, exporter: t.Optional[SpanExporter], sample_ratio: float):
+        self.exporter = exporter
+        self.sample_ratio = sample_ratio
+
+    def start_request_span(self, name: str, traceparent: t.Optional[str], **attributes) -> t.Optional[Span]:
+        if self.exporter is None:
+            return None
+        parent = parse_traceparent(traceparent)
+        if parent:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id, parent_id, sampled = '%032x' % random.getrandbits(128), None, random.random() < self.sample_ratio
+        if not sampled:
+            return None
+        return Span(self, name, trace_id, parent_id, kind='server', attributes=attributes)
+
+
+class TracingMiddleware:
+    def __init__(self, app, tracer: Tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope['headers'])
+        traceparent = headers.get(b'traceparent')
+        request_span = self.tracer.start_request_span(
+            f"{scope['method']} {scope['path']}",
+            traceparent.decode('latin-1') if traceparent else None,
+            **{'http.method': scope['method'], 'http.target': scope['path']},
+        )
+        if request_span is None:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                request_span.attributes['http.status_code'] = message['status']
+                request_span.error = message['status'] >= 500
+                message['headers'] = [*message.get('headers', []), (b'traceparent', request_span.traceparent.encode())]
+            await send(message)
+
+        token = _current_span.set(request_span)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException:
+            request_span.error = True
+            raise
+        finally:
+            _current_span.reset(token)
+            request_span.end()
+
+
+def make_exporter(kind: str, path: str, endpoint: str, service_name: str) -> t.Optional[SpanExporter]:
+    if kind == 'file':
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        return FileExporter(path)
+    if kind == 'otlp':
+        return OtlpExporter(endpoint, service_name)
+    return None
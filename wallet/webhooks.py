@@ -0,0 +1,155 @@
+import asyncio
+import datetime
+import json
+import logging
+import typing as t
+import uuid
+
+import httpx
+
+import adapters
+import enums
+import metrics
+import models
+
+
+_LOGGER = logging.getLogger(__name__)
+
+DELIVERED = metrics.Counter('webhook_events_delivered_total', 'Webhook events accepted by endpoints')
+REQUESTS = metrics.Counter('webhook_requests_total', 'Webhook delivery requests by outcome')
+PARKED = metrics.Counter('webhook_events_parked_total', 'Webhook events that ran out of delivery attempts')
+LAG = metrics.Gauge('webhook_delivery_lag_seconds', 'Age of the oldest event in the last delivered webhook request')
+
+
+def make_event(transaction: models.TransactionDB, transaction_id: int) -> str:
+    event_type = enums.WebhookEventType.transfer if transaction.sender_wallet_id else enums.WebhookEventType.deposit
+    return json.dumps({
+        'id': str(uuid.uuid4()),
+        'type': event_type.value,
+        'transaction_id': transaction_id,
+        'sender_wallet_id': str(transaction.sender_wallet_id) if transaction.sender_wallet_id else None,
+        'recipient_wallet_id': str(transaction.recipient_wallet_id),
+        'value': str(transaction.value),
+        'timestamp': transaction.timestamp.isoformat(),
+    })
+
+
+# Every worker process polls the outbox of every shard, SKIP LOCKED keeps the processes off each other's batches.
+# A batch is split per endpoint into requests of several events, at most `endpoint_concurrency` in flight per URL,
+# so a slow endpoint holds up its own events only.
+class WebhookDispatcher:
+    def __init__(
+            self,
+            db_adapters: t.List[adapters.OutboxDatabaseAdapter],
+            batch_size: int,
+            events_per_request: int,
+            endpoint_concurrency: int,
+            max_connections: int,
+            timeout: float,
+            max_attempts: int,
+            retry_base_seconds: float,
+            retry_max_seconds: float,
+            lease_seconds: int,
+            poll_interval: float,
+    ):
+        self.db_adapters = db_adapters
+        self.batch_size = batch_size
+        self.events_per_request = events_per_request
+        self.endpoint_concurrency = endpoint_concurrency
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self._client: t.Optional[httpx.AsyncClient] = None
+        self._semaphores: t.Dict[str, asyncio.Semaphore] = {}
+        self._wakeups: t.List[asyncio.Event] = []
+        self._tasks: t.List[asyncio.Future] = []
+
+    def start(self):
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout,
+            pool_limits=httpx.PoolLimits(max_keepalive=self.max_connections, max_connections=self.max_connections),
+        )
+        self._wakeups = [asyncio.Event() for _ in self.db_adapters]
+        self._tasks = [
+            asyncio.ensure_future(self._run(db_adapter, wakeup))
+            for db_adapter, wakeup in zip(self.db_adapters, self._wakeups)
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._client:
+            await self._client.aclose()
+            self._client = None
+
+    # Called after commit, so new events go out without waiting for the next poll
+    def notify(self):
+        for wakeup in self._wakeups:
+            wakeup.set()
+
+    async def _run(self, db_adapter: adapters.OutboxDatabaseAdapter, wakeup: asyncio.Event):
+        while True:
+            wakeup.clear()
+            try:
+                claimed = await self.run(db_adapter)
+            except Exception:
+                _LOGGER.exception('Webhook dispatch failed')
+                claimed = 0
+            if claimed < self.batch_size:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def run(self, db_adapter: adapters.OutboxDatabaseAdapter) -> int:
+        now = datetime.datetime.utcnow()
+        events = await db_adapter.claim(now, self.batch_size, datetime.timedelta(seconds=self.lease_seconds))
+        url_events = {}
+        for event in events:
+            url_events.setdefault(event.url, []).append(event)
+        await asyncio.gather(*(
+            self._deliver(db_adapter, url, url_event_list[start:start + self.events_per_request])
+            for url, url_event_list in url_events.items()
+            for start in range(0, len(url_event_list), self.events_per_request)
+        ))
+        return len(events)
+
+    async def _deliver(
+            self,
+            db_adapter: adapters.OutboxDatabaseAdapter,
+            url: str,
+            events: t.List[models.OutboxEventDB],
+    ):
+        semaphore = self._semaphores.setdefault(url, asyncio.Semaphore(self.endpoint_concurrency))
+        body = {'events': [json.loads(event.payload) for event in events]}
+        async with semaphore:
+            try:
+                response = await self._client.post(url, json=body)
+                delivered = 200 <= response.status_code < 300
+            except Exception:
+                _LOGGER.warning(f'Webhook request to {url} failed', exc_info=True)
+                delivered = False
+        now = datetime.datetime.utcnow()
+        if delivered:
+            REQUESTS.inc(outcome='delivered')
+            DELIVERED.inc(len(events))
+            LAG.set(max((now - event.created_at).total_seconds() for event in events))
+            await db_adapter.delete([event.id for event in events])
+            return
+        REQUESTS.inc(outcome='failed')
+        attempt_events = {}
+        for event in events:
+            attempt_events.setdefault(event.attempts, []).append(event.id)
+        for attempts, event_ids in attempt_events.items():
+            if attempts >= self.max_attempts:
+                PARKED.inc(len(event_ids))
+                await db_adapter.reschedule(event_ids, None)
+            else:
+                delay = min(self.retry_base_seconds * 2 ** (attempts - 1), self.retry_max_seconds)
+                await db_adapter.reschedule(event_ids, now + datetime.timedelta(seconds=delay))
@@ -0,0 +1,7 @@
+from uvicorn.workers import UvicornWorker as BaseUvicornWorker
+
+import config
+
+
+class UvicornWorker(BaseUvicornWorker):
+    CONFIG_KWARGS = {'loop': config.APP_LOOP, 'http': config.APP_HTTP}